@@ -1,10 +1,21 @@
+import itertools
 import os
+import time
+import zlib
 from datetime import date
-from typing import Callable, Union
+from typing import Callable, Union, Iterator
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Date, UniqueConstraint
+from fastapi import Request
+
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Date, DateTime, Index
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
 
+from Backend.metrics import database_metrics
+from Backend.migrations import upgrade
+
 """
 The databases are very much look alike for simplicity of development.
 There is no real reason for that so that's why I didn't build a more complex schema with a inheritance.
@@ -13,6 +24,33 @@ There is no real reason for that so that's why I didn't build a more complex sch
 # Global placeholders (will be initialized inside init_db)
 engine = None
 SessionLocal: Union[Callable, None] = None
+# only in the async mode (see Backend/async_routes.py)
+async_engine: Union[AsyncEngine, None] = None
+AsyncSessionLocal: Union[Callable, None] = None
+# the sessions of the read replicas (DATABASE_READ_URL) in turns, the primary's if there are none
+ReadSessions: Union[Iterator[Callable], None] = None
+AsyncReadSessions: Union[Iterator[Callable], None] = None
+# the sessions of every shard (DATABASE_SHARD_URLS), empty when the users are in one database (see Backend/shards.py)
+ShardSessions: list[Callable] = []
+
+# a request with this header reads from the primary, so it sees the writes that weren't replicated yet
+READ_PRIMARY_HEADER = 'X-Read-Primary'
+# set on the responses of writes, the next reads of the client go to the primary for READ_YOUR_WRITES_SECONDS
+LAST_WRITE_COOKIE = 'last_write'
+
+# the pool settings of the engines, environment variable -> (the argument of create_engine, its type)
+POOL_SETTINGS = {
+    'DB_POOL_SIZE'    : ('pool_size', int),
+    'DB_MAX_OVERFLOW' : ('max_overflow', int),
+    'DB_POOL_TIMEOUT' : ('pool_timeout', float),
+    'DB_POOL_RECYCLE' : ('pool_recycle', int),
+    'DB_POOL_PRE_PING': ('pool_pre_ping', lambda value: value.lower() in ('true', '1')),
+}
+
+# the async drivers of the databases the app runs on
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
+# the drivers that create_async_engine can use as they are (psycopg 3 is both sync and async)
+ASYNC_CAPABLE_DRIVERS = {'aiosqlite', 'asyncpg', 'psycopg', 'psycopg_async'}
 
 Base = declarative_base()
 
@@ -24,7 +62,7 @@ class User(Base):
     # In order to not expose the id to the users we will use the user_name as the main identifier for the user
     user_name = Column(String, unique=True, nullable=False)
     name = Column(String, nullable=False)
-    age = Column(Integer, nullable=False)
+    age = Column(Integer, nullable=False, index=True)  # the cohorts are selected by age
 
 
 class PhysicalActivity(Base):
@@ -37,7 +75,8 @@ class PhysicalActivity(Base):
     date = Column(Date, default=date.today, )
     __table_args__ = (
         # The app support one activity data unit per day. all other data will be added to the same day
-        UniqueConstraint('id', 'date'),
+        # all the queries filter by the user and the date, so it's also the index they use
+        Index('ix_physical_activity_user_id_date', 'user_id', 'date', unique=True),
     )
 
 
@@ -53,7 +92,7 @@ class SleepActivity(Base):
                   nullable=False)
     __table_args__ = (
         # the app support one sleep per day, the date is the time that the sleep started
-        UniqueConstraint('id', 'date'),
+        Index('ix_sleep_activity_user_id_date', 'user_id', 'date', unique=True),
     )
 
 
@@ -69,20 +108,236 @@ class BloodTest(Base):
     date = Column(Date, default=date.today)
     __table_args__ = (
         # the app support one blood test per day, the date is the time that the test was taken
-        UniqueConstraint('id', 'date'),
+        Index('ix_blood_tests_user_id_date', 'user_id', 'date', unique=True),
     )
 
 
+class UserAggregate(Base):
+    """Running sum and count of every metric of a user, so cohort averages don't need to scan the raw rows"""
+    __tablename__ = "user_aggregates"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    domain = Column(String, primary_key=True)  # physical / sleep / blood
+    metric = Column(String, primary_key=True)  # the column name in the domain table
+    total = Column(Float, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class MonthlyAggregate(Base):
+    """Count, sum and sum of squares of every metric of a user in a year-month, the user's aggregates are their sum"""
+    __tablename__ = "monthly_aggregates"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    domain = Column(String, primary_key=True)
+    month = Column(Integer, primary_key=True)  # year * 100 + month, 202310
+    metric = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    total = Column(Float, nullable=False, default=0)
+    total_squares = Column(Float, nullable=False, default=0)
+
+
+class ScoreState(Base):
+    """The exponentially weighted average of the monthly averages of a metric of a user, see Backend/ewma.py"""
+    __tablename__ = "score_states"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    domain = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)
+    weighted_total = Column(Float, nullable=False, default=0)  # the sum of the weighted monthly averages
+    weights = Column(Float, nullable=False, default=0)  # the sum of the weights, the last month has the weight 1
+    months = Column(Integer, nullable=False, default=0)
+    missing = Column(Integer, nullable=False, default=0)  # the months without values of the metric
+    last_month = Column(Integer, nullable=False)
+
+
+class CohortAggregate(Base):
+    """The sum of the per-user means of every metric for each age range (cohort) that get_age_range can return"""
+    __tablename__ = "cohort_aggregates"
+    age_bucket = Column(Integer, primary_key=True)  # the start of the age range
+    domain = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)
+    total = Column(Float, nullable=False, default=0)
+    users = Column(Integer, nullable=False, default=0)
+
+
+class HealthScore(Base):
+    """The health score of every user as of the last recompute job (see Backend/recompute.py)"""
+    __tablename__ = "health_scores"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    run_id = Column(Integer, ForeignKey("score_runs.id"), nullable=False)
+    score = Column(Float, nullable=True)
+    error = Column(String, nullable=True)  # the reason there is no score
+
+
+class ScoreRun(Base):
+    __tablename__ = "score_runs"
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)  # still null if the run was interrupted, it can be resumed
+
+
+class ScoreRunPartition(Base):
+    """The chunks of users a run already scored, the users that are missing are scored when the run is resumed"""
+    __tablename__ = "score_run_partitions"
+    run_id = Column(Integer, ForeignKey("score_runs.id", ondelete="CASCADE"), primary_key=True)
+    age_bucket = Column(Integer, primary_key=True)
+    first_user_id = Column(Integer, primary_key=True)
+    last_user_id = Column(Integer, nullable=False)
+    users = Column(Integer, nullable=False)
+    finished_at = Column(DateTime, nullable=False)
+
+
+def dialect_insert(db: Session, model):
+    """INSERT with ON CONFLICT support (on_conflict_do_nothing/do_update), the app runs on SQLite or Postgres"""
+    if db.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def async_mode() -> bool:
+    return os.environ.get('DATABASE_ASYNC', 'false').lower() in ('true', '1')
+
+
+def async_url(database_url: str) -> str:
+    """
+    The url with the async driver of the database, the sync drivers are replaced
+    (sqlite:///health.db and sqlite+pysqlite:///health.db -> sqlite+aiosqlite:///health.db)
+    """
+    url = make_url(database_url)
+    if '+' in url.drivername and url.get_driver_name() in ASYNC_CAPABLE_DRIVERS:
+        return database_url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver for {url.drivername}, set DATABASE_ASYNC_URL')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}').render_as_string(hide_password=False)
+
+
+def pool_options() -> dict:
+    """The pool settings that are set in the environment, SQLAlchemy's defaults are used for the rest"""
+    return {argument: parse(os.environ[variable])
+            for variable, (argument, parse) in POOL_SETTINGS.items() if os.environ.get(variable)}
+
+
+def read_urls() -> list[str]:
+    """The urls of the read replicas, DATABASE_READ_URL is a comma separated list"""
+    return [url.strip() for url in os.environ.get('DATABASE_READ_URL', '').split(',') if url.strip()]
+
+
+def shard_urls() -> list[str]:
+    """The urls of the shards, DATABASE_SHARD_URLS is a comma separated list. The order must never change"""
+    return [url.strip() for url in os.environ.get('DATABASE_SHARD_URLS', '').split(',') if url.strip()]
+
+
+def shard_of(user_name: str, shards: int) -> int:
+    # crc32 and not hash(), which is different in every process
+    return zlib.crc32(user_name.encode()) % shards
+
+
+def session_factory(user_name: Union[str, None]) -> Callable:
+    """The sessions of the shard of the user, of the first shard for the routes that aren't of one user"""
+    if not ShardSessions or user_name is None:
+        return SessionLocal
+    return ShardSessions[shard_of(user_name, len(ShardSessions))]
+
+
+def use_shard(db: Session, user_name: str) -> None:
+    """Move the session to the shard of the user, for the routes that get the user in the body. Before it's used"""
+    if ShardSessions:
+        db.bind = session_factory(user_name).kw['bind']
+
+
 def init_db():
-    global engine, SessionLocal
-    engine = create_engine(os.environ['DATABASE_URL'])
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    Base.metadata.create_all(bind=engine)
+    global engine, SessionLocal, async_engine, AsyncSessionLocal, ReadSessions, AsyncReadSessions, ShardSessions
+    urls = shard_urls() or [os.environ['DATABASE_URL']]
+    if len(urls) > 1 and (read_urls() or async_mode()):
+        raise ValueError('DATABASE_SHARD_URLS can not be used with DATABASE_READ_URL or DATABASE_ASYNC')
+    engines = [create_engine(url, **pool_options()) for url in urls]
+    ShardSessions = [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+                     for shard_engine in engines] if len(engines) > 1 else []
+    # the first shard is also the database of what doesn't belong to a user
+    engine = engines[0]
+    SessionLocal = ShardSessions[0] if ShardSessions else sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    for i, shard_engine in enumerate(engines):
+        database_metrics.observe(f'shard_{i}' if ShardSessions else 'primary', shard_engine)
+    # the replicas are migrated by the replication of the primary
+    read_engines = [create_engine(url, **pool_options()) for url in read_urls()]
+    for i, read_engine in enumerate(read_engines):
+        database_metrics.observe(f'replica_{i}', read_engine)
+    ReadSessions = itertools.cycle([sessionmaker(autoflush=False, bind=read_engine) for read_engine in read_engines]
+                                   or [SessionLocal])
+    # the sync engine is still used by the migrations and the sync_only routes
+    if async_mode():
+        async_engine = create_async_engine(os.environ.get('DATABASE_ASYNC_URL') or async_url(urls[0]),
+                                           **pool_options())
+        AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False)
+        database_metrics.observe('primary_async', async_engine.sync_engine)
+        async_read_engines = [create_async_engine(async_url(url), **pool_options()) for url in read_urls()]
+        for i, read_engine in enumerate(async_read_engines):
+            database_metrics.observe(f'replica_{i}_async', read_engine.sync_engine)
+        AsyncReadSessions = itertools.cycle([async_sessionmaker(read_engine, autoflush=False)
+                                             for read_engine in async_read_engines] or [AsyncSessionLocal])
+    for shard_engine in engines:
+        upgrade(shard_engine)
+
+
+def read_your_writes(request: Request) -> bool:
+    """If the request should read from the primary, it asked for it or its client wrote in the last seconds"""
+    if request.headers.get(READ_PRIMARY_HEADER, '').lower() in ('true', '1'):
+        return True
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+
+
+def replica_as_of(db: Session) -> Union[float, None]:
+    """
+    The time the data of the session is known to be complete to, None on the primary. A replica can be behind it by up
+    to READ_YOUR_WRITES_SECONDS, what is read from it isn't cached under the versions of a newer change (see cache.py)
+    """
+    if not db.info.get('replica'):
+        return None
+    return time.time() - float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
 
 
-def get_db():
-    db: Session = SessionLocal()
+def remember_write(request: Request, response) -> None:
+    """Called on every response, marks the client if it wrote (used the primary). Only matters if there are replicas"""
+    if getattr(request.state, 'wrote', False) and response.status_code < 400 and read_urls():
+        response.set_cookie(LAST_WRITE_COOKIE, str(time.time()),
+                            max_age=int(float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))) + 1, httponly=True)
+
+
+def get_db(request: Request):
+    # the routes that use the primary write, the client reads from it for a while (see remember_write)
+    request.state.wrote = True
+    db: Session = session_factory(request.path_params.get('user_name'))()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db(request: Request):
+    request.state.wrote = True
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_read_db(request: Request):
+    """A session for the read only routes, on a read replica unless the request has to see its own writes"""
+    if ShardSessions:
+        db: Session = session_factory(request.path_params.get('user_name'))()
+    else:
+        read_sessions = SessionLocal if read_your_writes(request) else next(ReadSessions)
+        db: Session = read_sessions()
+        # a replica can be behind the primary, see get_user
+        db.info['replica'] = read_sessions is not SessionLocal
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_read_db(request: Request):
+    read_sessions = AsyncSessionLocal if read_your_writes(request) else next(AsyncReadSessions)
+    async with read_sessions() as db:
+        db.sync_session.info['replica'] = read_sessions is not AsyncSessionLocal
+        yield db
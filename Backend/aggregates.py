@@ -0,0 +1,349 @@
+import os
+from datetime import date
+from typing import Union, Literal, Iterable
+
+import numpy as np
+from sqlalchemy import select, delete, insert, func, extract, literal, and_, or_
+from sqlalchemy.orm import Session
+
+from Backend import ewma
+from Backend.DB import User, PhysicalActivity, SleepActivity, BloodTest, UserAggregate, CohortAggregate, \
+    MonthlyAggregate, ScoreState, dialect_insert
+from Backend.routers.utilities import AGE_RANGES, get_cohort_range
+
+"""
+The cohort averages used to be calculated by loading every row of every user in the age range into pandas, so scoring
+one user got slower the more users we had.
+Instead, every user keeps a running sum and count per metric (user_aggregates) and every age range keeps the sum of the
+per-user means (cohort_aggregates). The write routes refresh the user's part and move the difference into the cohort,
+holding the lock of the user's row so concurrent writes of the same user don't lose each other's changes.
+The user's sums are themselves the sum of his monthly rollups (monthly_aggregates), a write regroups only the months it
+touched and the monthly analyses read the rollups instead of the daily rows.
+The cohort can also be calculated from the raw rows with a GROUP BY in the database (the 'sql' source), for databases
+that are written to without going through the routes, only the aggregated rows leave the database in both cases.
+"""
+
+# domain name -> (table, metrics), the order of the metrics is the order get_avg_all returns them
+DOMAINS = {
+    'physical': (PhysicalActivity, ('steps', 'cardio_time_session_minutes', 'strength_time_session_minutes')),
+    'sleep'   : (SleepActivity, ('sleep_hours', 'avg_heart_rate', 'avg_oxygen_level')),
+    'blood'   : (BloodTest, ('RBC', 'WBC', 'glucose_level', 'cholesterol_level', 'triglycerides_level')),
+}
+
+CohortSource = Literal['aggregates', 'sql']
+# the default source of get_user_means and get_cohort_total, see configure_cohort_source
+cohort_source: CohortSource = 'aggregates'
+
+
+def configure_cohort_source() -> None:
+    global cohort_source
+    source = os.environ.get('COHORT_SOURCE', 'aggregates')
+    if source not in ('aggregates', 'sql'):
+        raise ValueError(f'COHORT_SOURCE must be aggregates or sql, not {source}')
+    cohort_source = source
+
+
+def year_month(column):
+    return (extract('year', column) * 100 + extract('month', column)).label('month')
+
+
+def _month_bounds(month: int) -> tuple[date, date]:
+    year, month = divmod(month, 100)
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+
+def _mean(total: float, count: int) -> Union[float, None]:
+    return total / count if count else None
+
+
+def _user_means(db: Session, user_id: int, domain: Union[str, None] = None) -> dict[tuple[str, str], float]:
+    select_query = (select(UserAggregate.domain, UserAggregate.metric, UserAggregate.total, UserAggregate.count)
+                    .where(UserAggregate.user_id == user_id))
+    if domain:
+        select_query = select_query.where(UserAggregate.domain == domain)
+    means = {}
+    for row in db.execute(select_query):
+        mean = _mean(row.total, row.count)
+        if mean is not None:
+            means[(row.domain, row.metric)] = mean
+    return means
+
+
+def _lock_user(db: Session, user_id: int) -> None:
+    # the aggregates of the user are read, changed in python and written back (and his rollups deleted and inserted
+    # again), so the writes of the same user wait for each other on his row. sqlite has a single writer anyway
+    db.execute(select(User.id).where(User.id == user_id).with_for_update())
+
+
+def _add_to_cohort(db: Session, age: int, changes: dict[tuple[str, str], tuple[float, int]]) -> None:
+    age_range = get_cohort_range(age)
+    if age_range is None:
+        # the user is not part of any cohort (see get_age_range)
+        return
+    values = [{'age_bucket': age_range.start, 'domain': domain, 'metric': metric, 'total': total, 'users': users}
+              for (domain, metric), (total, users) in changes.items() if total or users]
+    if not values:
+        return
+    # one statement for all the metrics, adding in the database and not in python so concurrent writers don't
+    # override each other
+    statement = dialect_insert(db, CohortAggregate).values(values)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=['age_bucket', 'domain', 'metric'],
+        set_={'total': CohortAggregate.total + statement.excluded.total,
+              'users': CohortAggregate.users + statement.excluded.users}))
+
+
+def _refresh_months(db: Session, domain: str, user_id: int,
+                    dates: Iterable[date]) -> tuple[ewma.MonthValues, ewma.MonthValues]:
+    """
+    Regroup the monthly rollups of the months of the dates from the user's daily rows
+    returns the averages of the months before and after
+    """
+    model, metrics = DOMAINS[domain]
+    months = sorted({day.year * 100 + day.month for day in dates})
+    if not months:
+        return {}, {}
+    in_rollups = and_(MonthlyAggregate.user_id == user_id,
+                      MonthlyAggregate.domain == domain,
+                      MonthlyAggregate.month.in_(months))
+    old = ewma.month_values(db.execute(select(MonthlyAggregate.month, MonthlyAggregate.metric, MonthlyAggregate.total,
+                                              MonthlyAggregate.count).where(in_rollups)))
+    db.execute(delete(MonthlyAggregate).where(in_rollups))
+    # filtering by the date ranges of the months and not by year_month so the (user_id, date) index is used
+    in_months = or_(*[and_(model.date >= start, model.date < end) for start, end in map(_month_bounds, months)])
+    month = year_month(model.date)
+    columns = [month]
+    for metric in metrics:
+        column = getattr(model, metric)
+        columns += [func.count(column), func.sum(column), func.sum(column * column)]
+    rows = db.execute(select(*columns).where(model.user_id == user_id, in_months).group_by(month)).all()
+    values = [{'user_id': user_id, 'domain': domain, 'month': row.month, 'metric': metric,
+               'count': row[1 + 3 * i], 'total': row[2 + 3 * i] or 0, 'total_squares': row[3 + 3 * i] or 0}
+              for row in rows for i, metric in enumerate(metrics)]
+    if values:
+        db.execute(insert(MonthlyAggregate), values)
+    return old, ewma.month_values((value['month'], value['metric'], value['total'], value['count']) for value in values)
+
+
+def refresh_user(db: Session, domain: str, user_id: int, age: int, dates: Iterable[date]) -> None:
+    """
+    Recalculate the aggregates of a user in a domain after the data of the dates changed, should be called before the
+    commit
+    """
+    metrics = DOMAINS[domain][1]
+    _lock_user(db, user_id)
+    db.flush()
+    old_months, new_months = _refresh_months(db, domain, user_id, dates)
+    ewma.update_state(db, user_id, domain, metrics, old_months, new_months)
+    rows = db.execute(select(MonthlyAggregate.metric, func.sum(MonthlyAggregate.total),
+                             func.sum(MonthlyAggregate.count))
+                      .where(MonthlyAggregate.user_id == user_id, MonthlyAggregate.domain == domain)
+                      .group_by(MonthlyAggregate.metric)).all()
+    sums = {row[0]: (row[1], row[2]) for row in rows}
+
+    old_means = _user_means(db, user_id, domain)
+    new_means = {}
+    if sums:
+        values = []
+        for metric in metrics:
+            total, count = sums[metric]
+            values.append({'user_id': user_id, 'domain': domain, 'metric': metric, 'total': total, 'count': count})
+            mean = _mean(total, count)
+            if mean is not None:
+                new_means[(domain, metric)] = mean
+        statement = dialect_insert(db, UserAggregate).values(values)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'domain', 'metric'],
+            set_={'total': statement.excluded.total, 'count': statement.excluded.count}))
+    else:
+        db.execute(delete(UserAggregate).where(UserAggregate.user_id == user_id, UserAggregate.domain == domain))
+
+    changes = {}
+    for key in old_means.keys() | new_means.keys():
+        changes[key] = (new_means.get(key, 0) - old_means.get(key, 0),
+                        (key in new_means) - (key in old_means))
+    _add_to_cohort(db, age, changes)
+
+
+def move_user(db: Session, user_id: int, old_age: int, new_age: int) -> None:
+    """Move the user's means to the cohort of his new age"""
+    if get_cohort_range(old_age) == get_cohort_range(new_age):
+        return
+    _lock_user(db, user_id)
+    means = _user_means(db, user_id)
+    _add_to_cohort(db, old_age, {key: (-mean, -1) for key, mean in means.items()})
+    _add_to_cohort(db, new_age, {key: (mean, 1) for key, mean in means.items()})
+
+
+def drop_user(db: Session, user_id: int, age: int) -> None:
+    """Remove the user from his cohort and delete his aggregates"""
+    _lock_user(db, user_id)
+    means = _user_means(db, user_id)
+    _add_to_cohort(db, age, {key: (-mean, -1) for key, mean in means.items()})
+    db.execute(delete(UserAggregate).where(UserAggregate.user_id == user_id))
+    db.execute(delete(MonthlyAggregate).where(MonthlyAggregate.user_id == user_id))
+    db.execute(delete(ScoreState).where(ScoreState.user_id == user_id))
+
+
+def _grouped_user_means(domain: str, age_range: range):
+    """The mean of every metric of every user in the age range, calculated from the raw rows by the database"""
+    model, metrics = DOMAINS[domain]
+    return (select(model.user_id, *[func.avg(getattr(model, metric)).label(metric) for metric in metrics])
+            .join(User, User.id == model.user_id)
+            .where(User.age >= age_range.start, User.age < age_range.stop)
+            .group_by(model.user_id))
+
+
+def get_user_means(domain: str, age_range: range, db: Session,
+                   source: Union[CohortSource, None] = None) -> tuple[np.ndarray, ...]:
+    """The mean of every metric of every user in the age range, one array per metric ordered by the user id"""
+    metrics = DOMAINS[domain][1]
+    if (source or cohort_source) == 'sql':
+        rows = db.execute(_grouped_user_means(domain, age_range).order_by('user_id')).all()
+        return tuple(np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(metrics)).T)
+
+    rows = db.execute(
+        select(UserAggregate.user_id, UserAggregate.metric, UserAggregate.total, UserAggregate.count)
+        .join(User, User.id == UserAggregate.user_id)
+        .where(UserAggregate.domain == domain, User.age.in_(age_range))
+        .order_by(UserAggregate.user_id)
+    ).all()
+    users = {user_id: i for i, user_id in enumerate(dict.fromkeys(row.user_id for row in rows))}
+    means = np.full((len(metrics), len(users)), np.nan)
+    for row in rows:
+        if row.count:
+            means[metrics.index(row.metric), users[row.user_id]] = row.total / row.count
+    return tuple(means)
+
+
+def get_cohort_total(domain: str, age_range: range, db: Session, source: Union[CohortSource, None] = None) -> float:
+    """The sum of the means of all the metrics of all the users in the age range"""
+    if (source or cohort_source) == 'sql' or age_range not in AGE_RANGES:
+        # only the ranges of get_age_range are maintained, the others are summed by the database in one statement
+        user_means = _grouped_user_means(domain, age_range).subquery()
+        metrics = DOMAINS[domain][1]
+        total = db.execute(select(sum(func.coalesce(func.sum(user_means.c[metric]), 0) for metric in metrics)))
+        return float(total.scalar_one() or 0.0)
+    total = db.execute(select(func.sum(CohortAggregate.total))
+                       .where(CohortAggregate.age_bucket == age_range.start,
+                              CohortAggregate.domain == domain)).scalar_one()
+    return total or 0.0
+
+
+def get_cohort_totals(age_range: range, db: Session, source: Union[CohortSource, None] = None) -> dict[str, float]:
+    """get_cohort_total of every domain, in one statement when the totals are maintained"""
+    if (source or cohort_source) == 'sql' or age_range not in AGE_RANGES:
+        return {domain: get_cohort_total(domain, age_range, db, source) for domain in DOMAINS}
+    totals = dict(db.execute(select(CohortAggregate.domain, func.sum(CohortAggregate.total))
+                             .where(CohortAggregate.age_bucket == age_range.start)
+                             .group_by(CohortAggregate.domain)).all())
+    return {domain: totals.get(domain) or 0.0 for domain in DOMAINS}
+
+
+def _raw_totals(db: Session, model, metrics: tuple[str, ...]) -> list:
+    columns = [model.user_id, User.age]
+    columns += [func.sum(getattr(model, metric)) for metric in metrics]
+    columns += [func.count(getattr(model, metric)) for metric in metrics]
+    return db.execute(select(*columns).join(User, User.id == model.user_id).group_by(model.user_id, User.age)).all()
+
+
+def _rollup_totals(db: Session, domain: str, metrics: tuple[str, ...]) -> list:
+    # the same rows as _raw_totals, the sums of the monthly rollups
+    rows = db.execute(select(MonthlyAggregate.user_id, User.age, MonthlyAggregate.metric,
+                             func.sum(MonthlyAggregate.total), func.sum(MonthlyAggregate.count))
+                      .join(User, User.id == MonthlyAggregate.user_id)
+                      .where(MonthlyAggregate.domain == domain)
+                      .group_by(MonthlyAggregate.user_id, User.age, MonthlyAggregate.metric)).all()
+    users: dict[tuple[int, int], dict[str, tuple]] = {}
+    for user_id, age, metric, total, count in rows:
+        users.setdefault((user_id, age), {})[metric] = (total, count)
+    return [(user_id, age, *[sums.get(metric, (0, 0))[0] for metric in metrics],
+             *[sums.get(metric, (0, 0))[1] for metric in metrics])
+            for (user_id, age), sums in users.items()]
+
+
+def rebuild_totals(db: Session, from_rollups: bool = False) -> dict[str, int]:
+    """
+    Recalculate the user and cohort aggregates from the raw data, returns the number of users of every domain.
+    from_rollups sums the monthly rollups instead, for the months whose rows are archived (see Backend/archive.py)
+    """
+    db.execute(delete(UserAggregate))
+    db.execute(delete(CohortAggregate))
+    cohorts: dict[tuple[int, str, str], list] = {}
+    rebuilt = {}
+    for domain, (model, metrics) in DOMAINS.items():
+        rows = _rollup_totals(db, domain, metrics) if from_rollups else _raw_totals(db, model, metrics)
+        values = []
+        for user_id, age, *sums in rows:
+            age_range = get_cohort_range(age)
+            for i, metric in enumerate(metrics):
+                total, count = sums[i] or 0, sums[len(metrics) + i]
+                values.append({'user_id': user_id, 'domain': domain, 'metric': metric, 'total': total,
+                               'count': count})
+                if age_range is not None and count:
+                    cohort = cohorts.setdefault((age_range.start, domain, metric), [0.0, 0])
+                    cohort[0] += total / count
+                    cohort[1] += 1
+        if values:
+            db.execute(insert(UserAggregate), values)
+        rebuilt[domain] = len(rows)
+    if cohorts:
+        db.execute(insert(CohortAggregate), [
+            {'age_bucket': age_bucket, 'domain': domain, 'metric': metric, 'total': total, 'users': users}
+            for (age_bucket, domain, metric), (total, users) in cohorts.items()])
+    return rebuilt
+
+
+def rebuild_monthly(db: Session, since: Union[date, None] = None) -> None:
+    """
+    Recalculate the monthly rollups from the raw data, grouped and inserted by the database one metric at a time.
+    The rollups of the months before since (the first day of a month) are kept
+    """
+    deleted = delete(MonthlyAggregate)
+    if since:
+        deleted = deleted.where(MonthlyAggregate.month >= since.year * 100 + since.month)
+    db.execute(deleted)
+    columns = ['user_id', 'domain', 'month', 'metric', 'count', 'total', 'total_squares']
+    for domain, (model, metrics) in DOMAINS.items():
+        month = year_month(model.date)
+        for metric in metrics:
+            column = getattr(model, metric)
+            grouped = select(
+                model.user_id, literal(domain), month, literal(metric), func.count(column),
+                func.coalesce(func.sum(column), 0), func.coalesce(func.sum(column * column), 0))
+            if since:
+                grouped = grouped.where(model.date >= since)
+            db.execute(insert(MonthlyAggregate).from_select(columns, grouped.group_by(model.user_id, month)))
+
+
+def rebuild(db: Session) -> dict[str, int]:
+    """Recalculate all the aggregates from the raw data, used for backfill or if the aggregates ever drift"""
+    from Backend import archive
+
+    # the raw rows of the archived months are gone, their rollups are kept and the totals are summed from the rollups
+    cutoff = archive.archived_until()
+    if cutoff:
+        rebuild_monthly(db, since=cutoff)
+        rebuilt = rebuild_totals(db, from_rollups=True)
+    else:
+        rebuilt = rebuild_totals(db)
+        rebuild_monthly(db)
+    ewma.rebuild_states(db, {domain: metrics for domain, (_, metrics) in DOMAINS.items()})
+    db.commit()
+    return rebuilt
+
+
+if __name__ == '__main__':
+    # the offline rebuild: python -m Backend.aggregates, with the DATABASE_URL (or DATABASE_SHARD_URLS) of the app
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    from Backend.DB import shard_urls
+
+    load_dotenv()
+    # the aggregates of a shard are of its users only, every shard is rebuilt from its own rows
+    for url in shard_urls() or [os.environ['DATABASE_URL']]:
+        engine = create_engine(url)
+        with Session(engine) as session:
+            print(f'Rebuilt the aggregates of {rebuild(session)} users of {engine.url.render_as_string()}')
+        engine.dispose()
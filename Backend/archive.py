@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+from datetime import date
+from functools import reduce
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Union, Iterable, Iterator
+from urllib.parse import quote
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import select, delete, and_, Integer
+from sqlalchemy.orm import Session
+
+from Backend.DB import User, shard_urls
+from Backend.aggregates import DOMAINS
+from Backend.async_routes import blocking
+from Backend.files import atomic_write
+from Backend.routers.utilities import FilterParams, EXPORT_BATCH_SIZE
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = pc = None
+
+"""
+The archive of the old daily rows. The rows older than the horizon are moved out of physical_activity, sleep_activity
+and blood_tests into one Arrow file per user and domain on local disk, so the hot tables (and their indexes) only hold
+the recent months the scores weight the most.
+The files are in the Arrow IPC format without compression and are memory mapped when read, the columns are used in
+place without copying or decoding them (unlike Parquet, whose pages are decoded on every read).
+The monthly rollups of the archived months stay in the database, so the scores, get_avg_monthly and the cohorts don't
+read the archive at all. The history and export routes add the archived rows of the user to the rows of the table.
+The archived months are read only, a write before the cutoff would regroup the month from the table alone. The 'sql'
+cohort source groups the raw rows and doesn't see the archived months, use the aggregates with the archive.
+
+    python -m Backend.archive --months 24
+
+pyarrow is only needed when ARCHIVE_DIR is set.
+"""
+
+# the directory of the archive (ARCHIVE_DIR), None if the rows are never archived
+archive_dir: Union[Path, None] = None
+# (the modification time of the manifest, the cutoff in it), the manifest is read again only when it changes
+_manifest_cache: tuple[float, Union[date, None]] = (0.0, None)
+
+
+def configure(directory: Union[str, Path, None]) -> None:
+    global archive_dir, _manifest_cache
+    if directory and pa is None:
+        raise ImportError('ARCHIVE_DIR needs pyarrow, pip install pyarrow')
+    archive_dir = Path(directory) if directory else None
+    _manifest_cache = (0.0, None)
+
+
+def configure_from_env() -> None:
+    configure(os.environ.get('ARCHIVE_DIR'))
+
+
+def archived_until() -> Union[date, None]:
+    """The cutoff of the archive, the rows before it are archived. None if nothing was archived"""
+    if archive_dir is None:
+        return None
+    return blocking(_read_cutoff)
+
+
+def _read_cutoff() -> Union[date, None]:
+    global _manifest_cache
+    manifest = archive_dir / 'manifest.json'
+    try:
+        modified = manifest.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    if modified != _manifest_cache[0]:
+        _manifest_cache = (modified, date.fromisoformat(json.loads(manifest.read_text())['cutoff']))
+    return _manifest_cache[1]
+
+
+def _set_cutoff(cutoff: date) -> None:
+    def write(path: str):
+        Path(path).write_text(json.dumps({'cutoff': cutoff.isoformat()}))
+
+    atomic_write(archive_dir / 'manifest.json', write)
+
+
+def _path(domain: str, user_name: str) -> Path:
+    return archive_dir / domain / f'{quote(user_name, safe="")}.arrow'
+
+
+def _schema(domain: str) -> 'pa.Schema':
+    model, metrics = DOMAINS[domain]
+    return pa.schema([('date', pa.date32())] +
+                     [(metric, pa.int64() if isinstance(getattr(model, metric).type, Integer) else pa.float64())
+                      for metric in metrics])
+
+
+def read(domain: str, user_name: str) -> Union['pa.Table', None]:
+    """The archived rows of the user ordered by the date, memory mapped. None if he has none"""
+    if archive_dir is None:
+        return None
+    return blocking(_read, _path(domain, user_name))
+
+
+def _read(path: Path) -> Union['pa.Table', None]:
+    if not path.exists():
+        return None
+    # the table keeps the map open, a file replaced by the job stays mapped until the table is released
+    return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+
+
+def history(domain: str, user_name: str, query: FilterParams, rows: list) -> list:
+    """
+    The rows of a history GET with the archived rows of the user that match the query, ordered by the date.
+    The rows of the table win over archived rows of the same date (a run of the job that was interrupted)
+    """
+    table = read(domain, user_name)
+    if table is None:
+        return rows
+    dates = table.column('date')
+    conditions = []
+    if query.filter_by_date:
+        conditions.append(pc.is_in(dates, value_set=pa.array(query.filter_by_date, pa.date32())))
+    if query.from_date:
+        conditions.append(pc.greater_equal(dates, pa.scalar(query.from_date, pa.date32())))
+    if query.to_date:
+        conditions.append(pc.less_equal(dates, pa.scalar(query.to_date, pa.date32())))
+    if query.cursor and not query.filter_last:
+        conditions.append(pc.greater(dates, pa.scalar(query.cursor, pa.date32())))
+    archived = table.filter(reduce(pc.and_, conditions)) if conditions else table
+    if not archived.num_rows:
+        return rows
+    if query.filter_last:
+        return rows or [SimpleNamespace(**archived.slice(archived.num_rows - 1).to_pylist()[0])]
+    hot_dates = {row.date for row in rows}
+    merged = [SimpleNamespace(**row) for row in archived.to_pylist() if row['date'] not in hot_dates] + list(rows)
+    merged.sort(key=lambda row: row.date)
+    return merged[:query.limit + 1] if query.limit else merged
+
+
+def export_batches(domain: str, user_name: str, columns: list[str]) -> Iterator[list[dict]]:
+    """The archived rows of the user in batches of stream_export"""
+    table = read(domain, user_name)
+    if table is None:
+        return
+    for batch in table.select(columns).to_batches(max_chunksize=EXPORT_BATCH_SIZE):
+        yield batch.to_pylist()
+
+
+def check_writable(dates: Iterable[date]) -> None:
+    """The routes can't change archived days, 400 if one of the dates is before the cutoff"""
+    cutoff = archived_until()
+    if cutoff and any(day < cutoff for day in dates):
+        raise HTTPException(status_code=400, detail=f'The data before {cutoff} is archived and can not be changed')
+
+
+def mark_archived(valid: dict[int, BaseModel], results: dict[int, dict], date_field: str) -> None:
+    """The items of a bulk request before the cutoff are not created (see check_writable)"""
+    cutoff = archived_until()
+    if not cutoff:
+        return
+    for i, item in list(valid.items()):
+        if getattr(item, date_field) < cutoff:
+            results[i] = {'index': i, 'date': getattr(item, date_field), 'status': 'archived'}
+            del valid[i]
+
+
+def archived_dates(domain: str, user_name: str) -> list[date]:
+    table = read(domain, user_name)
+    return table.column('date').to_pylist() if table is not None else []
+
+
+def drop(domain: str, user_name: str) -> None:
+    """Delete the archived rows of the user in the domain, after the deletion of his rows was committed"""
+    if archive_dir is not None:
+        blocking(_path(domain, user_name).unlink, missing_ok=True)
+
+
+def drop_user(user_name: str) -> None:
+    for domain in DOMAINS:
+        drop(domain, user_name)
+
+
+def _write(domain: str, user_name: str, rows: list[dict]) -> None:
+    """Add the rows to the archive of the user"""
+    model, metrics = DOMAINS[domain]
+    existing = read(domain, user_name)
+    by_date = {row['date']: row for row in existing.to_pylist()} if existing is not None else {}
+    by_date.update((row['date'], row) for row in rows)
+    table = pa.Table.from_pylist([by_date[day] for day in sorted(by_date)], schema=_schema(domain))
+
+    def write(path: str):
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    atomic_write(_path(domain, user_name), write)
+
+
+def archive(db: Session, cutoff: date) -> dict[str, int]:
+    """Move the rows before the cutoff to the archive, returns the number of archived rows of every domain"""
+    # the routes stop writing before the cutoff first, so the rows that are moved can't change anymore
+    if (archived_until() or date.min) < cutoff:
+        _set_cutoff(cutoff)
+    archived = {}
+    for domain, (model, metrics) in DOMAINS.items():
+        archived[domain] = 0
+        users = db.execute(select(User.id, User.user_name)
+                           .where(User.id.in_(select(model.user_id).where(model.date < cutoff)))).all()
+        for user_id, user_name in users:
+            in_archive = and_(model.user_id == user_id, model.date < cutoff)
+            rows = db.execute(select(model.date, *[getattr(model, metric) for metric in metrics])
+                              .where(in_archive)).mappings().all()
+            # the file is written before the rows are deleted, an interrupted run leaves the rows in both
+            _write(domain, user_name, [dict(row) for row in rows])
+            db.execute(delete(model).where(in_archive))
+            db.commit()
+            archived[domain] += len(rows)
+    return archived
+
+
+def horizon_cutoff(months: int, today: Union[date, None] = None) -> date:
+    """The first day of the month that is the given number of months before this one"""
+    today = today or date.today()
+    month = today.year * 12 + today.month - 1 - months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def main():
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    parser = argparse.ArgumentParser(description='Move the daily rows older than the horizon into the archive')
+    parser.add_argument('--months', type=int, default=int(os.environ.get('ARCHIVE_HORIZON_MONTHS', 24)),
+                        help='the number of months (besides this one) that stay in the tables')
+    args = parser.parse_args()
+    load_dotenv()
+    configure_from_env()
+    if archive_dir is None:
+        parser.error('ARCHIVE_DIR is not set')
+    cutoff = horizon_cutoff(args.months)
+    # a user_name is on one shard only, so the files of the shards don't overlap
+    for url in shard_urls() or [os.environ['DATABASE_URL']]:
+        with Session(create_engine(url)) as db:
+            print(f'Archived the rows before {cutoff}: {archive(db, cutoff)}')
+
+
+if __name__ == '__main__':
+    main()
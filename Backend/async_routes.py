@@ -0,0 +1,76 @@
+import inspect
+from functools import wraps
+
+from fastapi import APIRouter, Depends
+from fastapi.routing import APIRoute
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.util.concurrency import await_, in_greenlet
+from starlette.concurrency import run_in_threadpool
+
+from Backend.DB import get_db, get_read_db, get_async_db, get_async_read_db
+
+"""
+The async mode (DATABASE_ASYNC=true): the routes that work with the database run on the event loop with an async session
+instead of a thread of the threadpool each. The handlers aren't written twice, asyncify makes an async version of every
+handler of a router that runs the same code with AsyncSession.run_sync, where the database calls wait in the event loop.
+The routes that do heavy work in python (scoring whole cohorts with NumPy, streaming exports, rebuilds) would block the
+event loop, they are marked with sync_only and stay sync handlers that FastAPI runs in the threadpool with the sync
+engine.
+The handlers that read files (the archive, the cohort snapshot) call them with blocking, which moves the call to the
+threadpool while the handler runs on the event loop.
+"""
+
+
+def sync_only(endpoint):
+    """Keep the route a sync handler in the async mode"""
+    endpoint.sync_only = True
+    return endpoint
+
+
+def blocking(function, *args, **kwargs):
+    """
+    Call a function that waits for the disk. In a handler of the async mode (inside AsyncSession.run_sync) it runs in
+    the threadpool and the event loop serves the other requests until it returns, elsewhere it is just called
+    """
+    if in_greenlet():
+        return await_(run_in_threadpool(function, *args, **kwargs))
+    return function(*args, **kwargs)
+
+
+# the dependency of the async session that replaces the sync one
+ASYNC_DEPENDENCIES = {get_db: get_async_db, get_read_db: get_async_read_db}
+
+
+def _async_endpoint(endpoint):
+    signature = inspect.signature(endpoint)
+    parameters = [parameter.replace(annotation=AsyncSession,
+                                    default=Depends(ASYNC_DEPENDENCIES[parameter.default.dependency]))
+                  if parameter.name == 'db' else parameter
+                  for parameter in signature.parameters.values()]
+
+    @wraps(endpoint)
+    async def async_endpoint(**kwargs):
+        db: AsyncSession = kwargs.pop('db')
+        return await db.run_sync(lambda session: endpoint(**kwargs, db=session))
+
+    # FastAPI reads the dependencies from the signature, db is the only one that changes
+    async_endpoint.__signature__ = signature.replace(parameters=parameters)
+    return async_endpoint
+
+
+def asyncify(router: APIRouter) -> APIRouter:
+    """A copy of the router where the handlers with a db parameter are async, except the sync_only ones"""
+    async_router = APIRouter()
+    for route in router.routes:
+        endpoint = getattr(route, 'endpoint', None)
+        if (not isinstance(route, APIRoute) or getattr(endpoint, 'sync_only', False)
+                or 'db' not in inspect.signature(endpoint).parameters):
+            async_router.routes.append(route)
+            continue
+        # the routes of a router already have its prefix, tags and responses
+        async_router.add_api_route(route.path, _async_endpoint(endpoint), methods=list(route.methods),
+                                   name=route.name, tags=route.tags, responses=route.responses,
+                                   status_code=route.status_code, summary=route.summary,
+                                   description=route.description, response_model=route.response_model,
+                                   response_class=route.response_class, include_in_schema=route.include_in_schema)
+    return async_router
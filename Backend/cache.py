@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Union, NamedTuple
+
+import numpy as np
+
+from Backend.routers.utilities import get_age_range, get_cohort_range
+
+"""
+The health score only changes when the user's data or the data of his cohort changes, so it is cached until then.
+Every write bumps the version of the user and of the cohort he belongs to, a cached score is valid only while both
+versions are the same as when it was calculated (and the entry is not older than the TTL).
+The entries are per process, the versions are shared by the workers in a mapped file if CACHE_VERSIONS_PATH is set, so
+a write in one worker invalidates the entries of all of them. Without it every worker only sees its own writes and
+serves the scores of the writes of the others for up to SCORE_CACHE_TTL, which should be short with several workers.
+A version is the time of the last change, the data of a read replica or of the cohort snapshot can be older than the
+versions taken before reading it, see ScoreCache.put.
+"""
+
+# the slots of the shared versions, 8 bytes each (the file is sparse until the slots are written)
+VERSION_SLOTS = 1 << 20
+
+
+class Versions:
+    """The versions of the keys of this process, the time in nanoseconds of their last change (0 if it never changed)"""
+
+    def __init__(self):
+        self._versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> int:
+        return self._versions.get(key, 0)
+
+    def bump(self, key: str) -> None:
+        with self._lock:
+            self._versions[key] = max(self._versions.get(key, 0) + 1, time.time_ns())
+
+    def bump_all(self) -> None:
+        now = time.time_ns()
+        with self._lock:
+            for key, version in self._versions.items():
+                self._versions[key] = max(version + 1, now)
+
+
+class SharedVersions(Versions):
+    """
+    The versions in a file that every worker maps, the keys are hashed into its slots (two keys of the same slot only
+    invalidate each other's entries). A bump writes a new time, so two workers that bump the same slot at once both
+    change it from the version the entries have and no file lock is needed
+    """
+
+    def __init__(self, path: str, slots: int = VERSION_SLOTS):
+        super().__init__()
+        with open(path, 'ab') as file:
+            if os.fstat(file.fileno()).st_size < slots * 8:
+                os.ftruncate(file.fileno(), slots * 8)
+        self._slots = np.memmap(path, dtype=np.int64, mode='r+', shape=(slots,))
+
+    def _slot(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % len(self._slots)
+
+    def get(self, key: str) -> int:
+        return int(self._slots[self._slot(key)])
+
+    def bump(self, key: str) -> None:
+        slot = self._slot(key)
+        with self._lock:
+            self._slots[slot] = max(int(self._slots[slot]) + 1, time.time_ns())
+
+    def bump_all(self) -> None:
+        # the other workers keep their entries, every slot changes so none of them is valid anymore
+        with self._lock:
+            np.maximum(self._slots + 1, time.time_ns(), out=self._slots)
+
+
+def _changed_after(version: int, as_of: Union[float, None]) -> bool:
+    # as_of is the time (time.time()) the data is known to be complete to, None if it is the latest
+    return as_of is not None and version > as_of * 1e9
+
+
+class ScoreCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 300, versions: Union[Versions, None] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # user_name -> (user version, age range start, cohort version, score, expiration time)
+        self._entries: OrderedDict[str, tuple[int, int, int, float, float]] = OrderedDict()
+        self.versions_store = versions or Versions()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size: int, ttl: float, versions: Union[Versions, None] = None) -> None:
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            if versions is not None:
+                # the entries have the versions of the old store
+                self.versions_store = versions
+                self._entries.clear()
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def versions(self, user_name: str, age: int) -> tuple[int, int, int]:
+        """The versions a score calculated now depends on, should be taken before reading the data"""
+        age_range = get_age_range(age)
+        return (self.versions_store.get(f'user:{user_name}'), age_range.start,
+                self.versions_store.get(f'cohort:{age_range.start}'))
+
+    def get(self, user_name: str) -> Union[float, None]:
+        with self._lock:
+            entry = self._entries.get(user_name)
+            if (entry is None
+                    or entry[0] != self.versions_store.get(f'user:{user_name}')
+                    or entry[2] != self.versions_store.get(f'cohort:{entry[1]}')
+                    or entry[4] < time.monotonic()):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_name)
+            self.hits += 1
+            return entry[3]
+
+    def put(self, user_name: str, versions: tuple[int, int, int], score: float,
+            as_of: Union[float, None] = None) -> None:
+        """
+        versions are of before the data was read, as_of is the time the data is known to be complete to (a replica or
+        the cohort snapshot can be behind, see scoring.score_as_of). A score of data that may miss a change of the
+        versions isn't cached, it would be valid under the new versions
+        """
+        if self.max_size <= 0 or _changed_after(max(versions[0], versions[2]), as_of):
+            return
+        with self._lock:
+            self._entries[user_name] = (*versions, score, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_name)
+            self._evict()
+
+    def bump_version(self, user_name: str, *ages: int) -> None:
+        """Called after the data of a user changed, ages are the ages the user had before and after the change"""
+        self.versions_store.bump(f'user:{user_name}')
+        for age in ages:
+            # the user's data is part of the cohort of get_cohort_range, which is not always get_age_range
+            age_range = get_cohort_range(age)
+            if age_range is not None:
+                self.versions_store.bump(f'cohort:{age_range.start}')
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'max_size': self.max_size,
+                'ttl': self.ttl}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.versions_store.bump_all()
+            self.hits = self.misses = 0
+
+
+class CachedUser(NamedTuple):
+    id: int
+    user_name: str
+    name: str
+    age: int
+
+
+# returned by UserCache.get when the user_name is not in the cache, None means the user is known not to exist
+NOT_CACHED = object()
+
+
+class UserCache:
+    """
+    user_name -> (id, name, age), also remembering the user_names that don't exist (so creating a user doesn't need to
+    query for duplicates). The routes that change a user bump his generation, an entry is valid only while the
+    generation is the one it was read under. Without shared versions (see the module) the other workers can be behind
+    by up to the TTL, which is why it is short.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 60, versions: Union[Versions, None] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # user_name -> (generation, user or None, expiration time)
+        self._entries: OrderedDict[str, tuple[int, Union[CachedUser, None], float]] = OrderedDict()
+        # bumped on every invalidation, so a lookup that raced with a change doesn't put the old row back
+        self.versions_store = versions or Versions()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size: int, ttl: float, versions: Union[Versions, None] = None) -> None:
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            if versions is not None:
+                self.versions_store = versions
+                self._entries.clear()
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def generation(self, user_name: str) -> int:
+        """Should be taken before reading the user from the database and passed to put"""
+        return self.versions_store.get(f'user_row:{user_name}')
+
+    def get(self, user_name: str) -> Union[CachedUser, None, object]:
+        with self._lock:
+            entry = self._entries.get(user_name)
+            if entry is None or entry[0] != self.generation(user_name) or entry[2] < time.monotonic():
+                self.misses += 1
+                return NOT_CACHED
+            self._entries.move_to_end(user_name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_name: str, generation: int, user: Union[CachedUser, None],
+            as_of: Union[float, None] = None) -> None:
+        """as_of is the time the row is known to be current to, see ScoreCache.put"""
+        if self.max_size <= 0 or _changed_after(generation, as_of):
+            return
+        with self._lock:
+            if generation != self.generation(user_name):
+                return
+            self._entries[user_name] = (generation, user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_name)
+            self._evict()
+
+    def invalidate(self, user_name: str) -> None:
+        """Called after a user was created, updated or deleted"""
+        with self._lock:
+            self._entries.pop(user_name, None)
+            self.versions_store.bump(f'user_row:{user_name}')
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'max_size': self.max_size,
+                'ttl': self.ttl}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.versions_store.bump_all()
+            self.hits = self.misses = 0
+
+
+score_cache = ScoreCache()
+user_cache = UserCache()
+
+
+def configure_from_env() -> None:
+    path = os.environ.get('CACHE_VERSIONS_PATH') or None
+    versions = SharedVersions(path) if path else Versions()
+    score_cache.configure(int(os.environ.get('SCORE_CACHE_SIZE', 1024)),
+                          float(os.environ.get('SCORE_CACHE_TTL', 300)), versions)
+    user_cache.configure(int(os.environ.get('USER_CACHE_SIZE', 4096)),
+                         float(os.environ.get('USER_CACHE_TTL', 60)), versions)
@@ -0,0 +1,208 @@
+import logging
+import os
+import threading
+import time
+from typing import Union
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from Backend import DB, aggregates, shards
+from Backend.async_routes import blocking
+from Backend.files import atomic_write
+from Backend.DB import CohortAggregate
+from Backend.aggregates import DOMAINS
+from Backend.routers.utilities import AGE_RANGES
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (windows), every worker refreshes the snapshot
+    fcntl = None
+
+"""
+A snapshot of the cohort aggregates in a file (COHORT_SNAPSHOT_PATH) that the workers map instead of every one of them
+reading the cohort totals from the database for every score. It is a NumPy array of (total, users) with a row per age
+bucket (AGE_RANGES) and a column per metric (METRICS), the workers map it read only and sum the columns of a domain in
+place, the file is never copied into their memory and the page cache holds it once for all of them.
+One worker refreshes it every COHORT_SNAPSHOT_SECONDS (the one that gets the lock file), it writes a new file and
+renames it over the old one, so a worker maps either the old or the new snapshot. A worker sees a new file by its inode.
+The baselines can be behind the database by the refresh interval, the cohort of a user moves slowly. The modification
+time of the file is the time the snapshot was read from the database (built_at), the score cache doesn't keep a score of
+a snapshot that is older than the last change of the cohort. Without a snapshot (not configured or not written yet) the
+totals are read from the database as before, and so they are when the snapshot is older than COHORT_SNAPSHOT_MAX_AGE
+(3 refresh intervals by default, its refresher is failing or gone).
+"""
+
+# the columns of the snapshot, every metric of every domain in the order of DOMAINS
+METRICS: tuple[tuple[str, str], ...] = tuple((domain, metric) for domain, (_, metrics) in DOMAINS.items()
+                                             for metric in metrics)
+SNAPSHOT_DTYPE = np.dtype([('total', np.float64), ('users', np.int64)])
+_COLUMNS = {key: i for i, key in enumerate(METRICS)}
+_DOMAIN_COLUMNS = {domain: slice(METRICS.index((domain, metrics[0])), METRICS.index((domain, metrics[-1])) + 1)
+                   for domain, (_, metrics) in DOMAINS.items()}
+_ROWS = {age_range.start: i for i, age_range in enumerate(AGE_RANGES)}
+
+logger = logging.getLogger(__name__)
+
+snapshot_path: Union[str, None] = None
+# seconds, an older snapshot isn't used (None for no limit)
+max_age: Union[float, None] = None
+# ((inode, modification time) of the mapped file, the mapped array)
+_mapped: tuple[tuple[int, int], Union[np.ndarray, None]] = ((0, 0), None)
+_refresher: Union[threading.Thread, None] = None
+_stop = threading.Event()
+_lock_file = None
+
+
+def build(db: Session) -> np.ndarray:
+    """The snapshot of the cohort aggregates, the sums of all the shards"""
+    snapshot = np.zeros((len(AGE_RANGES), len(METRICS)), dtype=SNAPSHOT_DTYPE)
+
+    def fetch(session: Session) -> list:
+        return session.execute(select(CohortAggregate.age_bucket, CohortAggregate.domain, CohortAggregate.metric,
+                                      CohortAggregate.total, CohortAggregate.users)).all()
+
+    for rows in shards.scatter(db, fetch):
+        for age_bucket, domain, metric, total, users in rows:
+            if age_bucket in _ROWS and (domain, metric) in _COLUMNS:
+                snapshot['total'][_ROWS[age_bucket], _COLUMNS[domain, metric]] += total
+                snapshot['users'][_ROWS[age_bucket], _COLUMNS[domain, metric]] += users
+    return snapshot
+
+
+def write(snapshot: np.ndarray, path: str, built_at: Union[float, None] = None) -> None:
+    """built_at is the time the snapshot was read from the database, the time of the write if not given"""
+    def save(temporary: str):
+        # np.save adds .npy to a path that doesn't end with it, so the file is given as a file
+        with open(temporary, 'wb') as file:
+            np.save(file, snapshot)
+        if built_at is not None:
+            os.utime(temporary, (built_at, built_at))
+
+    atomic_write(path, save)
+
+
+def refresh() -> None:
+    """Write a new snapshot from the database"""
+    # the writes after the start of the build may be missing from it
+    started = time.time()
+    with DB.SessionLocal() as db:
+        write(build(db), snapshot_path, started)
+
+
+def load() -> Union[np.ndarray, None]:
+    """The mapped snapshot, mapped again when the file was replaced. None if there is no snapshot"""
+    global _mapped
+    try:
+        stat = os.stat(snapshot_path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns)
+    if key != _mapped[0]:
+        snapshot = np.load(snapshot_path, mmap_mode='r')
+        # a file of another layout (written before the metrics or the age ranges changed) is ignored
+        if snapshot.dtype != SNAPSHOT_DTYPE or snapshot.shape != (len(AGE_RANGES), len(METRICS)):
+            snapshot = None
+        _mapped = (key, snapshot)
+    return _mapped[1]
+
+
+def _fresh() -> Union[np.ndarray, None]:
+    """The mapped snapshot, None if there is none or it is older than max_age"""
+    snapshot = load()
+    if snapshot is not None and max_age is not None and time.time() - _mapped[0][1] / 1e9 > max_age:
+        return None
+    return snapshot
+
+
+def built_at() -> Union[float, None]:
+    """
+    The time the mapped snapshot was read from the database, None if there is no snapshot to use. Taken before
+    cohort_totals, the snapshot it reads is never older
+    """
+    if snapshot_path is None or blocking(_fresh) is None:
+        return None
+    return _mapped[0][1] / 1e9
+
+
+def cohort_totals(age_range: range) -> Union[dict[str, float], None]:
+    """The same as aggregates.get_cohort_totals from the snapshot, None if the snapshot can't be used"""
+    if snapshot_path is None or age_range not in AGE_RANGES:
+        return None
+    snapshot = blocking(_fresh)
+    if snapshot is None:
+        return None
+    totals = snapshot['total'][_ROWS[age_range.start]]
+    return {domain: float(totals[columns].sum()) for domain, columns in _DOMAIN_COLUMNS.items()}
+
+
+def _refresh_every(seconds: float) -> None:
+    while not _stop.is_set():
+        try:
+            refresh()
+        except Exception:
+            # the workers keep the last snapshot until it is too old, the next round tries again
+            logger.exception('Refreshing the cohort snapshot failed')
+        _stop.wait(seconds)
+
+
+def _take_refresher_lock(path: str) -> bool:
+    global _lock_file
+    if fcntl is None:
+        return True
+    lock_file = open(f'{path}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    # held until stop or the end of the process, the other workers only read the snapshot
+    _lock_file = lock_file
+    return True
+
+
+def stop() -> None:
+    global _refresher, _lock_file
+    _stop.set()
+    if _refresher is not None:
+        _refresher.join()
+        _refresher = None
+    if _lock_file is not None:
+        _lock_file.close()
+        _lock_file = None
+    _stop.clear()
+
+
+def configure(path: Union[str, None], seconds: float = 10, oldest: Union[float, None] = None) -> None:
+    """
+    Read the cohort totals from the snapshot at path, refreshed every seconds by one process (0 never refreshes).
+    A snapshot older than oldest seconds isn't used, 3 refresh intervals if not given (no limit if it never refreshes)
+    """
+    global snapshot_path, max_age, _mapped, _refresher
+    stop()
+    snapshot_path = path
+    max_age = oldest if oldest is not None else 3 * seconds if seconds > 0 else None
+    _mapped = ((0, 0), None)
+    if path and seconds > 0 and _take_refresher_lock(path):
+        _refresher = threading.Thread(target=_refresh_every, args=(seconds,), name='cohort-snapshot', daemon=True)
+        _refresher.start()
+
+
+def configure_from_env() -> None:
+    path = os.environ.get('COHORT_SNAPSHOT_PATH') or None
+    if path and aggregates.cohort_source == 'sql':
+        raise ValueError('COHORT_SNAPSHOT_PATH needs COHORT_SOURCE=aggregates, it is a snapshot of the aggregates')
+    oldest = os.environ.get('COHORT_SNAPSHOT_MAX_AGE')
+    configure(path, float(os.environ.get('COHORT_SNAPSHOT_SECONDS', 10)), float(oldest) if oldest else None)
+
+
+if __name__ == '__main__':
+    # a refresh from outside the app (cron), with COHORT_SNAPSHOT_SECONDS=0 for the workers
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    DB.init_db()
+    snapshot_path = os.environ['COHORT_SNAPSHOT_PATH']
+    refresh()
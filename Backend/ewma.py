@@ -0,0 +1,133 @@
+from bisect import bisect_right
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+from sqlalchemy.orm import Session
+
+from Backend.DB import MonthlyAggregate, ScoreState
+
+"""
+The health score weights the monthly averages of a user exponentially, the i-th of his n months gets the weight base^i.
+Instead of recalculating the whole series on every score, every user keeps per metric the weighted sum and the sum of
+the weights (score_states), scaled so the last month has the weight 1 (base^(i - n + 1), which can't overflow no matter
+how long the history is). A write updates the state in O(1):
+- a month after the last one divides everything by the base and adds the month with the weight 1
+- a change in an existing month adds the difference with the weight of the month
+- a month added before the last one or removed changes the weights of all the months before it, so the state is
+  recalculated from the monthly rollups (backfills and deletes, which are rare)
+"""
+
+BASE = 2
+
+# month -> metric -> the average of the month, NaN if the month has no values of the metric
+MonthValues = dict[int, dict[str, float]]
+
+
+def _weights(months: int, base=BASE) -> np.ndarray:
+    # base^i divided by the largest weight, the average is the same and the weights are at most 1
+    return np.power(float(base), np.arange(months) - (months - 1))
+
+
+def month_values(rows) -> MonthValues:
+    """The averages of (month, metric, total, count) rows of monthly_aggregates"""
+    values: MonthValues = {}
+    for month, metric, total, count in rows:
+        values.setdefault(month, {})[metric] = total / count if count else np.nan
+    return values
+
+
+def _rollups(user_id: int, domain: str):
+    return (select(MonthlyAggregate.month, MonthlyAggregate.metric, MonthlyAggregate.total, MonthlyAggregate.count)
+            .where(MonthlyAggregate.user_id == user_id, MonthlyAggregate.domain == domain))
+
+
+def _states(user_id: int, domain: str, metrics: tuple[str, ...], months: MonthValues) -> list[dict]:
+    """The states of the series of months"""
+    last_month = max(months)
+    series = [months[month] for month in sorted(months)]
+    weights = _weights(len(series))
+    states = []
+    for metric in metrics:
+        values = np.array([month.get(metric, np.nan) for month in series])
+        present = ~np.isnan(values)
+        states.append({'user_id': user_id, 'domain': domain, 'metric': metric,
+                       'weighted_total': float(np.sum(values[present] * weights[present])),
+                       'weights': float(np.sum(weights)), 'months': len(series), 'missing': int(np.sum(~present)),
+                       'last_month': last_month})
+    return states
+
+
+def recalculate(db: Session, user_id: int, domain: str, metrics: tuple[str, ...]) -> None:
+    """Recalculate the state of the user in a domain from his monthly rollups"""
+    db.execute(delete(ScoreState).where(ScoreState.user_id == user_id, ScoreState.domain == domain))
+    months = month_values(db.execute(_rollups(user_id, domain)))
+    if months:
+        db.execute(insert(ScoreState), _states(user_id, domain, metrics, months))
+
+
+def update_state(db: Session, user_id: int, domain: str, metrics: tuple[str, ...],
+                 old: MonthValues, new: MonthValues) -> None:
+    """
+    Apply a write to the user's state, old and new are the averages of the months the write touched before and after it,
+    should be called after the monthly rollups were updated
+    """
+    states = {state.metric: state for state in db.execute(
+        select(ScoreState)
+        .where(ScoreState.user_id == user_id, ScoreState.domain == domain)
+        .execution_options(populate_existing=True)).scalars()}
+    last_month = next(iter(states.values())).last_month if states else None
+    appended = sorted(month for month in new if month not in old)
+    if (old.keys() - new.keys()
+            or (old and len(states) != len(metrics))
+            or (appended and last_month is not None and appended[0] <= last_month)):
+        recalculate(db, user_id, domain, metrics)
+        return
+
+    changed = sorted(new.keys() & old.keys())
+    # the months of the user from the first changed one on, read once for all the changed months
+    months = db.execute(select(MonthlyAggregate.month).distinct()
+                        .where(MonthlyAggregate.user_id == user_id, MonthlyAggregate.domain == domain,
+                               MonthlyAggregate.month >= changed[0])
+                        .order_by(MonthlyAggregate.month)).scalars().all() if changed else []
+    for month in changed:
+        # the weight of a month is base^-(the number of months after it)
+        months_after = len(months) - bisect_right(months, month)
+        weight = float(BASE) ** -(months_after - len(appended))
+        for metric, state in states.items():
+            old_value, new_value = old[month].get(metric, np.nan), new[month].get(metric, np.nan)
+            state.missing += int(np.isnan(new_value)) - int(np.isnan(old_value))
+            state.weighted_total += weight * (np.nan_to_num(new_value) - np.nan_to_num(old_value))
+
+    for month in appended:
+        for metric in metrics:
+            state = states.get(metric)
+            if state is None:
+                state = states[metric] = ScoreState(user_id=user_id, domain=domain, metric=metric,
+                                                    weighted_total=0.0, weights=0.0, months=0, missing=0)
+                db.add(state)
+            value = new[month].get(metric, np.nan)
+            state.weighted_total = state.weighted_total / BASE + float(np.nan_to_num(value))
+            state.weights = state.weights / BASE + 1
+            state.months += 1
+            state.missing += int(np.isnan(value))
+            state.last_month = month
+
+
+def weighted_average(state: ScoreState) -> float:
+    """The exponential weighted average of the monthly averages of the state, NaN if a month has no values"""
+    return state.weighted_total / state.weights if not state.missing else np.nan
+
+
+def rebuild_states(db: Session, domains: dict[str, tuple[str, ...]]) -> None:
+    """Recalculate the states of all the users from the monthly rollups, domains is domain -> metrics"""
+    db.execute(delete(ScoreState))
+    rows = db.execute(select(MonthlyAggregate.user_id, MonthlyAggregate.domain, MonthlyAggregate.month,
+                             MonthlyAggregate.metric, MonthlyAggregate.total, MonthlyAggregate.count))
+    series: dict[tuple[int, str], list] = {}
+    for user_id, domain, *rollup in rows:
+        series.setdefault((user_id, domain), []).append(rollup)
+    values = []
+    for (user_id, domain), user_rows in series.items():
+        values += _states(user_id, domain, domains[domain], month_values(user_rows))
+    if values:
+        db.execute(insert(ScoreState), values)
@@ -0,0 +1,26 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Union
+
+"""
+The files that other processes read while they are replaced (the archive, the cohort snapshot).
+"""
+
+
+def atomic_write(path: Union[str, Path], write: Callable[[str], None]) -> None:
+    """
+    Write the file with write(the path of a temporary file) and rename it over the path. The temporary file is next to
+    the path (a rename is atomic on the same filesystem), so a reader opens either the old or the new file and a reader
+    that mapped the old file keeps it until it maps the new one
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    os.close(descriptor)
+    try:
+        write(temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
@@ -1,92 +1,141 @@
+import time
 from contextlib import asynccontextmanager
+from typing import Union
 
 import numpy as np
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Request
+from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
 
-from Backend.DB import get_db, init_db
-from Backend.routers import user, physical, blood, sleep
+from Backend import archive, cohort_snapshot, parallel, profiler, shards
+from Backend.DB import get_read_db, init_db, async_mode, remember_write
+from Backend.async_routes import asyncify, sync_only
+from Backend.aggregates import configure_cohort_source
+from Backend.cache import score_cache, configure_from_env
+from Backend.metrics import RequestStats, request_stats, http_metrics
+from Backend.profiler import QueryProfile, current_profile
+from Backend.scoring import NO_COHORT_DATA, score_users, get_users, score_cohort, percentile_rank, \
+    user_weighted_averages, score_as_of
+from Backend.routers import user, physical, blood, sleep, admin, metrics, debug
+from Backend.routers.utilities import get_age_range
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # set up the database
-    load_dotenv()
     init_db()
+    configure_from_env()
+    configure_cohort_source()
+    parallel.configure_from_env()
+    archive.configure_from_env()
+    cohort_snapshot.configure_from_env()
+    profiler.configure_from_env()
     yield
+    cohort_snapshot.stop()
 
 
+# loaded before the app is created since the routes depend on the mode (DATABASE_ASYNC)
+load_dotenv()
 app = FastAPI(lifespan=lifespan)
 
+
+@app.middleware('http')
+async def record_metrics(request: Request, call_next):
+    # the queries of the request are counted into its stats by the cursor events (see Backend/metrics.py)
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the template of the route and not the path, so the users don't become labels
+        route = getattr(request.scope.get('route'), 'path', 'unmatched')
+        http_metrics.observe(request.method, route, time.perf_counter() - start, status, stats)
+        request_stats.reset(token)
+
+
+@app.middleware('http')
+async def profile_queries(request: Request, call_next):
+    if not profiler.enabled(request):
+        return await call_next(request)
+    profile = QueryProfile(request.method, request.url.path)
+    token = current_profile.set(profile)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_profile.reset(token)
+    # the queries of a streamed response run after the headers are sent and aren't in its profile
+    response.headers.update(profiler.headers(profiler.record(profile, response.status_code,
+                                                             time.perf_counter() - start)))
+    return response
+
+
+@app.middleware('http')
+async def read_your_writes(request: Request, call_next):
+    response = await call_next(request)
+    remember_write(request, response)
+    return response
+
+
+def include(router: APIRouter) -> None:
+    app.include_router(asyncify(router) if async_mode() else router)
+
+
 """
 The routes are organized into separate routers for each data type (user, physical, blood, sleep). This separation helps
 to keep the codebase organized and maintainable, especially as the application grows in complexity.
 Like the Databases the routes are similar in structure and implementation, but again there is no real reason for that. 
 That's is why there is no Unifying super class for the routes.
 """
-app.include_router(user.router)
-app.include_router(physical.router)
-app.include_router(blood.router)
-app.include_router(sleep.router)
-
-def get_age_range(age: int) -> range:
-    if age < 0:
-        raise ValueError("Age cannot be negative")
-    elif age <= 1:
-        return range(0, 1)  # 0-1 baby
-    elif age <= 3:
-        return range(1, 4)  # 1-3 toddler
-    elif age <= 12:
-        return range(4, 13)  # 4-12 child
-    elif age <= 19:
-        return range(13, 20)  # 13-19 teen
-    elif age <= 25:
-        return range(20, 25)  # 20-25 young adult
-    elif age <= 35:
-        return range(25, 36)  # 25-35
-    elif age <= 45:
-        return range(36, 50)  # 36-45
-    elif age <= 65:
-        return range(51, 66)  # 51-65
-    elif age <= 75:
-        return range(66, 76)  # 66-75
-    else:
-        return range(76, 120)  # Arbitrary upper limit for seniors
-
-
-def exponential_weighted_average(series: np.ndarray, base=2):
-    # Generate exponential weights
-    weights = np.arange(len(series))
-    base = np.full_like(weights, base)
-    np.power(base, weights, out=weights)
-
-    # Calculate the weighted average
-    weighted_avg = np.sum(series * weights) / np.sum(weights)
-
-    return weighted_avg
-
-
-@app.get('/get_health_score/{user_name}')
-def get_health_score(user_name: str, db: Session = Depends(get_db)):
+include(user.router)
+include(physical.router)
+include(blood.router)
+include(sleep.router)
+include(admin.router)
+include(metrics.router)
+include(debug.router)
+
+# the health score routes, included at the end of the module
+scores = APIRouter(tags=['health score'])
+
+
+@scores.get('/get_health_score/{user_name}')
+def get_health_score(user_name: str, db: Session = Depends(get_read_db)):
     """
     Get the health score of a user based on their physical, sleep and blood data.
     The health score itself is kind of nonsense, but it's a simple way to combine the three data types into one value,
     While giving more weight to more recent data.
+    The score is cached until the data of the user or of his cohort changes, a cache hit doesn't touch the database.
     """
+    cached_score = score_cache.get(user_name)
+    if cached_score is not None:
+        return {'health_score': cached_score}
+
     user_data = user.get_user(user_name, db)
     age_range = get_age_range(user_data.age)
+    # taking the versions before reading the data, so a write that happens in the middle invalidates this score
+    versions = score_cache.versions(user_name, user_data.age)
+    as_of = score_as_of(db)
+    # the cohort totals of all the workers are in a shared snapshot if configured (see Backend/cohort_snapshot.py)
+    cohort_totals = cohort_snapshot.cohort_totals(age_range)
     try:
-        physical_by_month = physical.get_avg_monthly(user_name, db)
-        sleep_by_month = sleep.get_avg_monthly(user_name, db)
-        blood_by_month = blood.get_avg_monthly(user_name, db)
+        # the weighted averages of the monthly averages, so more recent data has more weight.
+        # they are updated on every write (see Backend/ewma.py), so this doesn't read the history of the user.
+        # the cohort totals don't depend on them, both are read at the same time if enabled (see Backend/parallel.py)
+        if cohort_totals is None:
+            averages, cohort_totals = parallel.fetch_all(db,
+                                                         lambda session: user_weighted_averages(user_data.id, session),
+                                                         lambda session: shards.cohort_totals(age_range, session))
+        else:
+            averages = user_weighted_averages(user_data.id, db)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
-
-    # getting weighted average of the physical, sleep and blood data so more recent data has more weight
-    physicals = [exponential_weighted_average(activity) for activity in physical_by_month]
-    sleeps = [exponential_weighted_average(data) for data in sleep_by_month]
-    bloods = [exponential_weighted_average(count) for count in blood_by_month]
+    physicals, sleeps, bloods = averages['physical'], averages['sleep'], averages['blood']
 
     # summing the weighted averages and calculating the health score based on the average of the three
     physical_score = sum(physicals)
@@ -94,23 +143,85 @@ def get_health_score(user_name: str, db: Session = Depends(get_db)):
     blood_score = sum(bloods)
     calculated_score = (physical_score + sleep_score + blood_score) / 3
 
-    # getting the average of all users in the same age range to compare the user's health score to the average
-    all_avg_physical = physical.get_avg_all(age_range, db)
-    all_avg_sleep = sleep.get_avg_all(age_range, db)
-    all_avg_blood = blood.get_avg_all(age_range, db)
-
-    # summing the averages of all users in the same age range and calculating the health score based on the average
+    # getting the sum of the averages of all users in the same age range to compare the user's health score to it.
+    # The sums are maintained on every write (Backend/aggregates.py) so this is a few rows and not the whole cohort
     # No need for weighted average here as we are comparing the user to the average of all users in the same age range
-    physical_score_all = sum(all_avg_physical)
-    sleep_score_all = sum(all_avg_sleep)
-    blood_score_all = sum(all_avg_blood)
-    calculated_score_all = (physical_score_all.sum() + sleep_score_all.sum() + blood_score_all.sum()) / 3
+    physical_score_all = np.float64(cohort_totals['physical'])
+    sleep_score_all = np.float64(cohort_totals['sleep'])
+    blood_score_all = np.float64(cohort_totals['blood'])
+    calculated_score_all = (physical_score_all + sleep_score_all + blood_score_all) / 3
+    if not calculated_score_all:
+        raise HTTPException(status_code=404, detail=NO_COHORT_DATA)
 
     final_score:float = 100 * (calculated_score / calculated_score_all)
+    score_cache.put(user_name, versions, float(final_score), as_of)
 
     return {'health_score': final_score}
 
 
+class HealthScoreBatch(BaseModel):
+    user_names: list[str] = Field(title='The users to score', min_length=1, max_length=1000)
+
+
+@scores.post('/get_health_score/batch')
+@sync_only
+def get_health_score_batch(batch: HealthScoreBatch, db: Session = Depends(get_read_db)):
+    """
+    Get the health score of many users in one request, the scores are the same as get_health_score's.
+    The data of all the users is loaded with one query per domain and scored together (see Backend/scoring.py)
+    """
+    scores = {}
+    for user_name in dict.fromkeys(batch.user_names):
+        cached_score = score_cache.get(user_name)
+        if cached_score is not None:
+            scores[user_name] = cached_score
+
+    user_names = [user_name for user_name in batch.user_names if user_name not in scores]
+    errors = {user_name: 'User not found' for user_name in user_names}
+
+    def score_shard(session: Session) -> tuple[dict, Union[float, None], dict]:
+        # every shard finds and scores its own users
+        users = get_users(user_names, session)
+        versions = {db_user.user_name: score_cache.versions(db_user.user_name, db_user.age) for db_user in users}
+        as_of = score_as_of(session)
+        return versions, as_of, score_users(users, session) if users else {}
+
+    for versions, as_of, shard_scores in shards.scatter(db, score_shard):
+        for user_name, score in shard_scores.items():
+            del errors[user_name]
+            if isinstance(score, str):
+                errors[user_name] = score
+            else:
+                scores[user_name] = score
+                score_cache.put(user_name, versions[user_name], score, as_of)
+    return {'health_scores': scores, 'errors': errors}
+
+
+@scores.get('/get_health_score/{user_name}/percentile')
+@sync_only
+def get_health_score_percentile(user_name: str, db: Session = Depends(get_read_db)):
+    """
+    Get the percentile of the user's health score within his cohort (the users of the same age range).
+    The whole cohort is scored in one pass (see Backend/scoring.py), the users that can't be scored are not ranked
+    """
+    user_data = user.get_user(user_name, db)
+    scores = shards.merge(shards.scatter(db, lambda session: score_cohort(get_age_range(user_data.age), session)))
+    if user_name not in scores:
+        # the age ranges have gaps (25 is in range(20, 25)), so the user isn't always part of his own range
+        scores[user_name] = score_users([user_data], db)[user_name]
+    score = scores[user_name]
+    if isinstance(score, str):
+        raise HTTPException(status_code=404, detail=score)
+
+    cohort_scores = np.array([cohort_score for cohort_score in scores.values() if not isinstance(cohort_score, str)])
+    return {'health_score': score,
+            'percentile'  : percentile_rank(score, cohort_scores),
+            'cohort_size' : len(cohort_scores)}
+
+
+include(scores)
+
+
 @app.get("/")
 def root():
     return {"message": "Health Tracker API Root"}
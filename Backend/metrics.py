@@ -0,0 +1,281 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Union
+
+from sqlalchemy import event, exc, Engine
+from sqlalchemy.pool import QueuePool
+
+"""
+Metrics of the connection pools, to size the pool against the number of workers: how many connections are checked out,
+how many are in overflow and how long the requests wait for a connection.
+The counters are updated by the events of the pool, the latency of a checkout is measured around Engine.raw_connection
+(there is no event before a checkout). The numbers are of this process only, every worker has its own pools.
+The latency of every route and the number and time of the queries of its requests are recorded by a middleware, the
+queries are counted by the cursor events of every engine into the stats of the request that runs them. All of them are
+served in the text format of Prometheus on /metrics.
+"""
+
+# seconds, the upper bounds of the buckets of the histograms (there is always another one for everything above)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# the number of queries of a request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Counts of observations in buckets by their upper bound, cumulative like the histograms of Prometheus"""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """(upper bound, the number of observations up to it), the last bound is +Inf"""
+        with self._lock:
+            counts = list(self._counts)
+        total = 0
+        result = []
+        for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self) -> dict:
+        return {'buckets': dict(self.cumulative()), 'count': self.count, 'sum': self.sum}
+
+
+class PoolMetrics:
+    """The metrics of the pool of one engine"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        # the checkouts that didn't find an idle connection, they opened a new one or waited for one to be returned
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.checkout_latency = Histogram()
+        self.connect_latency = Histogram()
+        self._connect_starts = threading.local()
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observe(self, engine: Engine) -> None:
+        event.listen(engine, 'checkout', lambda *args: self._count('checkouts'))
+        event.listen(engine, 'checkin', lambda *args: self._count('checkins'))
+        event.listen(engine, 'invalidate', lambda *args: self._count('invalidations'))
+        event.listen(engine, 'do_connect', self._before_connect)
+        event.listen(engine, 'connect', self._after_connect)
+
+        # the checkouts are timed around Engine.raw_connection and not Pool.connect, dispose() replaces the pool of the
+        # engine (the pool events follow it to the new pool)
+        raw_connection = engine.raw_connection
+
+        def timed_raw_connection():
+            pool = engine.pool
+            idle = pool.checkedin() if isinstance(pool, QueuePool) else 1
+            start = time.perf_counter()
+            try:
+                return raw_connection()
+            except exc.TimeoutError:
+                self._count('timeouts')
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self.checkout_latency.observe(elapsed)
+                if not idle:
+                    with self._lock:
+                        self.waits += 1
+                        self.wait_seconds += elapsed
+
+        engine.raw_connection = timed_raw_connection
+
+    def _before_connect(self, dialect, conn_rec, cargs, cparams):
+        self._connect_starts.start = time.perf_counter()
+
+    def _after_connect(self, dbapi_connection, connection_record):
+        self._count('connects')
+        start = getattr(self._connect_starts, 'start', None)
+        if start is not None:
+            self.connect_latency.observe(time.perf_counter() - start)
+            self._connect_starts.start = None
+
+    def snapshot(self, pool) -> dict:
+        stats = {'pool': type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            stats.update({'size': pool.size(), 'checked_out': pool.checkedout(), 'checked_in': pool.checkedin(),
+                          'overflow': max(pool.overflow(), 0), 'timeout': pool.timeout()})
+        stats.update({'checkouts': self.checkouts, 'checkins': self.checkins, 'connects': self.connects,
+                      'invalidations': self.invalidations, 'timeouts': self.timeouts,
+                      'waits': self.waits, 'wait_seconds': self.wait_seconds,
+                      'checkout_latency_seconds': self.checkout_latency.snapshot(),
+                      'connect_latency_seconds': self.connect_latency.snapshot()})
+        return stats
+
+
+class DatabaseMetrics:
+    """The pool metrics of the engines of the app by their name"""
+
+    def __init__(self):
+        self._engines: dict[str, tuple[Engine, PoolMetrics]] = {}
+
+    def observe(self, name: str, engine: Engine) -> PoolMetrics:
+        metrics = PoolMetrics()
+        metrics.observe(engine)
+        self._engines[name] = (engine, metrics)
+        return metrics
+
+    def engines(self) -> dict[str, tuple[Engine, PoolMetrics]]:
+        return dict(self._engines)
+
+    def snapshot(self) -> dict:
+        return {name: metrics.snapshot(engine.pool) for name, (engine, metrics) in self._engines.items()}
+
+    def clear(self) -> None:
+        self._engines.clear()
+
+
+database_metrics = DatabaseMetrics()
+
+
+class RequestStats:
+    """The queries of one request, the statements of the threads it starts (see parallel.fetch_all) are added too"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_query(self, seconds: float) -> None:
+        with self._lock:
+            self.queries += 1
+            self.db_seconds += seconds
+
+
+# the stats of the request that runs in this context, None outside of a request
+request_stats: ContextVar[Union[RequestStats, None]] = ContextVar('request_stats', default=None)
+
+
+# the start is kept on the execution context of the statement, a statement that fails leaves nothing behind
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'query_start', None)
+    stats = request_stats.get()
+    if stats is not None and start is not None:
+        stats.add_query(time.perf_counter() - start)
+
+
+class RouteMetrics:
+    """The latency, the responses by status and the queries of the requests of one route"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_seconds = Histogram()
+        self.statuses: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, status: int, stats: RequestStats) -> None:
+        self.latency.observe(seconds)
+        self.queries.observe(stats.queries)
+        self.db_seconds.observe(stats.db_seconds)
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class HttpMetrics:
+    """The metrics of the routes by (method, path template), the requests that match no route are counted together"""
+
+    def __init__(self):
+        self._routes: dict[tuple[str, str], RouteMetrics] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method: str, route: str, seconds: float, status: int, stats: RequestStats) -> None:
+        with self._lock:
+            metrics = self._routes.get((method, route))
+            if metrics is None:
+                metrics = self._routes[method, route] = RouteMetrics()
+        metrics.observe(seconds, status, stats)
+
+    def routes(self) -> dict[tuple[str, str], RouteMetrics]:
+        with self._lock:
+            return dict(self._routes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._routes.clear()
+
+
+http_metrics = HttpMetrics()
+
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+def _histogram_lines(name: str, histogram: Histogram, **labels) -> list[str]:
+    lines = [f'{name}_bucket{_labels(**labels, le=bound)} {count}' for bound, count in histogram.cumulative()]
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.count}')
+    return lines
+
+
+def _family(lines: list[str], name: str, kind: str, description: str, samples: list[str]) -> None:
+    if samples:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}', *samples]
+
+
+def prometheus_text() -> str:
+    """The metrics of the routes and of the connection pools in the text format of Prometheus"""
+    lines = []
+    routes = sorted(http_metrics.routes().items())
+    _family(lines, 'http_requests_total', 'counter', 'The responses by route and status', [
+        f'http_requests_total{_labels(method=method, route=route, status=status)} {count}'
+        for (method, route), metrics in routes for status, count in sorted(metrics.statuses.items())])
+    for name, attribute, description in (
+            ('http_request_duration_seconds', 'latency', 'The latency of the requests until the response starts'),
+            ('http_request_db_queries', 'queries', 'The number of database queries of a request'),
+            ('http_request_db_seconds', 'db_seconds', 'The time a request spent in database queries')):
+        _family(lines, name, 'histogram', description, [
+            line for (method, route), metrics in routes
+            for line in _histogram_lines(name, getattr(metrics, attribute), method=method, route=route)])
+
+    pools = database_metrics.snapshot()
+    for name, key, kind, description in (
+            ('db_pool_checkouts_total', 'checkouts', 'counter', 'The connections checked out of the pool'),
+            ('db_pool_connects_total', 'connects', 'counter', 'The connections opened by the pool'),
+            ('db_pool_timeouts_total', 'timeouts', 'counter', 'The checkouts that timed out'),
+            ('db_pool_waits_total', 'waits', 'counter', 'The checkouts that found no idle connection'),
+            ('db_pool_checked_out', 'checked_out', 'gauge', 'The connections checked out right now'),
+            ('db_pool_overflow', 'overflow', 'gauge', 'The connections above the size of the pool')):
+        _family(lines, name, kind, description, [f'{name}{_labels(engine=engine)} {stats[key]}'
+                                                 for engine, stats in pools.items() if key in stats])
+    _family(lines, 'db_pool_checkout_seconds', 'histogram', 'The latency of the checkouts', [
+        line for engine, (_, metrics) in sorted(database_metrics.engines().items())
+        for line in _histogram_lines('db_pool_checkout_seconds', metrics.checkout_latency, engine=engine)])
+    return '\n'.join(lines) + '\n'
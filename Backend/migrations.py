@@ -0,0 +1,313 @@
+from contextlib import contextmanager
+from typing import Callable, Iterator, Union
+
+from sqlalchemy import Engine, Connection, Table, Column, Integer, String, Float, Date, DateTime, ForeignKey, Index, \
+    MetaData, select, delete, insert, func, literal, extract, case
+
+"""
+Versioned schema migrations, applied by init_db on startup.
+The applied versions are saved in the schema_version table, every migration runs once and in order inside the same
+transaction as its version row, so a failed migration can be fixed and rerun.
+A migration only uses the copy of the tables below as they were when it was written, never the models or the code of
+the app: those keep changing, and an applied migration must still do the same thing on the databases it reaches later.
+To change the schema add the change to the models and a new migration to MIGRATIONS with the tables it needs, never
+edit an applied one.
+The workers that start together apply the migrations one at a time, see _migration_lock.
+"""
+
+# the key of the advisory lock of the migrations on postgres, any number the app doesn't use for another lock
+MIGRATION_LOCK_KEY = 180_005
+# how long a worker waits for the lock of an sqlite database while another worker migrates it
+SQLITE_LOCK_TIMEOUT_MS = 10 * 60 * 1000
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+)
+
+frozen = MetaData()
+
+# the baseline of migration 1, the tables of the app when the migrations were added
+users = Table(
+    'users', frozen,
+    Column('id', Integer, primary_key=True, index=True),
+    Column('user_name', String, unique=True, nullable=False),
+    Column('name', String, nullable=False),
+    Column('age', Integer, nullable=False, index=True),
+)
+physical_activity = Table(
+    'physical_activity', frozen,
+    Column('id', Integer, primary_key=True, index=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    Column('steps', Integer, nullable=False),
+    Column('cardio_time_session_minutes', Integer, nullable=True),
+    Column('strength_time_session_minutes', Integer, nullable=True),
+    Column('date', Date),
+    Index('ix_physical_activity_user_id_date', 'user_id', 'date', unique=True),
+)
+sleep_activity = Table(
+    'sleep_activity', frozen,
+    Column('id', Integer, primary_key=True, index=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    Column('sleep_hours', Float, nullable=False),
+    Column('avg_heart_rate', Float, nullable=False),
+    Column('avg_oxygen_level', Float, nullable=False),
+    Column('date', Date, nullable=False),
+    Index('ix_sleep_activity_user_id_date', 'user_id', 'date', unique=True),
+)
+blood_tests = Table(
+    'blood_tests', frozen,
+    Column('id', Integer, primary_key=True, index=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    Column('RBC', Float, nullable=False),
+    Column('WBC', Float, nullable=False),
+    Column('glucose_level', Float, nullable=False),
+    Column('cholesterol_level', Float, nullable=False),
+    Column('triglycerides_level', Float, nullable=False),
+    Column('date', Date),
+    Index('ix_blood_tests_user_id_date', 'user_id', 'date', unique=True),
+)
+user_aggregates = Table(
+    'user_aggregates', frozen,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('domain', String, primary_key=True),
+    Column('metric', String, primary_key=True),
+    Column('total', Float, nullable=False),
+    Column('count', Integer, nullable=False),
+)
+cohort_aggregates = Table(
+    'cohort_aggregates', frozen,
+    Column('age_bucket', Integer, primary_key=True),
+    Column('domain', String, primary_key=True),
+    Column('metric', String, primary_key=True),
+    Column('total', Float, nullable=False),
+    Column('users', Integer, nullable=False),
+)
+BASELINE = (users, physical_activity, sleep_activity, blood_tests, user_aggregates, cohort_aggregates)
+
+# migration 4
+monthly_aggregates = Table(
+    'monthly_aggregates', frozen,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('domain', String, primary_key=True),
+    Column('month', Integer, primary_key=True),
+    Column('metric', String, primary_key=True),
+    Column('count', Integer, nullable=False),
+    Column('total', Float, nullable=False),
+    Column('total_squares', Float, nullable=False),
+)
+
+# migration 5
+score_states = Table(
+    'score_states', frozen,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('domain', String, primary_key=True),
+    Column('metric', String, primary_key=True),
+    Column('weighted_total', Float, nullable=False),
+    Column('weights', Float, nullable=False),
+    Column('months', Integer, nullable=False),
+    Column('missing', Integer, nullable=False),
+    Column('last_month', Integer, nullable=False),
+)
+
+# migration 6
+score_runs = Table(
+    'score_runs', frozen,
+    Column('id', Integer, primary_key=True),
+    Column('started_at', DateTime, nullable=False),
+    Column('finished_at', DateTime, nullable=True),
+)
+score_run_partitions = Table(
+    'score_run_partitions', frozen,
+    Column('run_id', Integer, ForeignKey('score_runs.id', ondelete='CASCADE'), primary_key=True),
+    Column('age_bucket', Integer, primary_key=True),
+    Column('users', Integer, nullable=False),
+    Column('finished_at', DateTime, nullable=False),
+)
+health_scores = Table(
+    'health_scores', frozen,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('run_id', Integer, ForeignKey('score_runs.id'), nullable=False),
+    Column('score', Float, nullable=True),
+    Column('error', String, nullable=True),
+)
+
+# migration 7, the table of migration 6 is replaced
+score_run_chunks = Table(
+    'score_run_partitions', MetaData(),
+    Column('run_id', Integer, ForeignKey(score_runs.c.id, ondelete='CASCADE'), primary_key=True),
+    Column('age_bucket', Integer, primary_key=True),
+    Column('first_user_id', Integer, primary_key=True),
+    Column('last_user_id', Integer, nullable=False),
+    Column('users', Integer, nullable=False),
+    Column('finished_at', DateTime, nullable=False),
+)
+
+# domain -> (table, metrics) of the backfills
+DOMAINS = {
+    'physical': (physical_activity, ('steps', 'cardio_time_session_minutes', 'strength_time_session_minutes')),
+    'sleep'   : (sleep_activity, ('sleep_hours', 'avg_heart_rate', 'avg_oxygen_level')),
+    'blood'   : (blood_tests, ('RBC', 'WBC', 'glucose_level', 'cholesterol_level', 'triglycerides_level')),
+}
+# (start, stop) of the age ranges of the cohorts when the cohort aggregates were backfilled
+AGE_RANGES = ((0, 1), (1, 4), (4, 13), (13, 20), (20, 25), (25, 36), (36, 50), (51, 66), (66, 76), (76, 120))
+# the weight of a month is EWMA_BASE times the weight of the month before it
+EWMA_BASE = 2
+
+
+def create_tables(connection: Connection) -> None:
+    # creates only the missing tables, so it is also the baseline for databases created before the migrations
+    frozen.create_all(connection, tables=BASELINE)
+
+
+def add_user_date_indexes(connection: Connection) -> None:
+    """
+    The old UniqueConstraint('id', 'date') enforced nothing (the id is unique anyway) and the queries had no index.
+    The routes rejected duplicate days, so duplicates can only come from races, the first row of a day is kept
+    """
+    for table in (physical_activity, sleep_activity, blood_tests):
+        first_rows = select(func.min(table.c.id)).group_by(table.c.user_id, table.c.date)
+        connection.execute(delete(table).where(table.c.id.not_in(first_rows)))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    for index in users.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def backfill_aggregates(connection: Connection) -> None:
+    connection.execute(delete(user_aggregates))
+    connection.execute(delete(cohort_aggregates))
+    for domain, (table, metrics) in DOMAINS.items():
+        for metric in metrics:
+            column = table.c[metric]
+            connection.execute(insert(user_aggregates).from_select(
+                ['user_id', 'domain', 'metric', 'total', 'count'],
+                select(table.c.user_id, literal(domain), literal(metric), func.coalesce(func.sum(column), 0),
+                       func.count(column))
+                .join(users, users.c.id == table.c.user_id)
+                .group_by(table.c.user_id)))
+    # the sum of the per-user means, a user is counted in the first age range that contains his age
+    age_bucket = case(*[(users.c.age.between(start, stop - 1), start) for start, stop in AGE_RANGES])
+    connection.execute(insert(cohort_aggregates).from_select(
+        ['age_bucket', 'domain', 'metric', 'total', 'users'],
+        select(age_bucket, user_aggregates.c.domain, user_aggregates.c.metric,
+               func.sum(user_aggregates.c.total / user_aggregates.c.count), func.count())
+        .join(users, users.c.id == user_aggregates.c.user_id)
+        .where(user_aggregates.c.count > 0, age_bucket.is_not(None))
+        .group_by(age_bucket, user_aggregates.c.domain, user_aggregates.c.metric)))
+
+
+def add_monthly_aggregates(connection: Connection) -> None:
+    monthly_aggregates.create(connection, checkfirst=True)
+    connection.execute(delete(monthly_aggregates))
+    columns = ['user_id', 'domain', 'month', 'metric', 'count', 'total', 'total_squares']
+    for domain, (table, metrics) in DOMAINS.items():
+        month = extract('year', table.c.date) * 100 + extract('month', table.c.date)
+        for metric in metrics:
+            column = table.c[metric]
+            connection.execute(insert(monthly_aggregates).from_select(columns, select(
+                table.c.user_id, literal(domain), month, literal(metric), func.count(column),
+                func.coalesce(func.sum(column), 0), func.coalesce(func.sum(column * column), 0))
+                .group_by(table.c.user_id, month)))
+
+
+def add_score_states(connection: Connection) -> None:
+    score_states.create(connection, checkfirst=True)
+    connection.execute(delete(score_states))
+    # (user, domain) -> month -> metric -> the average of the month, None without values
+    series: dict[tuple[int, str], dict[int, dict[str, Union[float, None]]]] = {}
+    for user_id, domain, month, metric, total, count in connection.execute(select(
+            monthly_aggregates.c.user_id, monthly_aggregates.c.domain, monthly_aggregates.c.month,
+            monthly_aggregates.c.metric, monthly_aggregates.c.total, monthly_aggregates.c.count)):
+        series.setdefault((user_id, domain), {}).setdefault(month, {})[metric] = total / count if count else None
+    values = []
+    for (user_id, domain), months in series.items():
+        # the last month has the weight 1
+        weights = [float(EWMA_BASE) ** (i - len(months) + 1) for i in range(len(months))]
+        for metric in DOMAINS[domain][1]:
+            averages = [months[month].get(metric) for month in sorted(months)]
+            values.append({'user_id': user_id, 'domain': domain, 'metric': metric,
+                           'weighted_total': sum(weight * average for weight, average in zip(weights, averages)
+                                                 if average is not None),
+                           'weights': sum(weights), 'months': len(months), 'missing': averages.count(None),
+                           'last_month': max(months)})
+    if values:
+        connection.execute(insert(score_states), values)
+
+
+def add_health_scores(connection: Connection) -> None:
+    for table in (score_runs, score_run_partitions, health_scores):
+        table.create(connection, checkfirst=True)
+
+
+def chunk_score_run_partitions(connection: Connection) -> None:
+    """
+    The partitions of the recompute job are chunks of the users of an age bucket. The partitions the unfinished runs
+    saved are dropped with the old table, resuming such a run scores all its users again
+    """
+    score_run_partitions.drop(connection, checkfirst=True)
+    score_run_chunks.create(connection)
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, 'create tables', create_tables),
+    (2, 'unique (user_id, date) indexes and users.age index', add_user_date_indexes),
+    (3, 'backfill the cohort aggregates', backfill_aggregates),
+    (4, 'monthly rollups of every user', add_monthly_aggregates),
+    (5, 'the exponential weighted averages of every user', add_score_states),
+    (6, 'the health scores of the recompute job', add_health_scores),
+    (7, 'chunks of users in the partitions of the recompute job', chunk_score_run_partitions),
+]
+
+
+def current_version(connection: Connection) -> int:
+    schema_version.create(connection, checkfirst=True)
+    return connection.execute(select(func.max(schema_version.c.version))).scalar_one() or 0
+
+
+@contextmanager
+def _migration_lock(engine: Engine) -> Iterator[Connection]:
+    """
+    A connection that holds the lock of the migrations, so the workers that start together don't apply the same
+    migration at the same time (and fail on the tables the other one created or on the version it inserted).
+    On postgres it's an advisory lock of the session, on sqlite the write lock of the database taken by BEGIN IMMEDIATE,
+    which the commit of the migration releases
+    """
+    with engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(select(func.pg_advisory_lock(MIGRATION_LOCK_KEY)))
+            connection.commit()
+            try:
+                yield connection
+            finally:
+                connection.rollback()
+                connection.execute(select(func.pg_advisory_unlock(MIGRATION_LOCK_KEY)))
+                connection.commit()
+        elif connection.dialect.name == 'sqlite':
+            timeout = connection.exec_driver_sql('PRAGMA busy_timeout').scalar_one()
+            connection.exec_driver_sql(f'PRAGMA busy_timeout = {SQLITE_LOCK_TIMEOUT_MS}')
+            try:
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+                yield connection
+            finally:
+                connection.rollback()
+                connection.exec_driver_sql(f'PRAGMA busy_timeout = {timeout}')
+        else:
+            yield connection
+
+
+def upgrade(engine: Engine) -> int:
+    """Apply the missing migrations and return the version of the schema"""
+    while True:
+        with _migration_lock(engine) as connection:
+            # read under the lock, another worker may have applied the next migration while this one waited for it
+            version = current_version(connection)
+            missing = [migration for migration in MIGRATIONS if migration[0] > version]
+            if not missing:
+                connection.commit()
+                return version
+            migration_version, description, migration = missing[0]
+            migration(connection)
+            connection.execute(insert(schema_version).values(version=migration_version, description=description))
+            connection.commit()
@@ -0,0 +1,49 @@
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from Backend.DB import MonthlyAggregate
+from Backend.aggregates import DOMAINS
+
+"""
+The monthly averages of a user, read from his monthly rollups (monthly_aggregates, maintained by refresh_user) so only
+one row per month and metric is read instead of the whole history of the user.
+The months are year-months (202310), so the same month of different years isn't merged.
+"""
+
+# the errors when a user has no data in a domain
+MISSING_DATA = {
+    'physical': 'No physical data found for this user',
+    'sleep'   : 'No sleep activity found for this user',
+    'blood'   : 'No blood tests found for this user',
+}
+
+
+def monthly_query(user_id, domain=None):
+    """The rollups of the user ordered by the month, user_id can be an id or a subquery (see user_id_of)"""
+    select_query = (select(MonthlyAggregate.domain, MonthlyAggregate.month, MonthlyAggregate.metric,
+                           MonthlyAggregate.total, MonthlyAggregate.count)
+                    .where(MonthlyAggregate.user_id == user_id)
+                    .order_by(MonthlyAggregate.month))
+    if domain:
+        select_query = select_query.where(MonthlyAggregate.domain == domain)
+    return select_query
+
+
+def _averages(domain: str, rows: list) -> tuple[np.ndarray, ...]:
+    """One array per metric with the average of every month, NaN for a month without values of the metric"""
+    metrics = DOMAINS[domain][1]
+    months = {month: i for i, month in enumerate(dict.fromkeys(row.month for row in rows))}
+    if not months:
+        raise ValueError(MISSING_DATA[domain])
+    averages = np.full((len(metrics), len(months)), np.nan)
+    for row in rows:
+        if row.count:
+            averages[metrics.index(row.metric), months[row.month]] = row.total / row.count
+    return tuple(averages)
+
+
+def get_monthly_averages(domain: str, user_id, db: Session) -> tuple[np.ndarray, ...]:
+    """One array per metric with the averages of the months the user has data in, ordered by the month"""
+    return _averages(domain, db.execute(monthly_query(user_id, domain)).all())
+
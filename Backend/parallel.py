@@ -0,0 +1,46 @@
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any, Union
+
+from sqlalchemy.orm import Session
+
+"""
+Running the independent reads of a request at the same time, so its latency is the slowest read and not their sum.
+A session can't be used by two threads, so every read gets its own session on the engine of the request's session, which
+also means the reads don't see the uncommitted changes of the request (only read only routes should use it).
+Off by default (PARALLEL_FETCH_THREADS=0), it helps when the database is remote and the reads wait on the network,
+SQLite in memory has one connection and gains nothing.
+"""
+
+_executor: Union[ThreadPoolExecutor, None] = None
+
+
+def configure(threads: int) -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='fetch') if threads > 0 else None
+
+
+def configure_from_env() -> None:
+    configure(int(os.environ.get('PARALLEL_FETCH_THREADS', 0)))
+
+
+def fetch_all(db: Session, *fetches: Callable[[Session], Any]) -> list:
+    """The results of the fetches, concurrently when enabled. An exception of a fetch is raised after all of them end"""
+    # the sessions of the async mode are bound to the event loop and can't be used by other threads
+    if _executor is None or len(fetches) < 2 or db.get_bind().dialect.is_async:
+        return [fetch(db) for fetch in fetches]
+
+    bind = db.get_bind()
+
+    def run(fetch: Callable[[Session], Any]):
+        with Session(bind=bind) as session:
+            return fetch(session)
+
+    # in the context of the request, so the queries are counted in its metrics
+    futures = [_executor.submit(contextvars.copy_context().run, run, fetch) for fetch in fetches]
+    for future in futures:
+        future.exception()
+    return [future.result() for future in futures]
@@ -0,0 +1,122 @@
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Union
+
+from sqlalchemy import event, Engine
+from starlette.requests import Request
+
+"""
+A profiler of the queries of a request, to find the handlers that run many small queries. Every statement is recorded
+with its duration, the rows it returned or changed and the line of the app that ran it, the statements that ran more
+than once in the same request are reported as repeated (usually a query in a loop, the N+1 pattern).
+It is off unless the request has the header X-Profile-Queries: true or QUERY_PROFILER=true profiles every request.
+A profiled response has the X-Query-* headers of its summary and the profile is kept in a ring buffer of the last
+requests (/debug/last-requests). Only the statements are kept, never their parameters.
+"""
+
+PROFILE_HEADER = 'X-Profile-Queries'
+# a statement that runs this many times in a request is reported as repeated
+REPEATED_THRESHOLD = 2
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+_ROOT_DIR = os.path.dirname(_BACKEND_DIR)
+
+profile_all = False
+last_requests: deque = deque(maxlen=50)
+_ids = itertools.count(1)
+
+
+class QueryProfile:
+    """The statements of one request"""
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.queries: list[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, statement: str, seconds: float, rows: Union[int, None], call_site: Union[str, None]) -> None:
+        with self._lock:
+            self.queries.append({'statement': statement, 'seconds': seconds, 'rows': rows, 'call_site': call_site})
+
+    def repeated(self) -> list[dict]:
+        """The statements that ran at least REPEATED_THRESHOLD times, the most repeated first"""
+        groups: dict[str, list[dict]] = {}
+        for query in self.queries:
+            groups.setdefault(query['statement'], []).append(query)
+        return sorted(({'statement': statement, 'count': len(queries),
+                        'seconds': sum(query['seconds'] for query in queries),
+                        'call_sites': sorted({query['call_site'] for query in queries if query['call_site']})}
+                       for statement, queries in groups.items() if len(queries) >= REPEATED_THRESHOLD),
+                      key=lambda group: -group['count'])
+
+    def summary(self, status: int, seconds: float) -> dict:
+        return {'id': next(_ids), 'method': self.method, 'path': self.path, 'status': status, 'seconds': seconds,
+                'query_count': len(self.queries), 'query_seconds': sum(query['seconds'] for query in self.queries),
+                'repeated': self.repeated(), 'queries': self.queries}
+
+
+# the profile of the request that runs in this context, None if it isn't profiled
+current_profile: ContextVar[Union[QueryProfile, None]] = ContextVar('current_profile', default=None)
+
+
+def _call_site() -> Union[str, None]:
+    # the innermost frame of the app, outside of this module
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_BACKEND_DIR) and filename != __file__:
+            return f'{os.path.relpath(filename, _ROOT_DIR)}:{frame.f_lineno} {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None and context is not None:
+        context.profile_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    start = getattr(context, 'profile_start', None)
+    if profile is None or start is None:
+        return
+    # the DBAPI reports -1 when it doesn't know (the SELECTs of sqlite)
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    profile.add(statement, time.perf_counter() - start, rows, _call_site())
+
+
+def enabled(request: Request) -> bool:
+    return profile_all or request.headers.get(PROFILE_HEADER, '').lower() in ('true', '1')
+
+
+def record(profile: QueryProfile, status: int, seconds: float) -> dict:
+    """Keep the profile in the ring buffer, returns its summary"""
+    summary = profile.summary(status, seconds)
+    last_requests.append(summary)
+    return summary
+
+
+def headers(summary: dict) -> dict[str, str]:
+    return {'X-Query-Profile-Id': str(summary['id']),
+            'X-Query-Count'     : str(summary['query_count']),
+            'X-Query-Time-Ms'   : f'{1000 * summary["query_seconds"]:.2f}',
+            'X-Query-Repeated'  : str(len(summary['repeated']))}
+
+
+def configure(enabled_for_all: bool, buffer_size: int = 50) -> None:
+    global profile_all, last_requests
+    profile_all = enabled_for_all
+    last_requests = deque(last_requests, maxlen=buffer_size)
+
+
+def configure_from_env() -> None:
+    configure(os.environ.get('QUERY_PROFILER', 'false').lower() in ('true', '1'),
+              int(os.environ.get('QUERY_PROFILER_BUFFER', 50)))
@@ -0,0 +1,203 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Union
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, select, update, insert, and_, Engine
+from sqlalchemy.orm import Session
+
+from Backend.DB import User, HealthScore, ScoreRun, ScoreRunPartition, dialect_insert, shard_urls
+from Backend.aggregates import get_cohort_totals
+from Backend.migrations import upgrade
+from Backend.routers.utilities import get_age_range
+from Backend.scoring import score_users, baseline_of
+
+"""
+Recompute the health score of every user into the health_scores table, meant to run after the nightly imports.
+The users are grouped by the age range of get_age_range, the cohort baseline of every range is calculated once and
+the users of the range are split into chunks of user ids that share it. Every chunk is a partition, scored by a process
+of the pool with the vectorized scoring (see Backend/scoring.py) and saved in one transaction.
+A run that was interrupted can be resumed, the users of the partitions it already saved are skipped.
+With DATABASE_SHARD_URLS every shard is scored in its own run, one after the other, against the baselines of the
+cohorts of all the shards (the cohort aggregates of a shard are of its users only, see Backend/shards.py).
+
+    python -m Backend.recompute --workers 8
+    python -m Backend.recompute --resume
+"""
+
+# the number of scores in one INSERT, SQLite allows 32766 parameters in a statement
+WRITE_BATCH_SIZE = 1000
+# get_age_range is checked up to this age, every older user is part of the last range
+MAX_AGE = 120
+# the users of an age range are scored in chunks of this many users, so the big ranges are shared by the workers
+CHUNK_SIZE = 5000
+
+
+def partitions() -> dict[int, tuple[int, Union[int, None]]]:
+    """
+    age bucket (the start of the range) -> the first and last age (None for no limit) of the users scored against it.
+    get_age_range has gaps (25 is in range(20, 25)), so these are the ages it returns the range for and not the range
+    """
+    bounds: dict[int, tuple[int, Union[int, None]]] = {}
+    for age in range(MAX_AGE):
+        bucket = get_age_range(age).start
+        bounds[bucket] = (bounds.get(bucket, (age,))[0], age)
+    last_bucket = get_age_range(MAX_AGE).start
+    bounds[last_bucket] = (bounds[last_bucket][0], None)
+    return bounds
+
+
+def _engine(database_url: str) -> Engine:
+    # the workers write at the same time, SQLite waits for the lock instead of failing
+    connect_args = {'timeout': 60} if database_url.startswith('sqlite') else {}
+    return create_engine(database_url, connect_args=connect_args)
+
+
+def _ages(first_age: int, last_age: Union[int, None]):
+    return User.age >= first_age if last_age is None else User.age.between(first_age, last_age)
+
+
+def chunks(db: Session, first_age: int, last_age: Union[int, None],
+           done: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    The first and last user id of the chunks of the users of the ages, done are the (first, last) user ids of the
+    chunks that were already saved, their users are left out
+    """
+    user_ids = [user_id for user_id in db.execute(select(User.id).where(_ages(first_age, last_age)).order_by(User.id))
+                .scalars() if not any(first <= user_id <= last for first, last in done)]
+    return [(user_ids[i], user_ids[min(i + CHUNK_SIZE, len(user_ids)) - 1])
+            for i in range(0, len(user_ids), CHUNK_SIZE)]
+
+
+def score_partition(database_url: str, run_id: int, bucket: int, first_age: int, last_age: Union[int, None],
+                    first_user_id: int, last_user_id: int, baseline: float) -> tuple[int, int, int, float]:
+    """
+    Score the users of the chunk against the baseline of their age range and save the scores.
+    Returns the bucket, the first user id, the number of users and the time
+    """
+    start = time.perf_counter()
+    engine = _engine(database_url)
+    with Session(engine) as db:
+        chunk = and_(_ages(first_age, last_age), User.id.between(first_user_id, last_user_id))
+        users_query = select(User.id).where(chunk)
+        users = list(db.execute(select(User).where(chunk).order_by(User.id)).scalars())
+        scores = score_users(users, db, users_query, {get_age_range(first_age): baseline}) if users else {}
+        values = []
+        for user in users:
+            score = scores[user.user_name]
+            values.append({'user_id': user.id, 'run_id': run_id,
+                           'score': None if isinstance(score, str) else score,
+                           'error': score if isinstance(score, str) else None})
+        for i in range(0, len(values), WRITE_BATCH_SIZE):
+            statement = dialect_insert(db, HealthScore).values(values[i:i + WRITE_BATCH_SIZE])
+            db.execute(statement.on_conflict_do_update(
+                index_elements=['user_id'],
+                set_={'run_id': statement.excluded.run_id, 'score': statement.excluded.score,
+                      'error': statement.excluded.error}))
+        # in the same transaction as the scores, so a saved partition is always complete
+        db.execute(insert(ScoreRunPartition).values(run_id=run_id, age_bucket=bucket, first_user_id=first_user_id,
+                                                    last_user_id=last_user_id, users=len(users),
+                                                    finished_at=datetime.now()))
+        db.commit()
+    engine.dispose()
+    return bucket, first_user_id, len(users), time.perf_counter() - start
+
+
+def cohort_baselines(database_urls: list[str]) -> dict[int, float]:
+    """The baseline of every age bucket, of the cohorts of all the databases (the shards) together"""
+    totals: dict[int, dict[str, float]] = {}
+    for database_url in database_urls:
+        engine = _engine(database_url)
+        with Session(engine) as db:
+            for bucket, (first_age, _) in partitions().items():
+                bucket_totals = totals.setdefault(bucket, {})
+                for domain, total in get_cohort_totals(get_age_range(first_age), db).items():
+                    bucket_totals[domain] = bucket_totals.get(domain, 0.0) + total
+        engine.dispose()
+    return {bucket: baseline_of(bucket_totals) for bucket, bucket_totals in totals.items()}
+
+
+def start_run(engine: Engine, resume: bool) -> tuple[int, dict[int, list[tuple[int, int]]]]:
+    """
+    The id of the run and the (first, last) user ids of the chunks it already saved by their bucket, a resumed run is
+    the last one that didn't finish
+    """
+    with Session(engine) as db:
+        run_id = None
+        if resume:
+            run_id = db.execute(select(ScoreRun.id)
+                                .where(ScoreRun.finished_at.is_(None))
+                                .order_by(ScoreRun.id.desc())
+                                .limit(1)).scalar_one_or_none()
+        if run_id is None:
+            run_id = db.execute(insert(ScoreRun).values(started_at=datetime.now()).returning(ScoreRun.id)).scalar_one()
+        done: dict[int, list[tuple[int, int]]] = {}
+        for bucket, first_user_id, last_user_id in db.execute(
+                select(ScoreRunPartition.age_bucket, ScoreRunPartition.first_user_id, ScoreRunPartition.last_user_id)
+                .where(ScoreRunPartition.run_id == run_id)):
+            done.setdefault(bucket, []).append((first_user_id, last_user_id))
+        db.commit()
+    return run_id, done
+
+
+def recompute(database_url: str, workers: int = os.cpu_count(), resume: bool = False, progress: bool = True,
+              baselines: Union[dict[int, float], None] = None) -> int:
+    """
+    Score all the users of the database, returns the id of the run.
+    baselines are the cohort baselines by the age bucket (see cohort_baselines), of the database if not given
+    """
+    engine = _engine(database_url)
+    upgrade(engine)
+    if baselines is None:
+        baselines = cohort_baselines([database_url])
+    run_id, done = start_run(engine, resume)
+    todo = []
+    with Session(engine) as db:
+        for bucket, (first_age, last_age) in partitions().items():
+            todo += [(bucket, first_age, last_age, *chunk, baselines[bucket])
+                     for chunk in chunks(db, first_age, last_age, done.get(bucket, []))]
+    if progress:
+        print(f'Run {run_id}: {len(todo)} partitions to score ({sum(map(len, done.values()))} already done) '
+              f'with {workers} workers')
+
+    start = time.perf_counter()
+    scored_users = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(score_partition, database_url, run_id, *partition) for partition in todo]
+        for finished, future in enumerate(as_completed(futures), start=1):
+            bucket, first_user_id, users, elapsed = future.result()
+            scored_users += users
+            if progress:
+                print(f'[{finished}/{len(futures)}] age bucket {bucket} from user {first_user_id}: {users} users '
+                      f'in {elapsed:.2f}s')
+
+    with Session(engine) as db:
+        db.execute(update(ScoreRun).where(ScoreRun.id == run_id).values(finished_at=datetime.now()))
+        db.commit()
+    engine.dispose()
+    if progress:
+        elapsed = time.perf_counter() - start
+        print(f'Run {run_id}: scored {scored_users} users in {elapsed:.2f}s '
+              f'({scored_users / max(elapsed, 1e-9):.0f} users/s)')
+    return run_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the health score of every user into health_scores')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of processes')
+    parser.add_argument('--resume', action='store_true', help='continue the last run that did not finish')
+    parser.add_argument('--quiet', action='store_true', help="don't print the progress")
+    args = parser.parse_args()
+    load_dotenv()
+    database_urls = shard_urls() or [os.environ['DATABASE_URL']]
+    # once for all the shards, their users are compared to the same cohorts
+    baselines = cohort_baselines(database_urls)
+    for database_url in database_urls:
+        recompute(database_url, args.workers, args.resume, not args.quiet, baselines)
+
+
+if __name__ == '__main__':
+    main()
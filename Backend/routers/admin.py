@@ -0,0 +1,42 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+
+from Backend import aggregates, shards
+from Backend.async_routes import sync_only
+from Backend.DB import get_db
+from Backend.cache import score_cache, user_cache
+
+"""
+Maintenance routes for the operators of the API.
+Security: these routes must be restricted to admins (they rewrite data of all the users), see the security notes in
+the readme.
+"""
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+)
+
+
+@router.post('/rebuild_aggregates')
+@sync_only
+def rebuild_aggregates(db: Session = Depends(get_db)):
+    """Recalculate the cohort aggregates from the raw data (backfill for existing databases)"""
+    rebuilt = {}
+    # the aggregates of every shard are of its own users
+    for shard_rebuilt in shards.scatter(db, aggregates.rebuild):
+        for domain, users in shard_rebuilt.items():
+            rebuilt[domain] = rebuilt.get(domain, 0) + users
+    # the rebuilt totals might be slightly different from the incrementally maintained ones
+    score_cache.clear()
+    return {'message': 'Aggregates rebuilt successfully', 'users': rebuilt}
+
+
+@router.get('/score_cache')
+def score_cache_stats():
+    return score_cache.stats()
+
+
+@router.get('/user_cache')
+def user_cache_stats():
+    return user_cache.stats()
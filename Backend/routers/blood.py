@@ -1,17 +1,24 @@
 from datetime import date
-from typing import Annotated, Union
+from types import SimpleNamespace
+from typing import Annotated, Any, Union
 
 import numpy as np
-import pandas as pd
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Body
 from pydantic import BaseModel, Field, BeforeValidator
 from sqlalchemy import and_, select, update, delete
 from sqlalchemy.orm import Session
 
-from Backend.DB import get_db, BloodTest, User
+from Backend import archive
+from Backend.async_routes import sync_only
+from Backend.DB import get_db, get_read_db, BloodTest, dialect_insert
+from Backend.aggregates import refresh_user
+from Backend.monthly import get_monthly_averages
+from Backend.shards import user_means
+from Backend.cache import score_cache
 from Backend.routers.user import get_user
 from Backend.routers.utilities import validate_date_format, FilterParams, \
-    DeleteParams
+    DeleteParams, MAX_BULK_ITEMS, validate_bulk, mark_duplicates, mark_existing, insert_for_user, user_id_of, \
+    returning_user, filter_history, paginate, ExportFormat, stream_export
 
 router = APIRouter(
     prefix="/blood",
@@ -42,35 +49,70 @@ class UserBloodUpdate(BaseModel):
 
 # CRUD Operations
 @router.post('/{user_name}')
-def create_blood_test(user_name: str, blood_test: UserBlood, db: Session = Depends(get_db)):
-    user = get_user(user_name, db)
-    user_id = user.id
-    blood_db = BloodTest(
-        user_id=user_id,
-        RBC=blood_test.RBC,
-        WBC=blood_test.WBC,
-        glucose_level=blood_test.glucose_level,
-        cholesterol_level=blood_test.cholesterol_level,
-        triglycerides_level=blood_test.triglycerides_level,
-        date=blood_test.test_date
-    )
-    blood = db.execute(
-        select(BloodTest)
-        .where(
-            and_(BloodTest.user_id == user_id,
-                 BloodTest.date == blood_test.test_date))
-    ).scalar_one_or_none()
-    if blood:
+def create_blood_test(user_name: str,
+                      blood_test: UserBlood,
+                      upsert: bool = Query(default=False, description='Override the test of the date if it exists'),
+                      db: Session = Depends(get_db)):
+    archive.check_writable([blood_test.test_date])
+    # one statement that resolves the user, inserts the test and detects an existing one (see insert_for_user)
+    created = db.execute(insert_for_user(db, BloodTest, user_name, {
+        'RBC'                : blood_test.RBC,
+        'WBC'                : blood_test.WBC,
+        'glucose_level'      : blood_test.glucose_level,
+        'cholesterol_level'  : blood_test.cholesterol_level,
+        'triglycerides_level': blood_test.triglycerides_level,
+        'date'               : blood_test.test_date
+    }, upsert)).one_or_none()
+    if not created:
+        get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
         raise HTTPException(status_code=400, detail='Blood test already exists for this date, use PUT to update it')
-    db.add(blood_db)
+    refresh_user(db, 'blood', created.user_id, created.age, [blood_test.test_date])
     db.commit()
-    return {'message': f'Created Blood test to user {user.name} on {blood_test.test_date}'}
+    score_cache.bump_version(user_name, created.age)
+    action = 'Saved' if upsert else 'Created'
+    return {'message': f'{action} Blood test to user {created.name} on {blood_test.test_date}'}
+
+
+@router.post('/{user_name}/bulk')
+def create_blood_tests_bulk(user_name: str,
+                            blood_tests: Annotated[list[Any], Body(max_length=MAX_BULK_ITEMS)],
+                            db: Session = Depends(get_db)):
+    """
+    Create many blood tests in one request.
+    Each item is created, reported as a duplicate or as invalid on its own, all the new tests are inserted together
+    """
+    # the age must be the current one, the cohort aggregates are updated by it
+    user = get_user(user_name, db, cached=False)
+    user_id, age, name = user.id, user.age, user.name
+    valid, results = validate_bulk(blood_tests, UserBlood)
+    archive.mark_archived(valid, results, 'test_date')
+    to_create = mark_duplicates(valid, results, 'test_date', [])
+    if to_create:
+        # the tests that already exist are skipped by the unique index, the returned dates are the created ones
+        statement = dialect_insert(db, BloodTest).values([{
+            'user_id'            : user_id,
+            'RBC'                : blood_test.RBC,
+            'WBC'                : blood_test.WBC,
+            'glucose_level'      : blood_test.glucose_level,
+            'cholesterol_level'  : blood_test.cholesterol_level,
+            'triglycerides_level': blood_test.triglycerides_level,
+            'date'               : blood_test.test_date
+        } for blood_test in to_create.values()])
+        created_dates = db.execute(statement
+                                   .on_conflict_do_nothing(index_elements=['user_id', 'date'])
+                                   .returning(BloodTest.date)).scalars().all()
+        mark_existing(to_create, results, 'test_date', created_dates)
+    if to_create:
+        refresh_user(db, 'blood', user_id, age, created_dates)
+        db.commit()
+        score_cache.bump_version(user_name, age)
+    return {'user': name, 'created': len(to_create), 'results': [results[i] for i in range(len(blood_tests))]}
 
 
 @router.get('/{user_name}')
 def get_blood_tests(user_name: str,
                     query: Annotated[FilterParams, Query()] = None,
-                    db: Session = Depends(get_db)):
+                    db: Session = Depends(get_read_db)):
     user = get_user(user_name, db)
     user_id: int = user.id
     details = 'No Blood test found for this user'
@@ -92,9 +134,12 @@ def get_blood_tests(user_name: str,
     else:
         # Get all blood tests
         select_query = select(BloodTest).where(BloodTest.user_id == user_id)
+    select_query = filter_history(select_query, BloodTest, query)
     blood_test = db.execute(select_query).scalars().all()
+    blood_test = archive.history('blood', user_name, query, blood_test)
     if not blood_test:
         raise HTTPException(status_code=404, detail=details)
+    blood_test, next_cursor = paginate(blood_test, query)
     # making the response more readable and make sure only the required fields are returned
     response = [{
         'RBC'                : data.RBC,
@@ -105,24 +150,47 @@ def get_blood_tests(user_name: str,
         'date'               : data.date
     } for data in blood_test]
 
-    return {'user': user.name, 'blood_tests': response}
+    return {'user': user.name, 'blood_tests': response, 'next_cursor': next_cursor}
+
+
+@router.get('/{user_name}/export')
+@sync_only
+def export_blood_tests(user_name: str,
+                       export_format: ExportFormat = Query(default='ndjson', alias='format'),
+                       db: Session = Depends(get_read_db)):
+    """Stream all the blood tests of the user as NDJSON or CSV"""
+    user = get_user(user_name, db)
+    columns = ['date', 'RBC', 'WBC', 'glucose_level', 'cholesterol_level', 'triglycerides_level']
+    select_query = (select(*[getattr(BloodTest, column) for column in columns])
+                    .where(BloodTest.user_id == user.id)
+                    .order_by(BloodTest.date))
+    # the archived rows are older than the rows of the table (see Backend/archive.py)
+    batches = [(None, archive.export_batches('blood', user_name, columns)), (None, select_query)]
+    return stream_export(db, batches, columns, export_format, f'{user_name}_blood')
 
 
 @router.put('/{user_name}')
 def update_blood_test(user_name: str, blood: UserBloodUpdate, db: Session = Depends(get_db)):
-    user = get_user(user_name, db)
-    user_id: int = user.id
+    archive.check_writable([blood.test_date])
     update_values = blood.dict(exclude={'test_date'}, exclude_none=True)  # update only the provided values
+    if not update_values:
+        raise HTTPException(status_code=400, detail='No fields to update')
+    # the user is resolved inside the statement and RETURNING tells if the test existed, so it's one round trip
     blood_test = db.execute(update(BloodTest)
                             .where(
         and_(
-            BloodTest.user_id == user_id,
+            BloodTest.user_id == user_id_of(user_name),
             BloodTest.date == blood.test_date))
-                            .values(**update_values))
-    if blood_test.rowcount == 0:
+                            .values(**update_values)
+                            .returning(*returning_user(BloodTest, user_name))
+                            .execution_options(synchronize_session=False)).one_or_none()
+    if not blood_test:
+        get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
         raise HTTPException(status_code=404, detail='No blood test found for this date')
+    refresh_user(db, 'blood', blood_test.user_id, blood_test.age, [blood.test_date])
     db.commit()
-    return {'message': f'Updated Blood test for user {user.name} on {blood.test_date}'}
+    score_cache.bump_version(user_name, blood_test.age)
+    return {'message': f'Updated Blood test for user {blood_test.name} on {blood.test_date}'}
 
 
 @router.delete('/{user_name}')
@@ -131,8 +199,11 @@ def delete_blood_test(user_name: str,
                       db: Session = Depends(get_db)):
     if not query.delete_all and not query.delete_dates:
         raise HTTPException(status_code=400, detail='No delete parameters provided')
-    user = get_user(user_name, db)
-    user_id: int = user.id
+    if query.delete_dates:
+        archive.check_writable(query.delete_dates)
+    # deleting all the data also deletes the archived days (see Backend/archive.py)
+    archived_dates = archive.archived_dates('blood', user_name) if query.delete_all else []
+    user_id = user_id_of(user_name)
     if query.delete_all:
         delete_query = delete(BloodTest).where(BloodTest.user_id == user_id)
     else:
@@ -142,10 +213,19 @@ def delete_blood_test(user_name: str,
             and_(
                 BloodTest.user_id == user_id,
                 BloodTest.date.in_(set(query.delete_dates)))))
-    result = db.execute(delete_query)
-    if result.rowcount == 0:
-        raise HTTPException(status_code=404, detail='No blood test found to delete')
+    deleted = db.execute(delete_query
+                         .returning(*returning_user(BloodTest, user_name), BloodTest.date)
+                         .execution_options(synchronize_session=False)).all()
+    if not deleted:
+        db_user = get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
+        if not archived_dates:
+            raise HTTPException(status_code=404, detail='No blood test found to delete')
+    user = deleted[0] if deleted else SimpleNamespace(user_id=db_user.id, age=db_user.age, name=db_user.name)
+    refresh_user(db, 'blood', user.user_id, user.age, [row.date for row in deleted] + archived_dates)
     db.commit()
+    if query.delete_all:
+        archive.drop('blood', user_name)
+    score_cache.bump_version(user_name, user.age)
     return {'message': f'Deleted Blood tests for user {user.name}'}
 
 
@@ -153,20 +233,10 @@ def get_avg_monthly(user_name: str, db: Session) -> tuple[np.ndarray, np.ndarray
     """Get the average blood test values for each month for a user
     the calculation itself is nonsense since it's just for demonstration purposes
     """
-    user = get_user(user_name, db)
-    user_id: int = user.id
-    select_query = select(BloodTest).where(BloodTest.user_id == user_id)
-    blood_tests = pd.read_sql(select_query, db.bind)
-    if blood_tests.empty:
-        raise ValueError('No blood tests found for this user')
-    blood_tests['date'] = pd.to_datetime(blood_tests['date'])
-    blood_tests['date'] = blood_tests['date'].dt.month
-    avgs = blood_tests.groupby(['date']).mean()
-    RBC = avgs['RBC'].values
-    WBC = avgs['WBC'].values
-    glucose_level = avgs['glucose_level'].values
-    cholesterol_level = avgs['cholesterol_level'].values
-    triglycerides_level = avgs['triglycerides_level'].values
+    # an unknown user is a 404 and not a ValueError of a user without data
+    # grouped by year-month in the database, one row per month instead of the whole history
+    RBC, WBC, glucose_level, cholesterol_level, triglycerides_level = get_monthly_averages(
+        'blood', get_user(user_name, db).id, db)
     return RBC, WBC, glucose_level, cholesterol_level, triglycerides_level
 
 
@@ -174,14 +244,6 @@ def get_avg_all(age_range: range, db: Session) -> tuple[np.ndarray, np.ndarray,
     """Get the average blood test values for all users within a specific age range
     The calculation itself is nonsense since it's just for demonstration purposes
     """
-    select_query = select(BloodTest).join(User).where(User.age.in_(age_range))
-    blood_tests = pd.read_sql(select_query, db.bind)
-    cols = ['user_id', 'RBC', 'WBC', 'glucose_level', 'cholesterol_level', 'triglycerides_level']
-    blood_tests = blood_tests[cols]
-    avgs = blood_tests.groupby(['user_id']).mean()
-    RBC = avgs['RBC'].values
-    WBC = avgs['WBC'].values
-    glucose_level = avgs['glucose_level'].values
-    cholesterol_level = avgs['cholesterol_level'].values
-    triglycerides_level = avgs['triglycerides_level'].values
+    # the per-user means are maintained on every write, see Backend/aggregates.py
+    RBC, WBC, glucose_level, cholesterol_level, triglycerides_level = user_means('blood', age_range, db)
     return RBC, WBC, glucose_level, cholesterol_level, triglycerides_level
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Query
+
+from Backend import profiler
+
+"""
+The profiles of the last profiled requests (see Backend/profiler.py).
+Security: like the admin routes these should only be reachable from the internal network, they show the statements.
+"""
+
+router = APIRouter(
+    prefix="/debug",
+    tags=["debug"],
+)
+
+
+@router.get('/last-requests')
+def last_requests(repeated_only: bool = Query(default=False, description='Only the requests with repeated statements')):
+    """The profiles of the last profiled requests, the newest first"""
+    return [summary for summary in reversed(profiler.last_requests) if summary['repeated'] or not repeated_only]
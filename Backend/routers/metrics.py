@@ -0,0 +1,26 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from Backend.metrics import database_metrics, prometheus_text
+
+"""
+The metrics of the process for the operators (see Backend/metrics.py).
+Security: like the admin routes these should only be reachable from the internal network.
+"""
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"],
+)
+
+
+@router.get('', response_class=PlainTextResponse)
+def all_metrics():
+    """The latency, responses and database queries of every route and the connection pools, for Prometheus to scrape"""
+    return PlainTextResponse(prometheus_text(), media_type='text/plain; version=0.0.4')
+
+
+@router.get('/db')
+def db_metrics():
+    """The connection pools of the engines: checked out connections, overflow, waits and checkout latency"""
+    return database_metrics.snapshot()
@@ -1,17 +1,24 @@
 from datetime import date
-from typing import Annotated, Union
+from types import SimpleNamespace
+from typing import Annotated, Any, Union
 
 import numpy as np
-import pandas as pd
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Body
 from pydantic import BaseModel, Field, BeforeValidator
 from sqlalchemy import and_, select, delete, update
 from sqlalchemy.orm import Session
 
-from Backend.DB import get_db, PhysicalActivity, User
+from Backend import archive
+from Backend.async_routes import sync_only
+from Backend.DB import get_db, get_read_db, PhysicalActivity, dialect_insert
+from Backend.aggregates import refresh_user
+from Backend.monthly import get_monthly_averages
+from Backend.shards import user_means
+from Backend.cache import score_cache
 from Backend.routers.user import get_user
 from Backend.routers.utilities import validate_date_format, DeleteParams, \
-    FilterParams
+    FilterParams, MAX_BULK_ITEMS, validate_bulk, mark_duplicates, mark_existing, insert_for_user, user_id_of, \
+    returning_user, filter_history, paginate, ExportFormat, stream_export
 
 router = APIRouter(
     prefix="/physical",
@@ -44,33 +51,66 @@ class UserPhysicalUpdate(BaseModel):
 
 
 @router.post('/{user_name}')
-def create_physical(user_name: str, physical: UserPhysical, db: Session = Depends(get_db)):
-    user = get_user(user_name, db)
-    user_id = user.id
-    physical_db = PhysicalActivity(
-        user_id=user_id,
-        steps=physical.steps,
-        cardio_time_session_minutes=physical.cardio_time_session_minutes,
-        strength_time_session_minutes=physical.strength_time_session_minutes,
-        date=physical.session_date
-    )
-    physical_data = db.execute(
-        select(PhysicalActivity)
-        .where(
-            and_(PhysicalActivity.user_id == user_id,
-                 PhysicalActivity.date == physical.session_date))
-    ).scalar_one_or_none()
-    if physical_data:
+def create_physical(user_name: str,
+                    physical: UserPhysical,
+                    upsert: bool = Query(default=False, description='Override the data of the day if it exists'),
+                    db: Session = Depends(get_db)):
+    archive.check_writable([physical.session_date])
+    # one statement that resolves the user, inserts the day and detects an existing one (see insert_for_user)
+    created = db.execute(insert_for_user(db, PhysicalActivity, user_name, {
+        'steps'                        : physical.steps,
+        'cardio_time_session_minutes'  : physical.cardio_time_session_minutes,
+        'strength_time_session_minutes': physical.strength_time_session_minutes,
+        'date'                         : physical.session_date
+    }, upsert)).one_or_none()
+    if not created:
+        get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
         raise HTTPException(status_code=400, detail='Physical data already exists for this date, use PUT to update it')
-    db.add(physical_db)
+    refresh_user(db, 'physical', created.user_id, created.age, [physical.session_date])
     db.commit()
-    return {'message': f'Created Physical data to user {user.name} on {physical.session_date}'}
+    score_cache.bump_version(user_name, created.age)
+    action = 'Saved' if upsert else 'Created'
+    return {'message': f'{action} Physical data to user {created.name} on {physical.session_date}'}
+
+
+@router.post('/{user_name}/bulk')
+def create_physical_bulk(user_name: str,
+                         physical_data: Annotated[list[Any], Body(max_length=MAX_BULK_ITEMS)],
+                         db: Session = Depends(get_db)):
+    """
+    Create many days of physical data in one request (e.g. a sync of a wearable).
+    Each item is created, reported as a duplicate or as invalid on its own, all the new days are inserted together
+    """
+    # the age must be the current one, the cohort aggregates are updated by it
+    user = get_user(user_name, db, cached=False)
+    user_id, age, name = user.id, user.age, user.name
+    valid, results = validate_bulk(physical_data, UserPhysical)
+    archive.mark_archived(valid, results, 'session_date')
+    to_create = mark_duplicates(valid, results, 'session_date', [])
+    if to_create:
+        # the days that already exist are skipped by the unique index, the returned dates are the created ones
+        statement = dialect_insert(db, PhysicalActivity).values([{
+            'user_id'                      : user_id,
+            'steps'                        : physical.steps,
+            'cardio_time_session_minutes'  : physical.cardio_time_session_minutes,
+            'strength_time_session_minutes': physical.strength_time_session_minutes,
+            'date'                         : physical.session_date
+        } for physical in to_create.values()])
+        created_dates = db.execute(statement
+                                   .on_conflict_do_nothing(index_elements=['user_id', 'date'])
+                                   .returning(PhysicalActivity.date)).scalars().all()
+        mark_existing(to_create, results, 'session_date', created_dates)
+    if to_create:
+        refresh_user(db, 'physical', user_id, age, created_dates)
+        db.commit()
+        score_cache.bump_version(user_name, age)
+    return {'user': name, 'created': len(to_create), 'results': [results[i] for i in range(len(physical_data))]}
 
 
 @router.get('/{user_name}')
 def get_physical_data(user_name: str,
                       query: Annotated[FilterParams, Query()] = None,
-                      db: Session = Depends(get_db)):
+                      db: Session = Depends(get_read_db)):
     user = get_user(user_name, db)
     user_id: int = user.id
     details = 'No physical data found for this user'
@@ -91,44 +131,61 @@ def get_physical_data(user_name: str,
     else:
         select_query = select(PhysicalActivity).where(PhysicalActivity.user_id == user_id)
 
+    select_query = filter_history(select_query, PhysicalActivity, query)
     physical_data = db.execute(select_query).scalars().all()
+    physical_data = archive.history('physical', user_name, query, physical_data)
     if not physical_data:
         raise HTTPException(status_code=404, detail=details)
+    physical_data, next_cursor = paginate(physical_data, query)
     response = [{
         'steps'                        : data.steps,
         'cardio_time_session_minutes'  : data.cardio_time_session_minutes,
         'strength_time_session_minutes': data.strength_time_session_minutes,
         'date'                         : data.date
     } for data in physical_data]
-    return {'user': user.name, 'physical_data': response}
+    return {'user': user.name, 'physical_data': response, 'next_cursor': next_cursor}
+
+
+@router.get('/{user_name}/export')
+@sync_only
+def export_physical_data(user_name: str,
+                         export_format: ExportFormat = Query(default='ndjson', alias='format'),
+                         db: Session = Depends(get_read_db)):
+    """Stream all the physical data of the user as NDJSON or CSV"""
+    user = get_user(user_name, db)
+    columns = ['date', 'steps', 'cardio_time_session_minutes', 'strength_time_session_minutes']
+    select_query = (select(*[getattr(PhysicalActivity, column) for column in columns])
+                    .where(PhysicalActivity.user_id == user.id)
+                    .order_by(PhysicalActivity.date))
+    # the archived rows are older than the rows of the table (see Backend/archive.py)
+    batches = [(None, archive.export_batches('physical', user_name, columns)), (None, select_query)]
+    return stream_export(db, batches, columns, export_format, f'{user_name}_physical')
 
 
 @router.put('/{user_name}')
 def update_physical(user_name: str, physical: UserPhysicalUpdate, db: Session = Depends(get_db)):
-    user = get_user(user_name, db)
-    user_id: int = user.id
-    physical_data = db.execute(
-        select(PhysicalActivity)
-        .where(
-            and_(
-                PhysicalActivity.user_id == user_id,
-                PhysicalActivity.date == physical.session_date))
-        .limit(1)
-    ).scalar_one_or_none()
-    if not physical_data:
-        raise HTTPException(status_code=404, detail='No physical data found for this date')
+    archive.check_writable([physical.session_date])
     update_values = physical.dict(exclude={'session_date'}, exclude_none=True)
-    result = db.execute(
+    if not update_values:
+        raise HTTPException(status_code=400, detail='No fields to update')
+    # the user is resolved inside the statement and RETURNING tells if the day existed, so it's one round trip
+    updated = db.execute(
         update(PhysicalActivity)
         .where(
             and_(
-                PhysicalActivity.user_id == user_id,
+                PhysicalActivity.user_id == user_id_of(user_name),
                 PhysicalActivity.date == physical.session_date))
-        .values(**update_values))
+        .values(**update_values)
+        .returning(*returning_user(PhysicalActivity, user_name))
+        .execution_options(synchronize_session=False)
+    ).one_or_none()
+    if not updated:
+        get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
+        raise HTTPException(status_code=404, detail='No physical data found for this date')
+    refresh_user(db, 'physical', updated.user_id, updated.age, [physical.session_date])
     db.commit()
-    if result.rowcount == 0:
-        raise HTTPException(status_code=404, detail='No physical data found for the provided dates')
-    return {'message': f'Updated Physical data for user {user.name} on {physical.session_date}'}
+    score_cache.bump_version(user_name, updated.age)
+    return {'message': f'Updated Physical data for user {updated.name} on {physical.session_date}'}
 
 
 @router.delete('/{user_name}')
@@ -138,8 +195,11 @@ def delete_physical(user_name: str,
     if not (query.delete_all or query.delete_dates):
         raise HTTPException(status_code=400, detail='No delete parameters provided')
 
-    user = get_user(user_name, db)
-    user_id: int = user.id
+    if query.delete_dates:
+        archive.check_writable(query.delete_dates)
+    # deleting all the data also deletes the archived days (see Backend/archive.py)
+    archived_dates = archive.archived_dates('physical', user_name) if query.delete_all else []
+    user_id = user_id_of(user_name)
     if query.delete_all:
         delete_query = delete(PhysicalActivity).where(PhysicalActivity.user_id == user_id)
     else:
@@ -148,37 +208,31 @@ def delete_physical(user_name: str,
             and_(
                 PhysicalActivity.user_id == user_id,
                 PhysicalActivity.date.in_(set(query.delete_dates)))))
-    result = db.execute(delete_query)
-    if result.rowcount == 0:
-        raise HTTPException(status_code=404, detail='No physical data found for the provided dates')
+    deleted = db.execute(delete_query
+                         .returning(*returning_user(PhysicalActivity, user_name), PhysicalActivity.date)
+                         .execution_options(synchronize_session=False)).all()
+    if not deleted:
+        db_user = get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
+        if not archived_dates:
+            raise HTTPException(status_code=404, detail='No physical data found for the provided dates')
+    user = deleted[0] if deleted else SimpleNamespace(user_id=db_user.id, age=db_user.age, name=db_user.name)
+    refresh_user(db, 'physical', user.user_id, user.age, [row.date for row in deleted] + archived_dates)
     db.commit()
+    if query.delete_all:
+        archive.drop('physical', user_name)
+    score_cache.bump_version(user_name, user.age)
     return {'message': f'Deleted Physical data for user {user.name}'}
 
 
 def get_avg_monthly(user_name: str, db: Session) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    user = get_user(user_name, db)
-    user_id: int = user.id
-    select_query = select(PhysicalActivity).where(PhysicalActivity.user_id == user_id)
-    physical_activity = pd.read_sql(select_query, db.bind)
-    if physical_activity.empty:
-        raise ValueError('No physical data found for this user')
-    physical_activity['date'] = pd.to_datetime(physical_activity['date'])
-    physical_activity['date'] = physical_activity['date'].dt.month
-    avgs = physical_activity.groupby(['date']).mean()
-    steps = avgs['steps'].values
-    cardio = avgs['cardio_time_session_minutes'].values
-    strength = avgs['strength_time_session_minutes'].values
+    # an unknown user is a 404 and not a ValueError of a user without data
+    # grouped by year-month in the database, one row per month instead of the whole history
+    steps, cardio, strength = get_monthly_averages('physical', get_user(user_name, db).id, db)
     return steps, cardio, strength
 
 
 def get_avg_all(age_range: range, db: Session) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    select_query = select(PhysicalActivity).join(User).where(User.age.in_(age_range))
-    physical_activity = pd.read_sql(select_query, db.bind)
-    cols = ['user_id', 'steps', 'cardio_time_session_minutes', 'strength_time_session_minutes']
-    physical_activity = physical_activity[cols]
-    avgs = physical_activity.groupby(['user_id']).mean()
-    steps = avgs['steps'].values
-    cardio = avgs['cardio_time_session_minutes'].values
-    strength = avgs['strength_time_session_minutes'].values
+    # the per-user means are maintained on every write, see Backend/aggregates.py
+    steps, cardio, strength = user_means('physical', age_range, db)
     # return just the values for user data protection
     return steps, cardio, strength
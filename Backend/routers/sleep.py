@@ -1,17 +1,24 @@
 from datetime import date
-from typing import Annotated
+from types import SimpleNamespace
+from typing import Annotated, Any
 
 import numpy as np
-import pandas as pd
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Body
 from pydantic import BaseModel, Field, BeforeValidator
 from sqlalchemy import and_, select, delete, update
 from sqlalchemy.orm import Session
 
-from Backend.DB import get_db, SleepActivity, User
+from Backend import archive
+from Backend.async_routes import sync_only
+from Backend.DB import get_db, get_read_db, SleepActivity, dialect_insert
+from Backend.aggregates import refresh_user
+from Backend.monthly import get_monthly_averages
+from Backend.shards import user_means
+from Backend.cache import score_cache
 from Backend.routers.user import get_user
 from Backend.routers.utilities import validate_date_format, FilterParams, \
-    DeleteParams
+    DeleteParams, MAX_BULK_ITEMS, validate_bulk, mark_duplicates, mark_existing, insert_for_user, user_id_of, \
+    returning_user, filter_history, paginate, ExportFormat, stream_export
 
 router = APIRouter(
     prefix="/sleep",
@@ -36,33 +43,67 @@ class UserSleepUpdate(BaseModel):
 
 
 @router.post('/{user_name}')
-def create_sleep_activity(user_name: str, sleep_activity: UserSleep, db: Session = Depends(get_db)):
-    user = get_user(user_name, db)
-    user_id: int = user.id
-    sleep_db = SleepActivity(
-        user_id=user_id,
-        sleep_hours=sleep_activity.sleep_hours,
-        avg_heart_rate=sleep_activity.avg_heart_rate,
-        avg_oxygen_level=sleep_activity.avg_oxygen_level,
-        date=sleep_activity.sleep_date
-    )
-    sleep = db.execute(
-        select(SleepActivity)
-        .where(
-            and_(SleepActivity.user_id == user_id,
-                 SleepActivity.date == sleep_activity.sleep_date))
-    ).scalar_one_or_none()
-    if sleep:
+def create_sleep_activity(user_name: str,
+                          sleep_activity: UserSleep,
+                          upsert: bool = Query(default=False, description='Override the existing sleep of the date'),
+                          db: Session = Depends(get_db)):
+    archive.check_writable([sleep_activity.sleep_date])
+    # one statement that resolves the user, inserts the sleep and detects an existing one (see insert_for_user)
+    created = db.execute(insert_for_user(db, SleepActivity, user_name, {
+        'sleep_hours'     : sleep_activity.sleep_hours,
+        'avg_heart_rate'  : sleep_activity.avg_heart_rate,
+        'avg_oxygen_level': sleep_activity.avg_oxygen_level,
+        'date'            : sleep_activity.sleep_date
+    }, upsert)).one_or_none()
+    if not created:
+        get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
         raise HTTPException(status_code=400, detail='Sleep already exists for this date, use PUT to update it')
-    db.add(sleep_db)
+    refresh_user(db, 'sleep', created.user_id, created.age, [sleep_activity.sleep_date])
     db.commit()
-    return {'message': f'Created Sleep activity to user {user.name} on {sleep_activity.sleep_date}'}
+    score_cache.bump_version(user_name, created.age)
+    action = 'Saved' if upsert else 'Created'
+    return {'message': f'{action} Sleep activity to user {created.name} on {sleep_activity.sleep_date}'}
+
+
+@router.post('/{user_name}/bulk')
+def create_sleep_activities_bulk(user_name: str,
+                                 sleep_activities: Annotated[list[Any], Body(max_length=MAX_BULK_ITEMS)],
+                                 db: Session = Depends(get_db)):
+    """
+    Create many nights of sleep in one request (e.g. a sync of a wearable).
+    Each item is created, reported as a duplicate or as invalid on its own, all the new nights are inserted together
+    """
+    # the age must be the current one, the cohort aggregates are updated by it
+    user = get_user(user_name, db, cached=False)
+    user_id, age, name = user.id, user.age, user.name
+    valid, results = validate_bulk(sleep_activities, UserSleep)
+    archive.mark_archived(valid, results, 'sleep_date')
+    to_create = mark_duplicates(valid, results, 'sleep_date', [])
+    if to_create:
+        # the nights that already exist are skipped by the unique index, the returned dates are the created ones
+        statement = dialect_insert(db, SleepActivity).values([{
+            'user_id'         : user_id,
+            'sleep_hours'     : sleep_activity.sleep_hours,
+            'avg_heart_rate'  : sleep_activity.avg_heart_rate,
+            'avg_oxygen_level': sleep_activity.avg_oxygen_level,
+            'date'            : sleep_activity.sleep_date
+        } for sleep_activity in to_create.values()])
+        created_dates = db.execute(statement
+                                   .on_conflict_do_nothing(index_elements=['user_id', 'date'])
+                                   .returning(SleepActivity.date)).scalars().all()
+        mark_existing(to_create, results, 'sleep_date', created_dates)
+    if to_create:
+        refresh_user(db, 'sleep', user_id, age, created_dates)
+        db.commit()
+        score_cache.bump_version(user_name, age)
+    return {'user'   : name, 'created': len(to_create),
+            'results': [results[i] for i in range(len(sleep_activities))]}
 
 
 @router.get('/{user_name}')
 def get_sleep_activities(user_name: str,
                          query: Annotated[FilterParams, Query()] = None,
-                         db: Session = Depends(get_db)):
+                         db: Session = Depends(get_read_db)):
     user = get_user(user_name, db)
     user_id: int = user.id
     details = 'No sleep activity found for this user'
@@ -83,9 +124,12 @@ def get_sleep_activities(user_name: str,
         details += f' on the provided dates'
     else:
         select_query = select(SleepActivity).where(SleepActivity.user_id == user_id)
+    select_query = filter_history(select_query, SleepActivity, query)
     sleep_activity = db.execute(select_query).scalars().all()
+    sleep_activity = archive.history('sleep', user_name, query, sleep_activity)
     if not sleep_activity:
         raise HTTPException(status_code=404, detail=details)
+    sleep_activity, next_cursor = paginate(sleep_activity, query)
     response = [{
         'sleep_hours'     : data.sleep_hours,
         'avg_heart_rate'  : data.avg_heart_rate,
@@ -93,25 +137,48 @@ def get_sleep_activities(user_name: str,
         'date'            : data.date
     } for data in sleep_activity]
 
-    return {'user': user.name, 'sleep activity': response}
+    return {'user': user.name, 'sleep activity': response, 'next_cursor': next_cursor}
+
+
+@router.get('/{user_name}/export')
+@sync_only
+def export_sleep_activities(user_name: str,
+                            export_format: ExportFormat = Query(default='ndjson', alias='format'),
+                            db: Session = Depends(get_read_db)):
+    """Stream all the sleep activities of the user as NDJSON or CSV"""
+    user = get_user(user_name, db)
+    columns = ['date', 'sleep_hours', 'avg_heart_rate', 'avg_oxygen_level']
+    select_query = (select(*[getattr(SleepActivity, column) for column in columns])
+                    .where(SleepActivity.user_id == user.id)
+                    .order_by(SleepActivity.date))
+    # the archived rows are older than the rows of the table (see Backend/archive.py)
+    batches = [(None, archive.export_batches('sleep', user_name, columns)), (None, select_query)]
+    return stream_export(db, batches, columns, export_format, f'{user_name}_sleep')
 
 
 @router.put('/{user_name}')
 def update_sleep(user_name: str, sleep: UserSleepUpdate, db: Session = Depends(get_db)):
-    user = get_user(user_name, db)
-    user_id: int = user.id
+    archive.check_writable([sleep.sleep_date])
     update_values = sleep.dict(exclude={'sleep_date'}, exclude_none=True)
+    if not update_values:
+        raise HTTPException(status_code=400, detail='No fields to update')
+    # the user is resolved inside the statement and RETURNING tells if the sleep existed, so it's one round trip
     update_query = (update(SleepActivity)
                     .where(
         and_(
-            SleepActivity.user_id == user_id,
+            SleepActivity.user_id == user_id_of(user_name),
             SleepActivity.date == sleep.sleep_date))
-                    .values(**update_values))
-    sleep_activity = db.execute(update_query)
-    db.commit()
-    if sleep_activity.rowcount == 0:
+                    .values(**update_values)
+                    .returning(*returning_user(SleepActivity, user_name))
+                    .execution_options(synchronize_session=False))
+    sleep_activity = db.execute(update_query).one_or_none()
+    if not sleep_activity:
+        get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
         raise HTTPException(status_code=404, detail='No sleep activity found for this date')
-    return {'message': f'Updated sleep activity for user {user.name} on {sleep.sleep_date}'}
+    refresh_user(db, 'sleep', sleep_activity.user_id, sleep_activity.age, [sleep.sleep_date])
+    db.commit()
+    score_cache.bump_version(user_name, sleep_activity.age)
+    return {'message': f'Updated sleep activity for user {sleep_activity.name} on {sleep.sleep_date}'}
 
 
 @router.delete('/{user_name}')
@@ -120,8 +187,11 @@ def delete_sleep(user_name: str,
                  db: Session = Depends(get_db)):
     if not query.delete_all and not query.delete_dates:
         raise HTTPException(status_code=400, detail='No delete parameters provided')
-    user = get_user(user_name, db)
-    user_id: int = user.id
+    if query.delete_dates:
+        archive.check_writable(query.delete_dates)
+    # deleting all the data also deletes the archived days (see Backend/archive.py)
+    archived_dates = archive.archived_dates('sleep', user_name) if query.delete_all else []
+    user_id = user_id_of(user_name)
     if query.delete_all:
         delete_query = delete(SleepActivity).where(SleepActivity.user_id == user_id)
     else:
@@ -130,36 +200,30 @@ def delete_sleep(user_name: str,
             and_(
                 SleepActivity.user_id == user_id,
                 SleepActivity.date.in_(set(query.delete_dates)))))
-    result = db.execute(delete_query)
+    deleted = db.execute(delete_query
+                         .returning(*returning_user(SleepActivity, user_name), SleepActivity.date)
+                         .execution_options(synchronize_session=False)).all()
+    if not deleted:
+        db_user = get_user(user_name, db, cached=False)  # the user doesn't exist -> 404
+        if not archived_dates:
+            raise HTTPException(status_code=404, detail='No sleep activity found for the provided dates')
+    user = deleted[0] if deleted else SimpleNamespace(user_id=db_user.id, age=db_user.age, name=db_user.name)
+    refresh_user(db, 'sleep', user.user_id, user.age, [row.date for row in deleted] + archived_dates)
     db.commit()
-    if result.rowcount == 0:
-        raise HTTPException(status_code=404, detail='No sleep activity found for the provided dates')
+    if query.delete_all:
+        archive.drop('sleep', user_name)
+    score_cache.bump_version(user_name, user.age)
     return {'message': f'Deleted sleep activity for user {user.name}'}
 
 
 def get_avg_monthly(user_name: str, db: Session) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    user = get_user(user_name, db)
-    user_id: int = user.id
-    select_query = select(SleepActivity).where(SleepActivity.user_id == user_id)
-    sleep_activity = pd.read_sql(select_query, db.bind)
-    if sleep_activity.empty:
-        raise ValueError('No sleep activity found for this user')
-    sleep_activity['date'] = pd.to_datetime(sleep_activity['date'])
-    sleep_activity['date'] = sleep_activity['date'].dt.month
-    avgs = sleep_activity.groupby(['date']).mean()
-    sleep_hours = avgs['sleep_hours'].values
-    avg_heart_rate = avgs['avg_heart_rate'].values
-    avg_oxygen_level = avgs['avg_oxygen_level'].values
+    # an unknown user is a 404 and not a ValueError of a user without data
+    # grouped by year-month in the database, one row per month instead of the whole history
+    sleep_hours, avg_heart_rate, avg_oxygen_level = get_monthly_averages('sleep', get_user(user_name, db).id, db)
     return sleep_hours, avg_heart_rate, avg_oxygen_level
 
 
 def get_avg_all(age_range: range, db: Session) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    select_query = select(SleepActivity).join(User).where(User.age.in_(age_range))
-    sleeps = pd.read_sql(select_query, db.bind)
-    cols = ['user_id', 'sleep_hours', 'avg_heart_rate', 'avg_oxygen_level']
-    sleeps = sleeps[cols]
-    avgs = sleeps.groupby(['user_id']).mean()
-    sleep_hours = avgs['sleep_hours'].values
-    avg_heart_rate = avgs['avg_heart_rate'].values
-    avg_oxygen_level = avgs['avg_oxygen_level'].values
+    # the per-user means are maintained on every write, see Backend/aggregates.py
+    sleep_hours, avg_heart_rate, avg_oxygen_level = user_means('sleep', age_range, db)
     return sleep_hours, avg_heart_rate, avg_oxygen_level
@@ -1,9 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Union
+
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel, Field
 from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from Backend.DB import get_db, User
+from Backend import archive
+from Backend.async_routes import sync_only
+from Backend.DB import get_db, get_read_db, use_shard, replica_as_of, User
+from Backend.aggregates import move_user, drop_user, DOMAINS
+from Backend.cache import score_cache, user_cache, CachedUser, NOT_CACHED
+from Backend.routers.utilities import ExportFormat, stream_export
 
 router = APIRouter(
     prefix="/users",
@@ -23,15 +31,40 @@ class UserUpdate(BaseModel):
     age: int = Field(title="The age of the user", description='must be above 18', ge=18, default=None)
 
 
-def get_user(user_name: str, db: Session) -> User:
-    user = db.execute(select(User).where(User.user_name == user_name)).scalar_one_or_none()
+def get_user(user_name: str, db: Session, cached: bool = True) -> CachedUser:
+    """
+    The id, name and age of the user, 404 if he doesn't exist.
+    The user is looked up once per request (db.info lives as long as the request's session) and kept in user_cache
+    between requests. cached=False reads the row from the database, for the routes that are about to change it
+    """
+    users: dict[str, Union[CachedUser, None]] = db.info.setdefault('users', {})
+    if cached and user_name in users:
+        user = users[user_name]
+    else:
+        user = user_cache.get(user_name) if cached else NOT_CACHED
+        if user is NOT_CACHED:
+            generation = user_cache.generation(user_name)
+            row = db.execute(select(User.id, User.user_name, User.name, User.age)
+                             .where(User.user_name == user_name)).one_or_none()
+            user = CachedUser(*row) if row else None
+            # a user that was just created or changed might not be on the read replica yet, that isn't kept
+            if user or not db.info.get('replica'):
+                user_cache.put(user_name, generation, user, replica_as_of(db))
+        users[user_name] = user
     if not user:
         raise HTTPException(status_code=404, detail='User not found')
     return user
 
 
+def forget_user(user_name: str, db: Session) -> None:
+    """Called after the user was created, updated or deleted"""
+    db.info.get('users', {}).pop(user_name, None)
+    user_cache.invalidate(user_name)
+
+
 @router.post('/')
 def create_user(user: UserCreate, db: Session = Depends(get_db)):
+    use_shard(db, user.user_name)
     try:
         existing_user = get_user(user.user_name, db)
     except HTTPException as e:
@@ -40,41 +73,77 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail='User with this user_name already exists')
     db_user = User(user_name=user.user_name, name=user.name, age=user.age)
     db.add(db_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # the user was created by another worker after this one cached that he doesn't exist
+        db.rollback()
+        forget_user(user.user_name, db)
+        raise HTTPException(status_code=400, detail='User with this user_name already exists')
+    forget_user(user.user_name, db)
+    score_cache.bump_version(user.user_name)
     return {'message': f'User {user.name} created successfully', 'user_name': db_user.user_name}
 
 
 @router.get('/{user_name}')
-def get_user_endpoint(user_name: str, db: Session = Depends(get_db)):
+def get_user_endpoint(user_name: str, db: Session = Depends(get_read_db)):
     user = get_user(user_name, db)
     return {'user_name': user.user_name, 'name': user.name, 'age': user.age}
 
 
+@router.get('/{user_name}/export')
+@sync_only
+def export_user_data(user_name: str,
+                     export_format: ExportFormat = Query(default='ndjson', alias='format'),
+                     db: Session = Depends(get_read_db)):
+    """Stream all the physical, sleep and blood data of the user, every row has the domain it came from"""
+    user = get_user(user_name, db)
+    columns = ['domain', 'date']
+    queries = []
+    for domain, (model, metrics) in DOMAINS.items():
+        columns += metrics
+        queries.append((domain, archive.export_batches(domain, user_name, ['date', *metrics])))
+        queries.append((domain, select(model.date, *[getattr(model, metric) for metric in metrics])
+                        .where(model.user_id == user.id)
+                        .order_by(model.date)))
+    return stream_export(db, queries, columns, export_format, f'{user_name}_all')
+
+
 @router.put('/{user_name}')
 def update_user(user_name: str, user: UserUpdate, db: Session = Depends(get_db)):
-    db_user = get_user(user_name, db)
+    # the age must be the current one, the cohort aggregates are moved by it
+    db_user = get_user(user_name, db, cached=False)
     if not db_user:
         raise HTTPException(status_code=404, detail='User not found')
     user_id: int = db_user.id
+    old_age: int = db_user.age
     name = user.name or db_user.name
-    age = user.age or db_user.age
+    age = user.age or old_age
     # there should be a check here to see if there were no changes to the user data, but for simplicity, I'll skip it
     update_query = update(User).where(User.id == user_id).values(name=name, age=age)
+    move_user(db, user_id, old_age, age)
     db.execute(update_query)
     db.commit()
+    forget_user(user_name, db)
+    score_cache.bump_version(user_name, old_age, age)
     return {'message': f'User {user.name} updated successfully'}
 
 
 @router.delete('/{user_name}')
 def delete_user(user_name: str, db: Session = Depends(get_db)):
-    db_user = get_user(user_name, db)
+    db_user = get_user(user_name, db, cached=False)
     name = db_user.name
+    age: int = db_user.age
     if not db_user:
         raise HTTPException(status_code=404, detail='User not found')
     user_id: int = db_user.id
+    drop_user(db, user_id, age)
     delete_statement = delete(User).where(User.id == user_id)
     result = db.execute(delete_statement)  # This will delete all related data as well due to the CASCADE constraint
     if result.rowcount == 0:
         raise HTTPException(status_code=404, detail='unexpected error occurred, user was not deleted successfully')
     db.commit()
+    archive.drop_user(user_name)
+    forget_user(user_name, db)
+    score_cache.bump_version(user_name, age)
     return {'message': f'User {name} was deleted successfully with all related data'}
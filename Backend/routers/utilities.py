@@ -1,13 +1,59 @@
+import base64
+import csv
+import io
+import json
 from datetime import date
-from typing import Annotated
+from typing import Annotated, Any, Union, Literal, Iterator
 
-from pydantic import BaseModel, BeforeValidator, Field
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, BeforeValidator, Field, ValidationError
+from sqlalchemy import select, literal, Select
+from sqlalchemy.orm import Session
+
+from Backend.DB import User, dialect_insert
 
 """
 Although I said I treated each route as a separate entity, I did collected some common code in the utilities.py file.
 """
 
 
+def get_age_range(age: int) -> range:
+    if age < 0:
+        raise ValueError("Age cannot be negative")
+    elif age <= 1:
+        return range(0, 1)  # 0-1 baby
+    elif age <= 3:
+        return range(1, 4)  # 1-3 toddler
+    elif age <= 12:
+        return range(4, 13)  # 4-12 child
+    elif age <= 19:
+        return range(13, 20)  # 13-19 teen
+    elif age <= 25:
+        return range(20, 25)  # 20-25 young adult
+    elif age <= 35:
+        return range(25, 36)  # 25-35
+    elif age <= 45:
+        return range(36, 50)  # 36-45
+    elif age <= 65:
+        return range(51, 66)  # 51-65
+    elif age <= 75:
+        return range(66, 76)  # 66-75
+    else:
+        return range(76, 120)  # Arbitrary upper limit for seniors
+
+
+# All the age ranges get_age_range can return, a user is part of the cohort of the range that contains his age
+AGE_RANGES: tuple[range, ...] = tuple(dict.fromkeys(get_age_range(age) for age in range(0, 120)))
+
+
+def get_cohort_range(age: int) -> Union[range, None]:
+    """The age range whose cohort the user is counted in (not always the same as get_age_range(age))"""
+    for age_range in AGE_RANGES:
+        if age in age_range:
+            return age_range
+    return None
+
+
 def validate_date_format(value: str) -> date:
     try:
         return date.fromisoformat(value)
@@ -29,6 +75,94 @@ def validate_bool(value: str) -> bool:
         raise ValueError('Must be True or False')
 
 
+# The maximum number of items in one bulk request, it also keeps the multi-row insert under the DB's parameter limit
+MAX_BULK_ITEMS = 1000
+
+
+def validate_bulk(items: list[Any], schema: type[BaseModel]) -> tuple[dict[int, BaseModel], dict[int, dict]]:
+    """
+    Validate every item of a bulk request on its own, so one bad item doesn't fail the whole request.
+    returns the valid items and the results of the invalid ones, both by the index of the item
+    """
+    valid, results = {}, {}
+    for i, item in enumerate(items):
+        try:
+            valid[i] = schema.model_validate(item)
+        except ValidationError as e:
+            results[i] = {'index': i, 'status': 'invalid', 'detail': e.errors(include_url=False, include_context=False)}
+    return valid, results
+
+
+def mark_duplicates(valid: dict[int, BaseModel], results: dict[int, dict], date_field: str,
+                    existing_dates) -> dict[int, BaseModel]:
+    """
+    Fill the results of the valid items and return the ones that should be created.
+    An item is a duplicate if its date already exists, or if an earlier item in the request has the same date
+    """
+    seen = set(existing_dates)
+    to_create = {}
+    for i, item in valid.items():
+        item_date = getattr(item, date_field)
+        if item_date in seen:
+            results[i] = {'index': i, 'date': item_date, 'status': 'duplicate'}
+        else:
+            seen.add(item_date)
+            to_create[i] = item
+            results[i] = {'index': i, 'date': item_date, 'status': 'created'}
+    return to_create
+
+
+def mark_existing(to_create: dict[int, BaseModel], results: dict[int, dict], date_field: str, created_dates) -> None:
+    """The items the insert skipped (ON CONFLICT DO NOTHING) already exist in the database"""
+    created_dates = set(created_dates)
+    for i, item in list(to_create.items()):
+        if getattr(item, date_field) not in created_dates:
+            results[i]['status'] = 'duplicate'
+            del to_create[i]
+
+
+def user_id_of(user_name: str):
+    """The id of the user as a subquery, so the statement itself resolves the user and not another query before it"""
+    return select(User.id).where(User.user_name == user_name).scalar_subquery()
+
+
+def returning_user(model, user_name: str) -> tuple:
+    """The columns of the user for RETURNING, so the route knows who the user is without querying it"""
+    return (model.user_id,
+            select(User.name).where(User.user_name == user_name).scalar_subquery().label('name'),
+            select(User.age).where(User.user_name == user_name).scalar_subquery().label('age'))
+
+
+def insert_for_user(db: Session, model, user_name: str, values: dict, upsert: bool = False):
+    """
+    INSERT ... SELECT FROM users ... ON CONFLICT (user_id, date) RETURNING the user.
+    The user is resolved inside the statement and an existing day is detected by the unique index instead of a SELECT,
+    so it's one round trip. Returns no row if the user doesn't exist or (without upsert) the day already exists.
+    """
+    table = model.__table__
+    select_values = (select(User.id, *[literal(value, table.c[column].type) for column, value in values.items()])
+                     .where(User.user_name == user_name))
+    statement = dialect_insert(db, model).from_select(['user_id', *values], select_values)
+    if upsert:
+        statement = statement.on_conflict_do_update(
+            index_elements=['user_id', 'date'],
+            set_={column: statement.excluded[column] for column in values if column != 'date'})
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=['user_id', 'date'])
+    return statement.returning(*returning_user(model, user_name))
+
+
+def encode_cursor(last_date: date) -> str:
+    return base64.urlsafe_b64encode(last_date.isoformat().encode()).decode()
+
+
+def decode_cursor(value: str) -> date:
+    try:
+        return date.fromisoformat(base64.urlsafe_b64decode(value.encode()).decode())
+    except ValueError:
+        raise ValueError('Invalid cursor, use the next_cursor of the previous page')
+
+
 class FilterParams(BaseModel):
     model_config = {"extra": "forbid"}
     filter_by_date: Annotated[list[date], BeforeValidator(validate_date_list_format)] = Field(
@@ -36,6 +170,90 @@ class FilterParams(BaseModel):
         title='Filter by dates',
         description='List of dates to filter by each one should be in its own query parameter')
     filter_last: Annotated[bool, BeforeValidator(validate_bool)] = Field(default=None, title='Filter by last')
+    from_date: Annotated[date, BeforeValidator(validate_date_format)] = Field(default=None,
+                                                                             title='Only from this date (inclusive)')
+    to_date: Annotated[date, BeforeValidator(validate_date_format)] = Field(default=None,
+                                                                           title='Only until this date (inclusive)')
+    limit: int = Field(default=None, title='The maximum number of days in the page', ge=1, le=1000)
+    cursor: Annotated[date, BeforeValidator(decode_cursor)] = Field(
+        default=None,
+        title='Page cursor',
+        description='The next_cursor of the previous page')
+
+
+def filter_history(select_query, model, query: FilterParams):
+    """
+    Add the date range and the page of the query to a select of a user's history.
+    The page is by date (keyset) and not by offset, so every page is a range scan of the (user_id, date) index
+    """
+    if query.from_date:
+        select_query = select_query.where(model.date >= query.from_date)
+    if query.to_date:
+        select_query = select_query.where(model.date <= query.to_date)
+    if query.filter_last:
+        # already ordered by the last date
+        return select_query
+    if query.cursor:
+        select_query = select_query.where(model.date > query.cursor)
+    select_query = select_query.order_by(model.date)
+    if query.limit:
+        # one more row to know if there is a next page
+        select_query = select_query.limit(query.limit + 1)
+    return select_query
+
+
+def paginate(rows: list, query: FilterParams) -> tuple[list, Union[str, None]]:
+    """The rows of the page and the cursor of the next page (None on the last page)"""
+    if query.filter_last or not query.limit or len(rows) <= query.limit:
+        return rows, None
+    rows = rows[:query.limit]
+    return rows, encode_cursor(rows[-1].date)
+
+
+ExportFormat = Literal['ndjson', 'csv']
+EXPORT_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# the number of rows fetched from the server side cursor and sent to the client at a time
+EXPORT_BATCH_SIZE = 1000
+
+
+def _export_lines(bind, queries: list[tuple[Union[str, None], object]], columns: list[str],
+                  export_format: ExportFormat) -> Iterator[str]:
+    # a session of its own, the one of the request might be closed while the response is still streaming
+    with Session(bind) as db:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+        if export_format == 'csv':
+            writer.writeheader()
+        for domain, select_query in queries:
+            batches = select_query
+            if isinstance(select_query, Select):
+                result = db.execute(select_query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+                batches = result.mappings().partitions()
+            for rows in batches:
+                rows = [{'domain': domain, **row} if domain else dict(row) for row in rows]
+                if export_format == 'csv':
+                    writer.writerows(rows)
+                else:
+                    buffer.writelines(json.dumps(row, default=str) + '\n' for row in rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        # the csv header of an empty export
+        if buffer.tell():
+            yield buffer.getvalue()
+
+
+def stream_export(db: Session, queries: list[tuple[Union[str, None], object]], columns: list[str],
+                  export_format: ExportFormat, filename: str) -> StreamingResponse:
+    """
+    Stream the rows of the queries as NDJSON or CSV.
+    The rows are read from a server side cursor in batches, so the memory doesn't grow with the history of the user.
+    queries are (domain, select) pairs, the domain is added to every row when exporting more than one table.
+    Instead of a select there can be batches of rows that aren't in the database (see archive.export_batches)
+    """
+    return StreamingResponse(_export_lines(db.get_bind(), queries, columns, export_format),
+                             media_type=EXPORT_MEDIA_TYPES[export_format],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}.{export_format}"'})
 
 
 class DeleteParams(BaseModel):
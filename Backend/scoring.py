@@ -0,0 +1,145 @@
+from typing import Union
+
+import numpy as np
+from sqlalchemy import select, Select
+from sqlalchemy.orm import Session
+
+from Backend import cohort_snapshot, ewma, shards
+from Backend.DB import User, ScoreState, replica_as_of
+from Backend.aggregates import DOMAINS
+from Backend.monthly import MISSING_DATA
+from Backend.routers.utilities import get_age_range
+
+"""
+Scoring many users at once. Instead of running get_health_score per user, the weighted averages of all the users are
+read from their score states (kept up to date on every write, see Backend/ewma.py) with one query and the cohort
+baseline is calculated once per age range.
+The results are the same as get_health_score's. score_cohort scores a whole age range this way, which is what ranking a
+user against his peers needs.
+"""
+
+
+def weighted_averages(user_ids: list[int], db: Session,
+                      users_query: Union[Select, None] = None) -> dict[int, dict[str, np.ndarray]]:
+    """
+    The exponential weighted averages of every metric of the users, read from their states (see Backend/ewma.py)
+    returns user id -> domain -> the averages in the order of the metrics, only the domains the user has data in.
+    users_query selects the same ids as user_ids as a subquery, so a whole cohort isn't sent as a huge IN list
+    """
+    rows = db.execute(select(ScoreState.user_id, ScoreState.domain, ScoreState.metric, ScoreState.weighted_total,
+                             ScoreState.weights, ScoreState.missing)
+                      .where(ScoreState.user_id.in_(user_ids if users_query is None else users_query)))
+    averages: dict[int, dict[str, np.ndarray]] = {}
+    for state in rows:
+        metrics = DOMAINS[state.domain][1]
+        domain_averages = averages.setdefault(state.user_id, {})
+        if state.domain not in domain_averages:
+            domain_averages[state.domain] = np.full(len(metrics), np.nan)
+        domain_averages[state.domain][metrics.index(state.metric)] = ewma.weighted_average(state)
+    return averages
+
+
+def user_weighted_averages(user_id: int, db: Session) -> dict[str, np.ndarray]:
+    """The weighted averages of one user, raises the error of the first domain he has no data in"""
+    averages = weighted_averages([user_id], db).get(user_id, {})
+    for domain in DOMAINS:
+        if domain not in averages:
+            raise ValueError(MISSING_DATA[domain])
+    return averages
+
+
+NO_COHORT_DATA = 'No cohort data for this age range'
+
+
+def baseline_of(totals: dict[str, float]) -> np.float64:
+    """The baseline of the cohort totals of every domain"""
+    return np.float64(sum(totals.values())) / 3
+
+
+def cohort_baseline(age_range: range, db: Session) -> np.float64:
+    """The score the user's score is compared to, see get_health_score"""
+    totals = cohort_snapshot.cohort_totals(age_range)
+    if totals is None:
+        totals = shards.cohort_totals(age_range, db)
+    return baseline_of(totals)
+
+
+def score_as_of(db: Session) -> Union[float, None]:
+    """
+    The time the data of a score is known to be complete to, None if it is the latest (see ScoreCache.put). Both the
+    read replica of the session and the cohort snapshot can be behind the writes
+    """
+    times = [as_of for as_of in (replica_as_of(db), cohort_snapshot.built_at()) if as_of is not None]
+    return min(times, default=None)
+
+
+def domain_sums(user_ids: list[int], db: Session,
+                users_query: Union[Select, None] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The sum of the weighted averages of the metrics of every domain of every user (users x domains), and a mask of the
+    domains each user has data in, the same as summing weighted_averages but without a python loop per user
+    """
+    rows = db.execute(select(ScoreState.user_id, ScoreState.domain, ScoreState.weighted_total, ScoreState.weights,
+                             ScoreState.missing)
+                      .where(ScoreState.user_id.in_(user_ids if users_query is None else users_query))).all()
+    index = {user_id: i for i, user_id in enumerate(user_ids)}
+    columns = {domain: i for i, domain in enumerate(DOMAINS)}
+    sums = np.zeros((len(user_ids), len(DOMAINS)))
+    present = np.zeros((len(user_ids), len(DOMAINS)), dtype=bool)
+    if rows:
+        user_ids_column, domains, weighted_totals, weights, missing = zip(*rows)
+        user_rows = np.fromiter((index[user_id] for user_id in user_ids_column), dtype=int, count=len(rows))
+        domain_columns = np.fromiter((columns[domain] for domain in domains), dtype=int, count=len(rows))
+        averages = np.where(np.array(missing) == 0, np.array(weighted_totals) / np.array(weights), np.nan)
+        np.add.at(sums, (user_rows, domain_columns), averages)
+        present[user_rows, domain_columns] = True
+    return sums, present
+
+
+def score_users(users: list[User], db: Session, users_query: Union[Select, None] = None,
+                baselines: Union[dict[range, np.float64], None] = None) -> dict[str, Union[float, str]]:
+    """
+    The health score of every user, or the reason it can't be calculated.
+    baselines are the cohort baselines that were already calculated by their age range, the others are read
+    """
+    sums, present = domain_sums([user.id for user in users], db, users_query)
+    user_scores = sums.sum(axis=1) / 3
+    # keeping the first error like get_health_score
+    first_missing = np.argmin(present, axis=1)
+    domains = list(DOMAINS)
+
+    baselines = dict(baselines or {})
+    scores = {}
+    for i, user in enumerate(users):
+        if not present[i].all():
+            scores[user.user_name] = MISSING_DATA[domains[first_missing[i]]]
+            continue
+        age_range = get_age_range(user.age)
+        if age_range not in baselines:
+            baselines[age_range] = cohort_baseline(age_range, db)
+        if not baselines[age_range]:
+            # nobody in the age range has data, not even the user (get_age_range(50) is range(51, 66))
+            scores[user.user_name] = NO_COHORT_DATA
+            continue
+        scores[user.user_name] = float(100 * (user_scores[i] / baselines[age_range]))
+    return scores
+
+
+def score_cohort(age_range: range, db: Session) -> dict[str, Union[float, str]]:
+    """The health score of every user in the age range in one pass, they all share the same baseline"""
+    cohort = select(User.id).where(User.age >= age_range.start, User.age < age_range.stop)
+    users = list(db.execute(select(User).where(User.id.in_(cohort)).order_by(User.id)).scalars())
+    if not users:
+        return {}
+    return score_users(users, db, cohort)
+
+
+def percentile_rank(score: float, scores: np.ndarray) -> float:
+    """The percentage of the scores below the score, a tie counts as half"""
+    below = np.count_nonzero(scores < score)
+    ties = np.count_nonzero(scores == score)
+    return float(100 * (below + 0.5 * ties) / len(scores))
+
+
+def get_users(user_names: list[str], db: Session) -> list[User]:
+    return list(db.execute(select(User).where(User.user_name.in_(user_names))).scalars())
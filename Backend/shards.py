@@ -0,0 +1,82 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar, Union
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from Backend import DB
+from Backend.aggregates import get_cohort_totals, get_user_means, DOMAINS
+
+"""
+Sharding the users over several databases (DATABASE_SHARD_URLS). A user and all his data, aggregates, monthly rollups
+and states live on the shard of his user_name (see DB.shard_of), so the routes of a user work with one shard like with
+one database. The cohort aggregates of a shard are of its users only, the cohort queries run on every shard and merge
+the partial sums (scatter-gather).
+Without DATABASE_SHARD_URLS there is one shard and these run on the session of the request.
+"""
+
+T = TypeVar('T')
+
+_executor: Union[ThreadPoolExecutor, None] = None
+_executor_threads = 0
+_executor_lock = threading.Lock()
+# set in the threads of a scatter, a scatter inside it runs in the same thread instead of waiting for the pool
+_scattering = threading.local()
+
+
+def _pool() -> ThreadPoolExecutor:
+    # a thread per shard, created on the first scatter since the shards are known only after init_db
+    global _executor, _executor_threads
+    with _executor_lock:
+        if _executor is None or _executor_threads != len(DB.ShardSessions):
+            _executor = ThreadPoolExecutor(max_workers=len(DB.ShardSessions), thread_name_prefix='shard')
+            _executor_threads = len(DB.ShardSessions)
+        return _executor
+
+
+def scatter(db: Session, fetch: Callable[[Session], T]) -> list[T]:
+    """The result of the fetch on every shard, at the same time. The fetches get their own sessions"""
+    if not DB.ShardSessions:
+        return [fetch(db)]
+
+    def run(shard_sessions: Callable) -> T:
+        _scattering.active = True
+        try:
+            with shard_sessions() as session:
+                return fetch(session)
+        finally:
+            _scattering.active = False
+
+    if getattr(_scattering, 'active', False):
+        return [run(shard_sessions) for shard_sessions in DB.ShardSessions]
+    # in the context of the request, so the queries are counted in its metrics
+    futures = [_pool().submit(contextvars.copy_context().run, run, shard_sessions)
+               for shard_sessions in DB.ShardSessions]
+    for future in futures:
+        future.exception()
+    return [future.result() for future in futures]
+
+
+def cohort_totals(age_range: range, db: Session) -> dict[str, float]:
+    """get_cohort_totals of all the shards, the sums of every shard are added up"""
+    totals = {domain: 0.0 for domain in DOMAINS}
+    for shard_totals in scatter(db, lambda session: get_cohort_totals(age_range, session)):
+        for domain, total in shard_totals.items():
+            totals[domain] += total
+    return totals
+
+
+def user_means(domain: str, age_range: range, db: Session) -> tuple[np.ndarray, ...]:
+    """get_user_means of all the shards, the users of every shard one after the other"""
+    shard_means = scatter(db, lambda session: get_user_means(domain, age_range, session))
+    return tuple(np.concatenate(metric_means) for metric_means in zip(*shard_means))
+
+
+def merge(results: list[dict]) -> dict:
+    """The dicts of the shards as one, the keys are by user_name which is on one shard only"""
+    merged = {}
+    for result in results:
+        merged.update(result)
+    return merged
@@ -0,0 +1,74 @@
+"""
+Latency of the cohort part of the health score against the size of physical_activity: the old pandas path (every raw
+row of the age range loaded into a DataFrame and grouped in python), the GROUP BY in the database (COHORT_SOURCE=sql)
+and the maintained aggregates (the default).
+
+    python -m benchmarks.bench_cohort --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from Backend import aggregates
+from Backend.DB import Base, User, PhysicalActivity
+from Backend.routers.utilities import get_age_range
+from benchmarks.bench_indexes import load
+
+AGE_RANGE = get_age_range(30)
+
+
+def pandas_total(db: Session) -> float:
+    # the get_avg_all before the aggregates
+    select_query = select(PhysicalActivity).join(User).where(User.age.in_(AGE_RANGE))
+    physical_activity = pd.read_sql(select_query, db.bind)
+    cols = ['user_id', 'steps', 'cardio_time_session_minutes', 'strength_time_session_minutes']
+    avgs = physical_activity[cols].groupby(['user_id']).mean()
+    return float(np.sum(avgs.values))
+
+
+def measure(db: Session, repeat: int) -> dict[str, tuple[float, float]]:
+    """The mean latency in milliseconds and the result of every path"""
+    paths = {
+        'pandas'    : lambda: pandas_total(db),
+        'sql'       : lambda: aggregates.get_cohort_total('physical', AGE_RANGE, db, source='sql'),
+        'aggregates': lambda: aggregates.get_cohort_total('physical', AGE_RANGE, db, source='aggregates'),
+    }
+    results = {}
+    for name, path in paths.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            total = path()
+        results[name] = ((time.perf_counter() - start) / repeat * 1000, total)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    random.seed(0)
+
+    print(f'{"rows":>10} | {"path":<10} | {"latency (ms)":>12} | {"cohort total":>14}')
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{Path(directory) / "bench.db"}')
+            Base.metadata.create_all(engine)
+            load(engine, size)
+            with Session(engine) as db:
+                aggregates.rebuild(db)
+                results = measure(db, args.repeat)
+            engine.dispose()
+        for name, (latency, total) in results.items():
+            print(f'{size:>10} | {name:<10} | {latency:>12.3f} | {total:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
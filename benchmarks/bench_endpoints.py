@@ -0,0 +1,235 @@
+"""
+Latency and throughput of every route of the routers and of the health score, end to end in process (the requests go
+through the app with its middleware, validation and serialization, only the network is missing).
+The routes run against a copy of a dataset of benchmarks.generate, so the writes never change the dataset, and report
+p50, p95 and p99 in milliseconds and the requests per second of one client. --save keeps the results as a baseline and
+--baseline compares a run to one, the routes whose p95 grew by more than --tolerance are regressions (exit status 1).
+
+    python -m benchmarks.generate --users 1000 --days 365 --output bench.db
+    python -m benchmarks.bench_endpoints --database bench.db --save baseline.json
+    python -m benchmarks.bench_endpoints --database bench.db --baseline baseline.json
+
+Without --database a small dataset is generated for the run. The admin, metrics and debug routes are not measured.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Callable, NamedTuple, Union
+
+import numpy as np
+from sqlalchemy import create_engine, select, func
+
+from Backend.DB import User, PhysicalActivity
+from benchmarks.generate import START_DATE, end_date, generate, user_name
+
+
+class Dataset(NamedTuple):
+    users: int
+    days: int
+
+
+class Call(NamedTuple):
+    method: str
+    url: str
+    json: Union[dict, list, None] = None
+
+
+class Scenario(NamedTuple):
+    name: str
+    # the call of the i-th request
+    call: Callable[[int], Call]
+    # run before every request and not measured
+    before: Union[Callable[[], None], None] = None
+
+
+DOMAINS = {
+    'physical': ('session_date', lambda rng: {'steps': rng.randint(0, 20000),
+                                              'cardio_time_session_minutes': rng.randint(0, 90),
+                                              'strength_time_session_minutes': rng.randint(0, 60)}),
+    'sleep'   : ('sleep_date', lambda rng: {'sleep_hours': round(rng.uniform(4, 10), 1),
+                                            'avg_heart_rate': round(rng.uniform(45, 80), 1),
+                                            'avg_oxygen_level': round(rng.uniform(92, 100), 1)}),
+    'blood'   : ('test_date', lambda rng: {'RBC': round(rng.uniform(4, 6), 2), 'WBC': round(rng.uniform(4, 11), 2),
+                                           'glucose_level': rng.randint(70, 140),
+                                           'cholesterol_level': rng.randint(120, 260),
+                                           'triglycerides_level': rng.randint(50, 250)}),
+}
+
+
+def scenarios(dataset: Dataset, seed: int) -> list[Scenario]:
+    """The requests of every route, reads first and the writes after them. The deletes delete what the creates wrote"""
+    from Backend.cache import score_cache
+
+    rng = random.Random(seed)
+
+    def random_user(i: int) -> str:
+        return user_name(rng.randint(1, dataset.users))
+
+    def random_day() -> date:
+        return START_DATE + timedelta(days=rng.randrange(dataset.days))
+
+    def pair(i: int) -> tuple[str, date]:
+        # the i-th (user, day) of the dataset, every request of a scenario gets another one
+        return user_name(i % dataset.users + 1), START_DATE + timedelta(days=i // dataset.users % dataset.days)
+
+    def new_day(i: int) -> date:
+        # the days after the dataset, the creates don't collide with it or with each other
+        return end_date(dataset.days) + timedelta(days=i)
+
+    result = [
+        Scenario('GET /users/{user_name}', lambda i: Call('GET', f'/users/{random_user(i)}')),
+        Scenario('GET /users/{user_name}/export', lambda i: Call('GET', f'/users/{random_user(i)}/export')),
+    ]
+    for domain in DOMAINS:
+        result += [
+            Scenario(f'GET /{domain}/{{user_name}}', lambda i, d=domain: Call('GET', f'/{d}/{random_user(i)}')),
+            Scenario(f'GET /{domain}/{{user_name}} (last 30 days)', lambda i, d=domain: Call(
+                'GET', f'/{d}/{random_user(i)}?from_date={end_date(dataset.days) - timedelta(days=30)}')),
+            Scenario(f'GET /{domain}/{{user_name}}/export',
+                     lambda i, d=domain: Call('GET', f'/{d}/{random_user(i)}/export')),
+        ]
+    result += [
+        Scenario('GET /get_health_score/{user_name}', lambda i: Call('GET', f'/get_health_score/{random_user(i)}'),
+                 before=score_cache.clear),
+        # the warmup caches the score
+        Scenario('GET /get_health_score/{user_name} (cached)',
+                 lambda i: Call('GET', f'/get_health_score/{user_name(1)}')),
+        Scenario('POST /get_health_score/batch', lambda i: Call('POST', '/get_health_score/batch', {
+            'user_names': [random_user(i) for _ in range(50)]}), before=score_cache.clear),
+        Scenario('GET /get_health_score/{user_name}/percentile',
+                 lambda i: Call('GET', f'/get_health_score/{random_user(i)}/percentile'), before=score_cache.clear),
+    ]
+    for domain, (date_field, values) in DOMAINS.items():
+        result += [
+            Scenario(f'POST /{domain}/{{user_name}}', lambda i, d=domain, f=date_field, v=values: Call(
+                'POST', f'/{d}/{random_user(i)}', {**v(rng), f: str(new_day(i))})),
+            Scenario(f'POST /{domain}/{{user_name}}/bulk', lambda i, d=domain, f=date_field, v=values: Call(
+                'POST', f'/{d}/{user_name(i % dataset.users + 1)}/bulk',
+                [{**v(rng), f: str(new_day(10_000 + 30 * (i // dataset.users) + day))} for day in range(30)])),
+            Scenario(f'PUT /{domain}/{{user_name}}', lambda i, d=domain, f=date_field, v=values: Call(
+                'PUT', f'/{d}/{random_user(i)}', {**v(rng), f: str(random_day())})),
+            Scenario(f'DELETE /{domain}/{{user_name}}', lambda i, d=domain: Call(
+                'DELETE', f'/{d}/{pair(i)[0]}?delete_dates={pair(i)[1]}')),
+        ]
+    result += [
+        Scenario('POST /users/', lambda i: Call('POST', '/users/', {'user_name': f'new_{i}', 'name': f'New {i}',
+                                                                     'age': 18 + i % 60})),
+        Scenario('PUT /users/{user_name}', lambda i: Call('PUT', f'/users/{random_user(i)}', {'name': f'Renamed {i}'})),
+        Scenario('DELETE /users/{user_name}', lambda i: Call('DELETE', f'/users/new_{i}')),
+    ]
+    return result
+
+
+def measure(client, scenario: Scenario, requests: int, warmup: int) -> dict[str, float]:
+    """The latency percentiles in milliseconds and the throughput of the scenario, the warmup requests don't count"""
+    latencies = []
+    for i in range(warmup + requests):
+        if scenario.before:
+            scenario.before()
+        call = scenario.call(i)
+        start = time.perf_counter()
+        response = client.request(call.method, call.url, json=call.json)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f'{scenario.name}: {call.method} {call.url} returned {response.status_code} '
+                               f'{response.text[:200]}')
+        if i >= warmup:
+            latencies.append(elapsed)
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'throughput': len(latencies) / sum(latencies), 'requests': len(latencies)}
+
+
+def dataset_of(path: Path) -> Dataset:
+    engine = create_engine(f'sqlite:///{path}')
+    with engine.connect() as connection:
+        users = connection.execute(select(func.count()).select_from(User)).scalar_one()
+        days = connection.execute(select(func.count(func.distinct(PhysicalActivity.date)))).scalar_one()
+    engine.dispose()
+    return Dataset(users, days)
+
+
+def run(database: Path, requests: int, warmup: int, seed: int, only: Union[str, None] = None) -> dict:
+    """Run the scenarios against a copy of the database, returns the results by the name of the scenario"""
+    dataset = dataset_of(database)
+    with tempfile.TemporaryDirectory() as directory:
+        copy = Path(directory) / 'bench.db'
+        shutil.copy(database, copy)
+        os.environ['DATABASE_URL'] = f'sqlite:///{copy}'
+        # imported after DATABASE_URL is set, the app reads its configuration when it starts
+        from fastapi.testclient import TestClient
+        from Backend.main import app
+
+        results = {}
+        with TestClient(app) as client:
+            for scenario in scenarios(dataset, seed):
+                if only and only not in scenario.name:
+                    continue
+                results[scenario.name] = measure(client, scenario, requests, warmup)
+                print(f'{scenario.name:<50} | {results[scenario.name]["p50"]:>8.2f} | '
+                      f'{results[scenario.name]["p95"]:>8.2f} | {results[scenario.name]["p99"]:>8.2f} | '
+                      f'{results[scenario.name]["throughput"]:>8.1f}', flush=True)
+    return {'dataset': dataset._asdict(), 'requests': requests, 'results': results}
+
+
+def compare(run_results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print the change of every route against the baseline, returns the routes whose p95 regressed"""
+    if run_results['dataset'] != baseline['dataset']:
+        print(f'Warning: the baseline is of another dataset {baseline["dataset"]}, not {run_results["dataset"]}')
+    print(f'\n{"route":<50} | {"p95 base":>8} | {"p95 now":>8} | {"change":>7}')
+    regressions = []
+    for name, result in run_results['results'].items():
+        if name not in baseline['results']:
+            print(f'{name:<50} | {"-":>8} | {result["p95"]:>8.2f} | {"new":>7}')
+            continue
+        before = baseline['results'][name]['p95']
+        change = result['p95'] / before - 1 if before else 0.0
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<50} | {before:>8.2f} | {result["p95"]:>8.2f} | {change:>+7.1%}' +
+              (' REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', type=Path, help='a dataset of benchmarks.generate')
+    parser.add_argument('--users', type=int, default=100, help='the users of the generated dataset without --database')
+    parser.add_argument('--days', type=int, default=90, help='the days of the generated dataset without --database')
+    parser.add_argument('--requests', type=int, default=100, help='the measured requests of every route')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='only the routes whose name contains this')
+    parser.add_argument('--save', type=Path, help='save the results as a baseline')
+    parser.add_argument('--baseline', type=Path, help='compare the results to a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='the growth of p95 that is a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = args.database
+        if database is None:
+            database = Path(directory) / 'generated.db'
+            print(f'Generating {args.users} users x {args.days} days')
+            generate(database, args.users, args.days, args.seed)
+        print(f'{"route":<50} | {"p50 (ms)":>8} | {"p95 (ms)":>8} | {"p99 (ms)":>8} | {"req/s":>8}')
+        results = run(database, args.requests, args.warmup, args.seed, args.only)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} routes regressed by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
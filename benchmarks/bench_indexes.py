@@ -0,0 +1,85 @@
+"""
+Lookup latency of the routes' queries against the size of physical_activity, with and without the (user_id, date)
+index added by migration 2.
+
+    python -m benchmarks.bench_indexes --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert, select, and_, Engine
+
+from Backend.DB import Base, User, PhysicalActivity
+
+DAYS_PER_USER = 365
+
+
+def load(engine: Engine, rows: int) -> int:
+    users = max(rows // DAYS_PER_USER, 1)
+    start = date(2023, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'id': i, 'user_name': f'user_{i}', 'name': f'User {i}', 'age': 20 + i % 60}
+                                          for i in range(1, users + 1)])
+        batch = []
+        for i in range(rows):
+            batch.append({'user_id': i % users + 1, 'steps': random.randint(0, 20000),
+                          'cardio_time_session_minutes': 30, 'strength_time_session_minutes': 20,
+                          'date': start + timedelta(days=i // users)})
+            if len(batch) == 10000:
+                connection.execute(insert(PhysicalActivity), batch)
+                batch = []
+        if batch:
+            connection.execute(insert(PhysicalActivity), batch)
+    return users
+
+
+def measure(engine: Engine, users: int, repeat: int) -> dict[str, float]:
+    """The mean latency in milliseconds of the queries the routes run"""
+    queries = {
+        'one day (create/update)': lambda user_id: select(PhysicalActivity).where(
+            and_(PhysicalActivity.user_id == user_id, PhysicalActivity.date == date(2023, 6, 1))),
+        'last day (filter_last)' : lambda user_id: select(PhysicalActivity).where(
+            PhysicalActivity.user_id == user_id).order_by(PhysicalActivity.date.desc()).limit(1),
+        'history (get_*)'        : lambda user_id: select(PhysicalActivity).where(PhysicalActivity.user_id == user_id),
+    }
+    results = {}
+    with engine.connect() as connection:
+        for name, query in queries.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(query(random.randint(1, users))).all()
+            results[name] = (time.perf_counter() - start) / repeat * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    random.seed(0)
+
+    print(f'{"rows":>10} | {"query":<24} | {"no index (ms)":>13} | {"index (ms)":>10}')
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{Path(directory) / "bench.db"}')
+            Base.metadata.create_all(engine)
+            indexes = list(PhysicalActivity.__table__.indexes)
+            for index in indexes:
+                index.drop(engine)
+            users = load(engine, size)
+            without_index = measure(engine, users, args.repeat)
+            for index in indexes:
+                index.create(engine)
+            with_index = measure(engine, users, args.repeat)
+            engine.dispose()
+        for name in without_index:
+            print(f'{size:>10} | {name:<24} | {without_index[name]:>13.3f} | {with_index[name]:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
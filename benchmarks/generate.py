@@ -0,0 +1,97 @@
+"""
+A synthetic dataset for the benchmarks: users x days of physical, sleep and blood data bulk loaded into a file
+database with the schema of the migrations and all the aggregates rebuilt, like a database the routes wrote.
+The same arguments always generate the same data (the values come from a random generator seeded with --seed).
+
+    python -m benchmarks.generate --users 1000 --days 365 --output bench.db
+"""
+import argparse
+import random
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Iterator
+
+from sqlalchemy import create_engine, insert, Engine
+from sqlalchemy.orm import Session
+
+from Backend import aggregates
+from Backend.DB import User, PhysicalActivity, SleepActivity, BloodTest
+from Backend.migrations import upgrade
+
+START_DATE = date(2023, 1, 1)
+BATCH_SIZE = 10000
+
+
+def user_name(i: int) -> str:
+    return f'user_{i}'
+
+
+def end_date(days: int) -> date:
+    """The day after the last generated day"""
+    return START_DATE + timedelta(days=days)
+
+
+def _rows(users: int, days: int, seed: int) -> Iterator[tuple[type, dict]]:
+    rng = random.Random(seed)
+    for day in range(days):
+        current = START_DATE + timedelta(days=day)
+        for user_id in range(1, users + 1):
+            yield PhysicalActivity, {'user_id': user_id, 'date': current, 'steps': rng.randint(0, 20000),
+                                     'cardio_time_session_minutes': rng.randint(0, 90),
+                                     'strength_time_session_minutes': rng.randint(0, 60)}
+            yield SleepActivity, {'user_id': user_id, 'date': current, 'sleep_hours': round(rng.uniform(4, 10), 1),
+                                  'avg_heart_rate': round(rng.uniform(45, 80), 1),
+                                  'avg_oxygen_level': round(rng.uniform(92, 100), 1)}
+            yield BloodTest, {'user_id': user_id, 'date': current, 'RBC': round(rng.uniform(4, 6), 2),
+                              'WBC': round(rng.uniform(4, 11), 2), 'glucose_level': rng.randint(70, 140),
+                              'cholesterol_level': rng.randint(120, 260),
+                              'triglycerides_level': rng.randint(50, 250)}
+
+
+def load(engine: Engine, users: int, days: int, seed: int = 0) -> None:
+    """Create the schema and load the users and their days into an empty database"""
+    upgrade(engine)
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'id': i, 'user_name': user_name(i), 'name': f'User {i}',
+                                           'age': rng.randint(18, 80)} for i in range(1, users + 1)])
+        batches: dict[type, list[dict]] = {PhysicalActivity: [], SleepActivity: [], BloodTest: []}
+        for model, row in _rows(users, days, seed):
+            batch = batches[model]
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                connection.execute(insert(model), batch)
+                batch.clear()
+        for model, batch in batches.items():
+            if batch:
+                connection.execute(insert(model), batch)
+    with Session(engine) as db:
+        aggregates.rebuild(db)
+
+
+def generate(path: Path, users: int, days: int, seed: int = 0) -> None:
+    if path.exists():
+        raise FileExistsError(f'{path} already exists, the dataset is loaded into a new database')
+    engine = create_engine(f'sqlite:///{path}')
+    try:
+        load(engine, users, days, seed)
+    finally:
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, default=Path('bench.db'))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.output, args.users, args.days, args.seed)
+    print(f'Generated {args.users} users x {args.days} days into {args.output} in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
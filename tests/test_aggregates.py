@@ -0,0 +1,182 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select, delete, insert, create_engine, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from Backend import aggregates
+from Backend.DB import User, PhysicalActivity, UserAggregate, CohortAggregate, MonthlyAggregate
+from Backend.migrations import upgrade
+from Backend.routers.physical import get_avg_all
+from tests.test_setup import client, create_test_user, engine, override_get_db, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def post_physical(user_name: str, steps: int, session_date: str):
+    return client.post(f'/physical/{user_name}', json={
+        'steps'                        : steps,
+        'cardio_time_session_minutes'  : 30,
+        'strength_time_session_minutes': 20,
+        'session_date'                 : session_date
+    })
+
+
+def test_get_avg_all_follows_create_update_and_delete():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    user1 = create_test_user('jane_doe', 'Jane Doe', 31)
+    post_physical(user.user_name, 1000, '2023-10-01')
+    post_physical(user.user_name, 3000, '2023-10-02')
+    post_physical(user1.user_name, 5000, '2023-10-01')
+    steps, cardio, strength = get_avg_all(range(25, 36), db)
+    assert list(steps) == [2000, 5000]
+
+    client.put(f'/physical/{user.user_name}', json={'steps': 2000, 'session_date': '2023-10-02'})
+    client.delete(f'/physical/{user1.user_name}?delete_all=true')
+    steps, cardio, strength = get_avg_all(range(25, 36), db)
+    assert list(steps) == [1500]
+    assert aggregates.get_cohort_total('physical', range(25, 36), db) == 1500 + 30 + 20
+
+
+def test_cohort_total_follows_user_age_and_deletion():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    post_physical(user.user_name, 1000, '2023-10-01')
+    assert aggregates.get_cohort_total('physical', range(25, 36), db) == 1050
+
+    client.put(f'/users/{user.user_name}', json={'age': 40})
+    assert aggregates.get_cohort_total('physical', range(25, 36), db) == 0
+    assert aggregates.get_cohort_total('physical', range(36, 50), db) == 1050
+
+    client.delete(f'/users/{user.user_name}')
+    assert aggregates.get_cohort_total('physical', range(36, 50), db) == 0
+    assert db.execute(select(UserAggregate)).first() is None
+
+
+def test_moving_and_dropping_a_user_lock_his_row():
+    user = create_test_user('john_doe', 'John Doe', 30)
+    post_physical(user.user_name, 1000, '2023-10-01')
+    locks = []
+
+    def listener(conn, clause, *args):
+        if getattr(clause, 'is_select', False) and 'FOR UPDATE' in str(clause.compile(dialect=postgresql.dialect())):
+            locks.append(clause)
+
+    event.listen(engine, 'before_execute', listener)
+    try:
+        client.put(f'/users/{user.user_name}', json={'age': 40})
+        assert len(locks) == 1
+        client.delete(f'/users/{user.user_name}')
+        assert len(locks) == 2
+    finally:
+        event.remove(engine, 'before_execute', listener)
+
+
+def test_rebuild_aggregates():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    post_physical(user.user_name, 1000, '2023-10-01')
+    post_physical(user.user_name, 2000, '2023-10-02')
+    expected = get_avg_all(range(25, 36), db)
+    db.execute(delete(UserAggregate))
+    db.execute(delete(CohortAggregate))
+    db.commit()
+
+    response = client.post('/admin/rebuild_aggregates')
+    assert response.status_code == 200
+    assert response.json()['users']['physical'] == 1
+    np.testing.assert_array_equal(get_avg_all(range(25, 36), db), expected)
+    assert aggregates.get_cohort_total('physical', range(25, 36), db) == 1500 + 30 + 20
+
+
+def test_sql_source_matches_the_aggregates():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    user1 = create_test_user('jane_doe', 'Jane Doe', 31)
+    post_physical(user.user_name, 1000, '2023-10-01')
+    post_physical(user.user_name, 3000, '2023-10-02')
+    post_physical(user1.user_name, 5000, '2023-10-01')
+    for expected, actual in zip(aggregates.get_user_means('physical', range(25, 36), db, source='aggregates'),
+                                aggregates.get_user_means('physical', range(25, 36), db, source='sql')):
+        np.testing.assert_array_equal(expected, actual)
+    assert aggregates.get_cohort_total('physical', range(25, 36), db, source='sql') == 2000 + 5000 + 2 * (30 + 20)
+    assert (aggregates.get_cohort_total('physical', range(25, 36), db, source='sql') ==
+            aggregates.get_cohort_total('physical', range(25, 36), db, source='aggregates'))
+    assert aggregates.get_cohort_total('physical', range(50, 60), db, source='sql') == 0
+
+
+def monthly_rollups(db, metric='steps'):
+    return [(row.month, row.count, row.total, row.total_squares) for row in db.execute(
+        select(MonthlyAggregate).where(MonthlyAggregate.metric == metric).order_by(MonthlyAggregate.month)).scalars()]
+
+
+def test_monthly_rollups_follow_the_writes():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    post_physical(user.user_name, 1000, '2023-09-30')
+    post_physical(user.user_name, 2000, '2023-10-01')
+    post_physical(user.user_name, 3000, '2023-10-31')
+    assert monthly_rollups(db) == [(202309, 1, 1000, 1000 ** 2), (202310, 2, 5000, 2000 ** 2 + 3000 ** 2)]
+
+    client.put(f'/physical/{user.user_name}', json={'steps': 4000, 'session_date': '2023-10-31'})
+    client.delete(f'/physical/{user.user_name}?delete_dates=2023-09-30')
+    assert monthly_rollups(db) == [(202310, 2, 6000, 2000 ** 2 + 4000 ** 2)]
+    assert db.execute(select(UserAggregate.total, UserAggregate.count)
+                      .where(UserAggregate.metric == 'steps')).one() == (6000, 2)
+
+    client.delete(f'/physical/{user.user_name}?delete_all=true')
+    assert monthly_rollups(db) == []
+    assert db.execute(select(UserAggregate)).first() is None
+
+
+def test_rebuild_monthly_rollups():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000, 'cardio_time_session_minutes': 30, 'session_date': '2023-09-30'},
+        {'steps': 2000, 'session_date': '2023-10-01'},
+    ])
+    expected = monthly_rollups(db), monthly_rollups(db, 'cardio_time_session_minutes')
+    assert expected[1] == [(202309, 1, 30, 900), (202310, 1, 0, 0)]
+    db.execute(delete(MonthlyAggregate))
+    db.commit()
+
+    assert client.post('/admin/rebuild_aggregates').status_code == 200
+    assert (monthly_rollups(db), monthly_rollups(db, 'cardio_time_session_minutes')) == expected
+
+
+def test_concurrent_writes_of_the_same_user_and_month(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "concurrent.db"}')
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'id': 1, 'user_name': 'john_doe', 'name': 'John Doe', 'age': 30}])
+    statements = []
+    event.listen(engine, 'before_execute', lambda conn, clause, *args: statements.append(clause))
+    start = threading.Barrier(2)
+
+    def write(day: int) -> None:
+        with Session(engine) as db:
+            start.wait()
+            db.execute(insert(PhysicalActivity).values(user_id=1, date=date(2023, 10, day), steps=1000 * day,
+                                                       cardio_time_session_minutes=30,
+                                                       strength_time_session_minutes=20))
+            aggregates.refresh_user(db, 'physical', 1, 30, [date(2023, 10, day)])
+            db.commit()
+
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(write, (1, 2)))
+
+    with Session(engine) as db:
+        assert monthly_rollups(db) == [(202310, 2, 3000, 1000 ** 2 + 2000 ** 2)]
+        assert db.execute(select(UserAggregate.total, UserAggregate.count)
+                          .where(UserAggregate.metric == 'steps')).one() == (3000, 2)
+        assert db.execute(select(CohortAggregate.total, CohortAggregate.users)
+                          .where(CohortAggregate.metric == 'steps')).one() == (1500, 1)
+    # the writers of the user wait for each other on his row (FOR UPDATE isn't rendered by sqlite)
+    assert any('FOR UPDATE' in str(clause.compile(dialect=postgresql.dialect()))
+               for clause in statements if getattr(clause, 'is_select', False))
+    engine.dispose()
@@ -0,0 +1,136 @@
+import json
+from datetime import date
+
+import pytest
+from sqlalchemy import select, func
+
+from Backend import archive
+from Backend.DB import PhysicalActivity, MonthlyAggregate
+from Backend.routers.physical import get_avg_monthly
+from tests.test_monthly import post_physical, post_sleep, post_blood
+from tests.test_setup import client, create_test_user, TestingSessionLocal, setup_and_teardown
+
+a = setup_and_teardown
+
+DAYS = ['2022-01-10', '2022-01-20', '2022-02-10', '2023-03-10', '2023-04-10']
+CUTOFF = date(2023, 1, 1)
+
+
+@pytest.fixture
+def archived(tmp_path):
+    """A user with two archived months and two months in the tables"""
+    archive.configure(tmp_path)
+    user = create_test_user('archived', 'Archived', 30)
+    for i, day in enumerate(DAYS):
+        post_physical(user.user_name, 1000 * (i + 1), day)
+        post_sleep(user.user_name, 6 + i, day)
+        post_blood(user.user_name, 4 + i / 10, day)
+    before = {'health_score': client.get(f'/get_health_score/{user.user_name}').json()['health_score'],
+              'physical': client.get(f'/physical/{user.user_name}').json()['physical_data']}
+    with TestingSessionLocal() as db:
+        before['monthly'] = get_avg_monthly(user.user_name, db)
+        assert archive.archive(db, CUTOFF) == {'physical': 3, 'sleep': 3, 'blood': 3}
+    yield user, before
+    archive.configure(None)
+
+
+def assert_monthly(actual: tuple, expected: tuple) -> None:
+    for actual_means, expected_means in zip(actual, expected, strict=True):
+        assert list(actual_means) == pytest.approx(list(expected_means))
+
+
+def count_rows() -> int:
+    with TestingSessionLocal() as db:
+        return db.execute(select(func.count()).select_from(PhysicalActivity)).scalar_one()
+
+
+def test_archive_moves_the_old_rows(archived, tmp_path):
+    user, before = archived
+    assert count_rows() == 2
+    assert archive.archived_until() == CUTOFF
+    assert json.loads((tmp_path / 'manifest.json').read_text()) == {'cutoff': '2023-01-01'}
+    assert archive.archived_dates('physical', user.user_name) == [date.fromisoformat(day) for day in DAYS[:3]]
+    # the history is the same as before
+    assert client.get(f'/physical/{user.user_name}').json()['physical_data'] == before['physical']
+
+
+def test_history_filters_the_archive(archived):
+    user, _ = archived
+    response = client.get(f'/physical/{user.user_name}?from_date=2022-01-15&to_date=2023-03-31').json()
+    assert [row['date'] for row in response['physical_data']] == ['2022-01-20', '2022-02-10', '2023-03-10']
+    response = client.get(f'/sleep/{user.user_name}?filter_by_date=2022-02-10&filter_by_date=2023-04-10').json()
+    assert [row['date'] for row in response['sleep activity']] == ['2022-02-10', '2023-04-10']
+    response = client.get(f'/blood/{user.user_name}?filter_last=true').json()
+    assert [row['date'] for row in response['blood_tests']] == ['2023-04-10']
+
+
+def test_history_pages_through_the_archive(archived):
+    user, _ = archived
+    dates, cursor = [], None
+    while True:
+        url = f'/physical/{user.user_name}?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url).json()
+        dates += [row['date'] for row in response['physical_data']]
+        cursor = response['next_cursor']
+        if not cursor:
+            break
+    assert dates == DAYS
+
+
+def test_export_includes_the_archive(archived):
+    user, _ = archived
+    lines = client.get(f'/physical/{user.user_name}/export').text.splitlines()
+    assert [json.loads(line)['date'] for line in lines] == DAYS
+    lines = client.get(f'/users/{user.user_name}/export').text.splitlines()
+    assert sum(json.loads(line)['domain'] == 'blood' for line in lines) == len(DAYS)
+
+
+def test_aggregates_are_unchanged(archived):
+    user, before = archived
+    assert client.get(f'/get_health_score/{user.user_name}').json()['health_score'] == \
+           pytest.approx(before['health_score'])
+    with TestingSessionLocal() as db:
+        assert_monthly(get_avg_monthly(user.user_name, db), before['monthly'])
+
+
+def test_archived_days_are_read_only(archived):
+    user, _ = archived
+    assert post_physical(user.user_name, 1, '2022-03-01').status_code == 400
+    response = client.put(f'/physical/{user.user_name}', json={'session_date': '2022-01-10', 'steps': 1})
+    assert response.status_code == 400
+    assert client.delete(f'/physical/{user.user_name}?delete_dates=2022-01-10').status_code == 400
+    response = client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1, 'cardio_time_session_minutes': 1, 'strength_time_session_minutes': 1, 'session_date': day}
+        for day in ('2022-03-01', '2023-05-01')]).json()
+    assert [result['status'] for result in response['results']] == ['archived', 'created']
+
+
+def test_delete_all_deletes_the_archive(archived):
+    user, _ = archived
+    assert client.delete(f'/physical/{user.user_name}?delete_all=true').status_code == 200
+    assert archive.archived_dates('physical', user.user_name) == []
+    assert client.get(f'/physical/{user.user_name}').status_code == 404
+    with TestingSessionLocal() as db:
+        assert not db.execute(select(MonthlyAggregate).where(MonthlyAggregate.domain == 'physical')).all()
+    # nothing is left to delete
+    assert client.delete(f'/physical/{user.user_name}?delete_all=true').status_code == 404
+
+
+def test_delete_user_deletes_the_archive(archived):
+    user, _ = archived
+    assert client.delete(f'/users/{user.user_name}').status_code == 200
+    assert all(archive.read(domain, user.user_name) is None for domain in ('physical', 'sleep', 'blood'))
+
+
+def test_rebuild_keeps_the_archived_months(archived):
+    user, before = archived
+    assert client.post('/admin/rebuild_aggregates').status_code == 200
+    assert client.get(f'/get_health_score/{user.user_name}').json()['health_score'] == \
+           pytest.approx(before['health_score'])
+    with TestingSessionLocal() as db:
+        assert_monthly(get_avg_monthly(user.user_name, db), before['monthly'])
+
+
+def test_horizon_cutoff():
+    assert archive.horizon_cutoff(24, date(2024, 3, 15)) == date(2022, 3, 1)
+    assert archive.horizon_cutoff(2, date(2024, 1, 31)) == date(2023, 11, 1)
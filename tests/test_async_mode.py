@@ -0,0 +1,135 @@
+import asyncio
+import threading
+from datetime import date
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.util.concurrency import greenlet_spawn
+
+from Backend import main, archive
+from Backend.DB import get_db, get_read_db, get_async_db, get_async_read_db, async_url
+from Backend.async_routes import asyncify, blocking
+from Backend.cache import score_cache, user_cache
+from Backend.routers import user, physical, blood, sleep, admin
+from tests.test_recompute import database_url
+
+a = database_url
+ROUTERS = (user.router, physical.router, blood.router, sleep.router, admin.router, main.scores)
+
+
+@pytest.fixture
+def async_app(database_url):
+    """An app in the async mode on the database of the recompute tests"""
+    app = FastAPI()
+    for router in ROUTERS:
+        app.include_router(asyncify(router))
+
+    engine = create_engine(database_url)
+    async_engine = create_async_engine(async_url(database_url))
+    SyncSession = sessionmaker(autoflush=False, bind=engine)
+    AsyncSession = async_sessionmaker(async_engine, autoflush=False)
+
+    def override_get_db():
+        with SyncSession() as db:
+            yield db
+
+    async def override_get_async_db():
+        async with AsyncSession() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    app.dependency_overrides[get_async_read_db] = override_get_async_db
+    yield app
+    score_cache.clear()
+    user_cache.clear()
+    engine.dispose()
+
+
+def test_async_url():
+    assert async_url('sqlite:///health.db') == 'sqlite+aiosqlite:///health.db'
+    assert async_url('postgresql://user:password@db/health') == 'postgresql+asyncpg://user:password@db/health'
+    assert async_url('postgresql+psycopg://db/health') == 'postgresql+psycopg://db/health'
+    # the explicit sync drivers are replaced
+    assert async_url('postgresql+psycopg2://db/health') == 'postgresql+asyncpg://db/health'
+    assert async_url('sqlite+pysqlite:///health.db') == 'sqlite+aiosqlite:///health.db'
+    assert async_url('postgresql+asyncpg://db/health') == 'postgresql+asyncpg://db/health'
+    with pytest.raises(ValueError):
+        async_url('mysql+pymysql://db/health')
+
+
+def test_blocking_calls_leave_the_event_loop():
+    async def threads() -> tuple[int, int]:
+        # a handler of the async mode runs in a greenlet of run_sync on the thread of the loop
+        return threading.get_ident(), await greenlet_spawn(blocking, threading.get_ident)
+
+    loop_thread, call_thread = asyncio.run(threads())
+    assert loop_thread != call_thread
+    assert blocking(threading.get_ident) == threading.get_ident()
+
+
+def test_only_the_light_routes_are_async():
+    handlers = {route.name: route.endpoint for router in ROUTERS for route in asyncify(router).routes}
+    for name in ('create_user', 'get_user_endpoint', 'create_physical', 'get_sleep_activities', 'update_blood_test',
+                 'delete_physical', 'get_health_score'):
+        assert asyncio.iscoroutinefunction(handlers[name]), name
+    for name in ('export_user_data', 'export_physical_data', 'get_health_score_batch', 'get_health_score_percentile',
+                 'rebuild_aggregates', 'score_cache_stats'):
+        assert not asyncio.iscoroutinefunction(handlers[name]), name
+
+
+def test_crud_in_async_mode(async_app):
+    client = TestClient(async_app)
+    response = client.post('/users/', json={'user_name': 'async_user', 'name': 'Async', 'age': 30})
+    assert response.status_code == 200
+    assert client.get('/users/async_user').json() == {'user_name': 'async_user', 'name': 'Async', 'age': 30}
+
+    physical_data = {'steps': 5000, 'cardio_time_session_minutes': 30, 'strength_time_session_minutes': 10,
+                     'session_date': '2023-01-05'}
+    assert client.post('/physical/async_user', json=physical_data).status_code == 200
+    assert client.post('/physical/async_user', json=physical_data).status_code == 400
+    assert client.put('/physical/async_user', json={'steps': 6000, 'session_date': '2023-01-05'}).status_code == 200
+    rows = client.get('/physical/async_user').json()['physical_data']
+    assert [row['steps'] for row in rows] == [6000]
+
+    assert client.delete('/users/async_user').status_code == 200
+    assert client.get('/users/async_user').status_code == 404
+    assert client.post('/physical/async_user', json=physical_data).status_code == 404
+
+
+def test_health_score_is_the_same_in_async_mode(async_app, database_url):
+    with Session(create_engine(database_url)) as db:
+        expected = main.get_health_score('user_4', db)['health_score']
+    score_cache.clear()
+    user_cache.clear()
+
+    response = TestClient(async_app).get('/get_health_score/user_4')
+    assert response.status_code == 200
+    assert response.json()['health_score'] == pytest.approx(expected)
+    assert score_cache.stats()['hits'] == 0
+    assert TestClient(async_app).get('/get_health_score/user_9').status_code == 404
+
+
+def test_sync_only_routes_in_async_mode(async_app):
+    client = TestClient(async_app)
+    response = client.get('/users/user_4/export', params={'format': 'csv'})
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 1 + 9
+    percentile = client.get('/get_health_score/user_4/percentile').json()
+    assert 0 <= percentile['percentile'] <= 100
+
+
+def test_archived_history_in_async_mode(async_app, database_url, tmp_path):
+    archive.configure(tmp_path)
+    try:
+        with Session(create_engine(database_url)) as db:
+            assert archive.archive(db, date(2023, 2, 1))['physical'] == 8
+        response = TestClient(async_app).get('/physical/user_1')
+        assert [row['date'] for row in response.json()['physical_data']] == ['2023-01-01', '2023-02-01', '2023-03-01']
+    finally:
+        archive.configure(None)
@@ -284,6 +284,26 @@ def test_update_blood_test_with_no_data_returns_404():
     assert response.json()['detail'] == 'No blood test found for this date'
 
 
+def test_update_blood_with_only_the_date_returns_400():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    # a day that doesn't exist
+    response = client.put(f'/blood/{user.user_name}', json={'test_date': '2023-10-01'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'No fields to update'
+
+    client.post(f'/blood/{user.user_name}', json={
+        'RBC'                : 5.0,
+        'WBC'                : 7.0,
+        'glucose_level'      : 95,
+        'cholesterol_level'  : 185,
+        'triglycerides_level': 155,
+        'test_date'          : '2023-10-01'
+    })
+    response = client.put(f'/blood/{user.user_name}', json={'test_date': '2023-10-01'})
+    assert response.status_code == 400
+    assert client.get(f'/blood/{user.user_name}').json()['blood_tests'][0]['RBC'] == 5.0
+
+
 def test_delete_blood_test_with_no_data_returns_404():
     user = create_test_user('john_doe', 'Jane Doe', 25)
     response = client.delete(f'/blood/{user.user_name}?delete_dates=2023-10-01')
@@ -489,4 +509,56 @@ def test_get_blood_tests_with_filter_last_multiple_entries():
     assert response.status_code == 200
     assert response.json()['user'] == user.name
     assert len(response.json()['blood_tests']) == 1
-    assert response.json()['blood_tests'][0]['RBC'] == 4.8
\ No newline at end of file
+    assert response.json()['blood_tests'][0]['RBC'] == 4.8
+
+
+def test_create_blood_tests_bulk():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    blood_test = {'RBC': 4.5, 'WBC': 6.0, 'glucose_level': 90, 'cholesterol_level': 180, 'triglycerides_level': 150}
+    response = client.post(f'/blood/{user.user_name}/bulk', json=[
+        {**blood_test, 'test_date': '2023-10-01'},
+        {**blood_test, 'test_date': '2023-10-01'},
+        {**blood_test, 'test_date': '2023-13-01'},
+        {**blood_test, 'test_date': '2023-11-01'},
+    ])
+    assert response.status_code == 200
+    assert response.json()['created'] == 2
+    assert [result['status'] for result in response.json()['results']] == \
+           ['created', 'duplicate', 'invalid', 'created']
+    response = client.get(f'/blood/{user.user_name}')
+    assert len(response.json()['blood_tests']) == 2
+
+
+def test_create_blood_tests_bulk_with_items_that_are_not_objects():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    blood_test = {'RBC': 4.5, 'WBC': 6.0, 'glucose_level': 90, 'cholesterol_level': 180, 'triglycerides_level': 150,
+                  'test_date': '2023-10-01'}
+    response = client.post(f'/blood/{user.user_name}/bulk', json=['not a blood test', 42, None, blood_test])
+    assert response.status_code == 200
+    assert response.json()['created'] == 1
+    assert [result['status'] for result in response.json()['results']] == ['invalid', 'invalid', 'invalid', 'created']
+
+
+def test_create_blood_test_with_upsert_overrides_existing_date():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    blood_test = {'RBC'              : 4.5, 'WBC': 6.0, 'glucose_level': 90,
+                  'cholesterol_level': 180, 'triglycerides_level': 150, 'test_date': '2023-10-01'}
+    client.post(f'/blood/{user.user_name}', json=blood_test)
+    response = client.post(f'/blood/{user.user_name}?upsert=true', json={**blood_test, 'glucose_level': 110})
+    assert response.status_code == 200
+    response = client.get(f'/blood/{user.user_name}')
+    assert [data['Glucose Level'] for data in response.json()['blood_tests']] == [110]
+
+
+def test_get_blood_tests_pages_with_date_range():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    blood_test = {'RBC': 4.5, 'WBC': 6.0, 'glucose_level': 90, 'cholesterol_level': 180, 'triglycerides_level': 150}
+    client.post(f'/blood/{user.user_name}/bulk', json=[
+        {**blood_test, 'test_date': f'2023-0{month}-01'} for month in range(1, 7)
+    ])
+    response = client.get(f'/blood/{user.user_name}?from_date=2023-02-01&limit=3')
+    assert [data['date'] for data in response.json()['blood_tests']] == ['2023-02-01', '2023-03-01', '2023-04-01']
+    cursor = response.json()['next_cursor']
+    response = client.get(f'/blood/{user.user_name}?from_date=2023-02-01&limit=3&cursor={cursor}')
+    assert [data['date'] for data in response.json()['blood_tests']] == ['2023-05-01', '2023-06-01']
+    assert response.json()['next_cursor'] is None
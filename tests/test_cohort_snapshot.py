@@ -0,0 +1,150 @@
+import time
+
+import numpy as np
+import pytest
+from sqlalchemy import event
+
+from Backend import DB, aggregates, cohort_snapshot
+from Backend.cache import score_cache
+from Backend.routers.utilities import get_age_range
+from tests.test_monthly import post_physical, post_sleep, post_blood
+from tests.test_setup import client, create_test_user, engine, TestingSessionLocal, setup_and_teardown
+
+a = setup_and_teardown
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    yield str(tmp_path / 'cohorts.npy')
+    cohort_snapshot.configure(None)
+    score_cache.clear()
+
+
+def populate() -> None:
+    for i, age in enumerate((30, 31, 32, 45)):
+        user = create_test_user(f'user_{i}', f'User {i}', age)
+        post_physical(user.user_name, 1000 * (i + 1), '2023-10-01')
+        post_sleep(user.user_name, 6 + i, '2023-10-01')
+        post_blood(user.user_name, 4 + i / 10, '2023-10-01')
+
+
+def write_snapshot(path: str) -> None:
+    with TestingSessionLocal() as db:
+        cohort_snapshot.write(cohort_snapshot.build(db), path)
+
+
+def test_snapshot_has_the_cohort_totals(snapshot_path):
+    populate()
+    write_snapshot(snapshot_path)
+    cohort_snapshot.configure(snapshot_path, seconds=0)
+    with TestingSessionLocal() as db:
+        for age in (30, 45, 70):
+            assert cohort_snapshot.cohort_totals(get_age_range(age)) == \
+                   pytest.approx(aggregates.get_cohort_totals(get_age_range(age), db))
+    snapshot = cohort_snapshot.load()
+    assert isinstance(snapshot, np.memmap)
+    assert snapshot['users'].sum() == 4 * len(cohort_snapshot.METRICS)
+
+
+def test_health_score_reads_the_baseline_from_the_snapshot(snapshot_path):
+    populate()
+    expected = client.get('/get_health_score/user_0').json()['health_score']
+    score_cache.clear()
+    write_snapshot(snapshot_path)
+    cohort_snapshot.configure(snapshot_path, seconds=0)
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        assert client.get('/get_health_score/user_0').json()['health_score'] == pytest.approx(expected)
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    assert statements
+    assert not any('cohort_aggregates' in statement for statement in statements)
+
+
+def test_a_new_snapshot_is_mapped(snapshot_path):
+    populate()
+    write_snapshot(snapshot_path)
+    cohort_snapshot.configure(snapshot_path, seconds=0)
+    before = cohort_snapshot.cohort_totals(get_age_range(30))
+    post_physical('user_1', 100000, '2023-11-01')
+    write_snapshot(snapshot_path)
+    assert cohort_snapshot.cohort_totals(get_age_range(30))['physical'] > before['physical']
+
+
+def test_without_a_snapshot_the_database_is_read(snapshot_path):
+    cohort_snapshot.configure(snapshot_path, seconds=0)
+    assert cohort_snapshot.cohort_totals(get_age_range(30)) is None
+    # a snapshot of another layout
+    np.save(snapshot_path, np.zeros(3))
+    assert cohort_snapshot.cohort_totals(get_age_range(30)) is None
+    populate()
+    assert client.get('/get_health_score/user_0').status_code == 200
+
+
+def test_one_process_refreshes_the_snapshot(snapshot_path, monkeypatch):
+    monkeypatch.setattr(DB, 'SessionLocal', TestingSessionLocal)
+    populate()
+    cohort_snapshot.configure(snapshot_path, seconds=0.01)
+    for _ in range(100):
+        if cohort_snapshot.load() is not None:
+            break
+        time.sleep(0.01)
+    with TestingSessionLocal() as db:
+        assert cohort_snapshot.cohort_totals(get_age_range(30)) == \
+               pytest.approx(aggregates.get_cohort_totals(get_age_range(30), db))
+    # the lock is taken, another worker would only read
+    assert not cohort_snapshot._take_refresher_lock(snapshot_path)
+    cohort_snapshot.stop()
+
+
+def test_the_snapshot_needs_the_aggregates(snapshot_path, monkeypatch):
+    monkeypatch.setenv('COHORT_SNAPSHOT_PATH', snapshot_path)
+    monkeypatch.setattr(aggregates, 'cohort_source', 'sql')
+    with pytest.raises(ValueError):
+        cohort_snapshot.configure_from_env()
+
+
+def test_the_snapshot_is_as_old_as_its_build(snapshot_path):
+    populate()
+    with TestingSessionLocal() as db:
+        cohort_snapshot.write(cohort_snapshot.build(db), snapshot_path, built_at=time.time() - 60)
+    cohort_snapshot.configure(snapshot_path, seconds=0)
+    assert cohort_snapshot.built_at() == pytest.approx(time.time() - 60, abs=1)
+    # the cohort changed after the snapshot was built, its score isn't cached
+    client.get('/get_health_score/user_0')
+    assert score_cache.get('user_0') is None
+
+
+def test_the_refresher_survives_a_failed_write(snapshot_path, monkeypatch):
+    monkeypatch.setattr(DB, 'SessionLocal', TestingSessionLocal)
+    populate()
+    write = cohort_snapshot.write
+    failures = []
+
+    def failing_write(*args):
+        if not failures:
+            failures.append(1)
+            raise OSError('disk full')
+        write(*args)
+
+    monkeypatch.setattr(cohort_snapshot, 'write', failing_write)
+    cohort_snapshot.configure(snapshot_path, seconds=0.01)
+    for _ in range(100):
+        if cohort_snapshot.load() is not None:
+            break
+        time.sleep(0.01)
+    assert failures and cohort_snapshot.load() is not None
+    cohort_snapshot.stop()
+
+
+def test_a_stale_snapshot_isnt_used(snapshot_path):
+    populate()
+    with TestingSessionLocal() as db:
+        cohort_snapshot.write(cohort_snapshot.build(db), snapshot_path, built_at=time.time() - 60)
+    cohort_snapshot.configure(snapshot_path, seconds=0, oldest=30)
+    assert cohort_snapshot.cohort_totals(get_age_range(30)) is None
+    assert cohort_snapshot.built_at() is None
+    assert client.get('/get_health_score/user_0').status_code == 200
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from sqlalchemy import select, event
+
+from Backend.DB import ScoreState
+from Backend.ewma import BASE, _weights
+from Backend.monthly import get_monthly_averages
+from Backend.routers.utilities import user_id_of
+from Backend.scoring import weighted_averages
+from tests.test_setup import client, create_test_user, engine, override_get_db, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def post_physical(user_name: str, steps: int, session_date: str, cardio: int = 30):
+    return client.post(f'/physical/{user_name}', json={
+        'steps'                        : steps,
+        'cardio_time_session_minutes'  : cardio,
+        'strength_time_session_minutes': 20,
+        'session_date'                 : session_date
+    })
+
+
+def weighted_average_of(series: np.ndarray) -> float:
+    # the whole series weighted from scratch, base^i for the i-th month
+    weights = np.power(float(BASE), np.arange(len(series)))
+    return np.sum(series * weights) / np.sum(weights)
+
+
+def assert_state_matches_the_history(user_name: str, db):
+    user_id = db.execute(select(user_id_of(user_name).scalar_subquery())).scalar_one()
+    expected = [weighted_average_of(series) for series in get_monthly_averages('physical', user_id, db)]
+    states = {state.metric: state for state in db.execute(
+        select(ScoreState).where(ScoreState.user_id == user_id).execution_options(populate_existing=True)).scalars()}
+    actual = [states[metric].weighted_total / states[metric].weights
+              for metric in ('steps', 'cardio_time_session_minutes', 'strength_time_session_minutes')]
+    np.testing.assert_allclose(actual, expected)
+
+
+def test_weights_of_a_long_history():
+    # the integer weights 2^i overflowed after 62 months
+    weights = _weights(200)
+    assert np.all(np.isfinite(weights)) and weights[-1] == 1
+    assert np.sum(np.array([1, 2, 3]) * _weights(3)) / np.sum(_weights(3)) == pytest.approx((1 + 2 * 2 + 3 * 4) / 7)
+
+
+def test_state_follows_the_writes():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    # new months after the last one
+    post_physical(user.user_name, 1000, '2023-01-01')
+    post_physical(user.user_name, 2000, '2023-02-01')
+    post_physical(user.user_name, 3000, '2023-04-01')
+    assert_state_matches_the_history(user.user_name, db)
+    # a change of an existing month
+    post_physical(user.user_name, 5000, '2023-02-15')
+    client.put(f'/physical/{user.user_name}', json={'steps': 7000, 'session_date': '2023-01-01'})
+    assert_state_matches_the_history(user.user_name, db)
+    # a month before the last one and a removed month
+    post_physical(user.user_name, 4000, '2023-03-01')
+    assert_state_matches_the_history(user.user_name, db)
+    client.delete(f'/physical/{user.user_name}?delete_dates=2023-02-01&delete_dates=2023-02-15')
+    assert_state_matches_the_history(user.user_name, db)
+    # several new months at once
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000, 'session_date': '2023-05-01'},
+        {'steps': 2000, 'session_date': '2023-06-01'},
+        {'steps': 3000, 'session_date': '2023-04-02'},
+    ])
+    assert_state_matches_the_history(user.user_name, db)
+
+
+def test_state_of_a_long_history():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000 + month, 'session_date': f'{2000 + month // 12}-{month % 12 + 1:02}-01'}
+        for month in range(100)])
+    post_physical(user.user_name, 5000, '2008-04-02')
+    assert_state_matches_the_history(user.user_name, db)
+    user_id = db.execute(select(user_id_of(user.user_name).scalar_subquery())).scalar_one()
+    steps = weighted_averages([user_id], db)[user_id]['physical'][0]
+    assert np.isfinite(steps)
+
+
+def test_changed_months_read_the_months_once():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000 * month, 'session_date': f'2023-{month:02}-01'} for month in range(1, 6)])
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        # a new day in every month but the last one, all of them change an existing month
+        client.post(f'/physical/{user.user_name}/bulk', json=[
+            {'steps': 500, 'session_date': f'2023-{month:02}-15'} for month in range(1, 5)])
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    assert len([statement for statement in statements if 'SELECT DISTINCT monthly_aggregates.month' in statement]) == 1
+    assert_state_matches_the_history(user.user_name, db)
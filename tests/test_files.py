@@ -0,0 +1,27 @@
+from pathlib import Path
+
+import pytest
+
+from Backend.files import atomic_write
+
+
+def test_atomic_write_replaces_the_file(tmp_path):
+    path = tmp_path / 'directory' / 'file.txt'
+    atomic_write(path, lambda temporary: Path(temporary).write_text('old'))
+    atomic_write(path, lambda temporary: Path(temporary).write_text('new'))
+    assert path.read_text() == 'new'
+    assert [file.name for file in path.parent.iterdir()] == ['file.txt']
+
+
+def test_a_failed_write_keeps_the_old_file(tmp_path):
+    path = tmp_path / 'file.txt'
+    path.write_text('old')
+
+    def write(temporary: str):
+        Path(temporary).write_text('half')
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        atomic_write(path, write)
+    assert path.read_text() == 'old'
+    assert [file.name for file in tmp_path.iterdir()] == ['file.txt']
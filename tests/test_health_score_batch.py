@@ -0,0 +1,133 @@
+import pytest
+
+from Backend.cache import score_cache
+from tests.test_setup import client, create_test_user, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def create_data(user_name: str, day: str, factor: float):
+    client.post(f'/physical/{user_name}', json={
+        'steps'                        : int(1000 * factor),
+        'cardio_time_session_minutes'  : int(30 * factor),
+        'strength_time_session_minutes': 20,
+        'session_date'                 : day
+    })
+    client.post(f'/sleep/{user_name}', json={
+        'sleep_hours'     : 8.0 * factor,
+        'avg_heart_rate'  : 60.0,
+        'avg_oxygen_level': 98.0,
+        'sleep_date'      : day
+    })
+    client.post(f'/blood/{user_name}', json={
+        'RBC'                : 4.5 * factor,
+        'WBC'                : 6.0,
+        'glucose_level'      : 90,
+        'cholesterol_level'  : 180,
+        'triglycerides_level': 150,
+        'test_date'          : day
+    })
+
+
+def test_batch_scores_match_single_scores():
+    users = [create_test_user('john_doe', 'John Doe', 30),
+             create_test_user('jane_doe', 'Jane Doe', 31),
+             create_test_user('old_doe', 'Old Doe', 70)]
+    for i, user in enumerate(users):
+        create_data(user.user_name, '2023-01-15', 1 + i)
+        create_data(user.user_name, '2023-03-02', 2 + i)
+        create_data(user.user_name, '2023-03-20', 0.5)
+        create_data(user.user_name, f'2023-1{i}-01', 1.5)
+
+    response = client.post('/get_health_score/batch', json={'user_names': [user.user_name for user in users]})
+    assert response.status_code == 200
+    batch_scores = response.json()['health_scores']
+    assert response.json()['errors'] == {}
+
+    score_cache.clear()
+    for user in users:
+        single_score = client.get(f'/get_health_score/{user.user_name}').json()['health_score']
+        assert batch_scores[user.user_name] == pytest.approx(single_score)
+
+
+def test_batch_scores_report_errors_per_user():
+    user = create_test_user('john_doe', 'John Doe', 30)
+    no_blood = create_test_user('jane_doe', 'Jane Doe', 31)
+    create_test_user('no_data', 'No Data', 31)
+    create_data(user.user_name, '2023-01-15', 1)
+    client.post(f'/sleep/{no_blood.user_name}', json={
+        'sleep_hours'     : 8.0,
+        'avg_heart_rate'  : 60.0,
+        'avg_oxygen_level': 98.0,
+        'sleep_date'      : '2023-01-15'
+    })
+
+    response = client.post('/get_health_score/batch',
+                           json={'user_names': ['john_doe', 'jane_doe', 'no_data', 'invalid_user']})
+    assert response.status_code == 200
+    assert list(response.json()['health_scores']) == ['john_doe']
+    assert response.json()['errors'] == {
+        'jane_doe'    : 'No physical data found for this user',
+        'no_data'     : 'No physical data found for this user',
+        'invalid_user': 'User not found',
+    }
+
+
+def test_batch_scores_with_an_empty_cohort():
+    # get_age_range(50) is range(51, 66), the user isn't part of his own cohort and nobody else is in it
+    lonely = create_test_user('lonely', 'Lonely', 50)
+    user = create_test_user('john_doe', 'John Doe', 30)
+    create_data(lonely.user_name, '2023-01-15', 1)
+    create_data(user.user_name, '2023-01-15', 1)
+
+    response = client.post('/get_health_score/batch', json={'user_names': ['lonely', 'john_doe']})
+    assert response.status_code == 200
+    assert list(response.json()['health_scores']) == ['john_doe']
+    assert response.json()['errors'] == {'lonely': 'No cohort data for this age range'}
+    # the error isn't cached
+    assert score_cache.get('lonely') is None
+    assert client.get('/get_health_score/lonely').status_code == 404
+    assert client.get('/get_health_score/lonely/percentile').status_code == 404
+
+
+def test_batch_scores_with_no_users_returns_422():
+    response = client.post('/get_health_score/batch', json={'user_names': []})
+    assert response.status_code == 422
+
+
+def test_cohort_percentile():
+    users = [create_test_user(f'user_{i}', f'User {i}', 30 + i) for i in range(4)]
+    for i, user in enumerate(users):
+        create_data(user.user_name, '2023-01-15', 1 + i)
+        create_data(user.user_name, '2023-02-15', 1 + i)
+    create_test_user('no_data', 'No Data', 30)
+    other_cohort = create_test_user('old_doe', 'Old Doe', 70)
+    create_data(other_cohort.user_name, '2023-01-15', 10)
+
+    response = client.get(f'/get_health_score/{users[3].user_name}/percentile')
+    assert response.status_code == 200
+    assert response.json()['cohort_size'] == 4
+    assert response.json()['percentile'] == 87.5
+    single_score = client.get(f'/get_health_score/{users[3].user_name}').json()['health_score']
+    assert response.json()['health_score'] == pytest.approx(single_score)
+    assert client.get(f'/get_health_score/{users[0].user_name}/percentile').json()['percentile'] == 12.5
+
+
+def test_cohort_percentile_errors():
+    create_test_user('no_data', 'No Data', 30)
+    response = client.get('/get_health_score/no_data/percentile')
+    assert response.status_code == 404
+    assert response.json()['detail'] == 'No physical data found for this user'
+    assert client.get('/get_health_score/missing/percentile').status_code == 404
+
+
+def test_cohort_percentile_outside_of_the_age_ranges():
+    # 25 is not part of range(20, 25), the range get_age_range returns for it
+    user = create_test_user('john_doe', 'John Doe', 25)
+    peer = create_test_user('jane_doe', 'Jane Doe', 22)
+    create_data(user.user_name, '2023-01-15', 2)
+    create_data(peer.user_name, '2023-01-15', 1)
+    response = client.get(f'/get_health_score/{user.user_name}/percentile')
+    assert response.status_code == 200
+    assert response.json()['cohort_size'] == 2
+    assert response.json()['percentile'] == 75
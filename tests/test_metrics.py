@@ -0,0 +1,142 @@
+import pytest
+from sqlalchemy import create_engine, text, exc
+
+from Backend.DB import pool_options
+from Backend.metrics import Histogram, PoolMetrics, RequestStats, database_metrics, http_metrics, request_stats
+from tests.test_setup import client, create_test_user, engine as test_engine, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def test_histogram_is_cumulative():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.cumulative() == [('0.1', 2), ('1', 3), ('+Inf', 4)]
+    assert histogram.snapshot()['count'] == 4
+    assert histogram.snapshot()['sum'] == pytest.approx(3.65)
+
+
+def test_pool_options_from_the_environment(monkeypatch):
+    assert pool_options() == {}
+    monkeypatch.setenv('DB_POOL_SIZE', '20')
+    monkeypatch.setenv('DB_MAX_OVERFLOW', '5')
+    monkeypatch.setenv('DB_POOL_TIMEOUT', '2.5')
+    monkeypatch.setenv('DB_POOL_RECYCLE', '1800')
+    monkeypatch.setenv('DB_POOL_PRE_PING', 'true')
+    assert pool_options() == {'pool_size': 20, 'max_overflow': 5, 'pool_timeout': 2.5, 'pool_recycle': 1800,
+                              'pool_pre_ping': True}
+
+
+def test_pool_metrics(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "pool.db"}', pool_size=1, max_overflow=0, pool_timeout=0.05)
+    metrics = PoolMetrics()
+    metrics.observe(engine)
+
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        stats = metrics.snapshot(engine.pool)
+        assert stats['checked_out'] == 1
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+
+    stats = metrics.snapshot(engine.pool)
+    assert (stats['checkouts'], stats['checkins'], stats['connects']) == (2, 2, 1)
+    assert stats['checked_out'] == 0
+    assert stats['timeouts'] == 1
+    # the first checkout opened the connection and the second one waited for it
+    assert stats['waits'] == 2
+    assert stats['wait_seconds'] >= 0.05
+    assert stats['checkout_latency_seconds']['count'] == 3
+    assert stats['connect_latency_seconds']['count'] == 1
+    engine.dispose()
+
+
+def test_pool_metrics_follow_the_engine_to_a_new_pool(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "pool.db"}')
+    metrics = PoolMetrics()
+    metrics.observe(engine)
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+    engine.dispose()
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+
+    stats = metrics.snapshot(engine.pool)
+    assert (stats['checkouts'], stats['checkins'], stats['connects']) == (2, 2, 2)
+    assert stats['checkout_latency_seconds']['count'] == 2
+    engine.dispose()
+
+
+def test_db_metrics_route(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "pool.db"}')
+    database_metrics.observe('primary', engine)
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        response = client.get('/metrics/db')
+        assert response.status_code == 200
+        stats = response.json()['primary']
+        assert stats['pool'] == 'QueuePool'
+        assert stats['checkouts'] == 1
+        assert stats['checkout_latency_seconds']['buckets']['+Inf'] == 1
+    finally:
+        database_metrics.clear()
+        engine.dispose()
+
+
+def test_queries_are_counted_into_the_request():
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    try:
+        with test_engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+            connection.execute(text('SELECT 2'))
+    finally:
+        request_stats.reset(token)
+    with test_engine.connect() as connection:
+        connection.execute(text('SELECT 3'))
+    assert stats.queries == 2
+    assert stats.db_seconds > 0
+
+
+def test_failed_statements_leave_nothing_on_the_connection():
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    try:
+        with test_engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(exc.OperationalError):
+                    connection.execute(text('SELECT * FROM missing_table'))
+            connection.execute(text('SELECT 1'))
+            assert not any(isinstance(value, list) for value in connection.info.values())
+    finally:
+        request_stats.reset(token)
+    assert stats.queries == 1
+
+
+def test_prometheus_metrics_of_the_routes():
+    http_metrics.clear()
+    create_test_user('john_doe', 'John Doe', 30)
+    client.get('/users/john_doe')
+    client.get('/users/jane_doe')
+    client.get('/no_such_route')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    lines = response.text.splitlines()
+    # the routes are labeled by their template and not by the user
+    assert 'http_requests_total{method="GET",route="/users/{user_name}",status="200"} 1' in lines
+    assert 'http_requests_total{method="GET",route="/users/{user_name}",status="404"} 1' in lines
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"} 1' in lines
+    assert 'http_request_duration_seconds_count{method="GET",route="/users/{user_name}"} 2' in lines
+    assert '# TYPE http_request_db_queries histogram' in lines
+    # the create reads the user and inserts him
+    assert 'http_request_db_queries_bucket{method="POST",route="/users/",le="0"} 0' in lines
+    assert 'http_request_db_queries_bucket{method="POST",route="/users/",le="+Inf"} 1' in lines
+    assert any(line.startswith('http_request_db_seconds_sum{method="GET",route="/users/{user_name}"}')
+               for line in lines)
+    http_metrics.clear()
@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, inspect, text, select
+from sqlalchemy.orm import Session
+
+from Backend.DB import Base, PhysicalActivity, UserAggregate, MonthlyAggregate, ScoreState
+from Backend.migrations import upgrade, MIGRATIONS
+
+# the schema the app created before the migrations
+OLD_SCHEMA = [
+    'CREATE TABLE users (id INTEGER PRIMARY KEY, user_name VARCHAR NOT NULL UNIQUE, name VARCHAR NOT NULL, '
+    'age INTEGER NOT NULL)',
+    'CREATE TABLE physical_activity (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id) '
+    'ON DELETE CASCADE, steps INTEGER NOT NULL, cardio_time_session_minutes INTEGER, '
+    'strength_time_session_minutes INTEGER, date DATE, UNIQUE (id, date))',
+    'CREATE TABLE sleep_activity (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id) '
+    'ON DELETE CASCADE, sleep_hours FLOAT NOT NULL, avg_heart_rate FLOAT NOT NULL, avg_oxygen_level FLOAT NOT NULL, '
+    'date DATE NOT NULL, UNIQUE (id, date))',
+    'CREATE TABLE blood_tests (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id) '
+    'ON DELETE CASCADE, "RBC" FLOAT NOT NULL, "WBC" FLOAT NOT NULL, glucose_level FLOAT NOT NULL, '
+    'cholesterol_level FLOAT NOT NULL, triglycerides_level FLOAT NOT NULL, date DATE, UNIQUE (id, date))',
+]
+
+
+def test_upgrade_new_database(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "new.db"}')
+    assert upgrade(engine) == MIGRATIONS[-1][0]
+    indexes = {index['name']: index for index in inspect(engine).get_indexes('physical_activity')}
+    assert indexes['ix_physical_activity_user_id_date']['unique']
+    assert 'ix_users_age' in {index['name'] for index in inspect(engine).get_indexes('users')}
+
+
+def test_upgrade_old_database(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    with engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO users VALUES (1, 'john_doe', 'John Doe', 30)"))
+        connection.execute(text("INSERT INTO physical_activity VALUES (1, 1, 1000, 30, 20, '2023-10-01'), "
+                                "(2, 1, 2000, 30, 20, '2023-10-01'), (3, 1, 3000, 30, 20, '2023-10-02')"))
+
+    assert upgrade(engine) == MIGRATIONS[-1][0]
+    with Session(engine) as db:
+        assert db.execute(select(PhysicalActivity.id)).scalars().all() == [1, 3]
+        steps = db.execute(select(UserAggregate).where(UserAggregate.metric == 'steps')).scalar_one()
+        assert (steps.total, steps.count) == (4000, 2)
+        steps = db.execute(select(MonthlyAggregate).where(MonthlyAggregate.metric == 'steps')).scalar_one()
+        assert (steps.month, steps.total, steps.count, steps.total_squares) == (202310, 4000, 2, 1000 ** 2 + 3000 ** 2)
+        steps = db.execute(select(ScoreState).where(ScoreState.metric == 'steps')).scalar_one()
+        assert (steps.weighted_total, steps.weights, steps.months, steps.last_month) == (2000, 1, 1, 202310)
+    for index_name, table in [('ix_physical_activity_user_id_date', 'physical_activity'),
+                              ('ix_sleep_activity_user_id_date', 'sleep_activity'),
+                              ('ix_blood_tests_user_id_date', 'blood_tests')]:
+        assert index_name in {index['name'] for index in inspect(engine).get_indexes(table)}
+
+    # applying again does nothing
+    assert upgrade(engine) == MIGRATIONS[-1][0]
+
+
+def test_migrations_create_the_tables_of_the_models(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "new.db"}')
+    upgrade(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        assert {column['name'] for column in inspector.get_columns(table.name)} == set(table.columns.keys())
+        assert {index['name'] for index in inspector.get_indexes(table.name)} >= {index.name for index in table.indexes}
+
+
+def test_workers_upgrade_at_the_same_time(tmp_path):
+    url = f'sqlite:///{tmp_path / "shared.db"}'
+    start = threading.Barrier(4)
+
+    def worker() -> int:
+        engine = create_engine(url)
+        start.wait()
+        return upgrade(engine)
+
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(lambda _: worker(), range(4))) == [MIGRATIONS[-1][0]] * 4
+    with create_engine(url).connect() as connection:
+        assert connection.execute(text('SELECT version FROM schema_version')).scalars().all() == \
+               [version for version, _, _ in MIGRATIONS]
@@ -0,0 +1,58 @@
+import pytest
+from fastapi import HTTPException
+
+from Backend.routers import blood, physical, sleep
+from Backend.routers.physical import get_avg_monthly
+from tests.test_setup import client, create_test_user, override_get_db, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def post_physical(user_name: str, steps: int, session_date: str):
+    return client.post(f'/physical/{user_name}', json={
+        'steps'                        : steps,
+        'cardio_time_session_minutes'  : 30,
+        'strength_time_session_minutes': 20,
+        'session_date'                 : session_date
+    })
+
+
+def post_sleep(user_name: str, sleep_hours: float, session_date: str):
+    return client.post(f'/sleep/{user_name}', json={
+        'sleep_hours'     : sleep_hours,
+        'avg_heart_rate'  : 60,
+        'avg_oxygen_level': 98,
+        'sleep_date'      : session_date
+    })
+
+
+def post_blood(user_name: str, RBC: float, session_date: str):
+    return client.post(f'/blood/{user_name}', json={
+        'RBC'                : RBC,
+        'WBC'                : 7,
+        'glucose_level'      : 90,
+        'cholesterol_level'  : 180,
+        'triglycerides_level': 150,
+        'test_date'          : session_date
+    })
+
+
+def test_same_month_of_different_years_is_not_merged():
+    db = next(override_get_db())
+    user = create_test_user('john_doe', 'John Doe', 30)
+    post_physical(user.user_name, 1000, '2022-10-01')
+    post_physical(user.user_name, 3000, '2023-09-01')
+    post_physical(user.user_name, 5000, '2023-10-01')
+    post_physical(user.user_name, 7000, '2023-10-02')
+    steps, cardio, strength = get_avg_monthly(user.user_name, db)
+    assert list(steps) == [1000, 3000, 6000]
+    assert list(cardio) == [30, 30, 30]
+
+
+def test_monthly_averages_of_an_unknown_user_are_a_404():
+    db = next(override_get_db())
+    for router in (physical, sleep, blood):
+        with pytest.raises(HTTPException) as error:
+            router.get_avg_monthly('missing_user', db)
+        assert error.value.status_code == 404
+        assert error.value.detail == 'User not found'
@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from Backend import parallel
+from Backend.cache import score_cache, user_cache
+from Backend.main import get_health_score
+from tests.test_recompute import database_url
+
+a = database_url
+
+
+@pytest.fixture
+def threads():
+    parallel.configure(4)
+    yield
+    parallel.configure(0)
+
+
+def test_fetch_all_uses_a_session_per_fetch(database_url, threads):
+    with Session(create_engine(database_url)) as db:
+        def fetch(session: Session):
+            return session is db, threading.current_thread().name
+
+        results = parallel.fetch_all(db, fetch, fetch)
+    assert [same_session for same_session, _ in results] == [False, False]
+    assert all(thread.startswith('fetch') for _, thread in results)
+
+
+def test_fetch_all_raises_the_error_of_a_fetch(database_url, threads):
+    def fail(session: Session):
+        raise ValueError('No physical data found for this user')
+
+    with Session(create_engine(database_url)) as db, pytest.raises(ValueError):
+        parallel.fetch_all(db, lambda session: 1, fail)
+
+
+def test_health_score_is_the_same_with_concurrent_fetches(database_url):
+    with Session(create_engine(database_url)) as db:
+        expected = get_health_score('user_4', db)['health_score']
+        score_cache.clear()
+        parallel.configure(4)
+        try:
+            assert get_health_score('user_5', db)['health_score'] != expected
+            assert get_health_score('user_4', db)['health_score'] == pytest.approx(expected)
+            assert score_cache.stats()['hits'] == 0
+        finally:
+            parallel.configure(0)
+            score_cache.clear()
+            user_cache.clear()
@@ -1,3 +1,5 @@
+import json
+
 from Backend.routers.physical import get_avg_all, get_avg_monthly
 from tests.test_setup import client, create_test_user, override_get_db, setup_and_teardown
 
@@ -262,6 +264,24 @@ def test_update_physical_with_no_data_returns_404():
     assert response.json()['detail'] == 'No physical data found for this date'
 
 
+def test_update_physical_with_only_the_date_returns_400():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    # a day that doesn't exist
+    response = client.put(f'/physical/{user.user_name}', json={'session_date': '2023-10-01'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'No fields to update'
+
+    client.post(f'/physical/{user.user_name}', json={
+        'steps'                        : 1000,
+        'cardio_time_session_minutes'  : 30,
+        'strength_time_session_minutes': 20,
+        'session_date'                 : '2023-10-01'
+    })
+    response = client.put(f'/physical/{user.user_name}', json={'session_date': '2023-10-01'})
+    assert response.status_code == 400
+    assert client.get(f'/physical/{user.user_name}').json()['physical_data'][0]['steps'] == 1000
+
+
 def test_delete_physical_with_no_data_returns_404():
     user = create_test_user('john_doe', 'Jane Doe', 25)
     response = client.delete(f'/physical/{user.user_name}?delete_dates=2023-10-01')
@@ -435,4 +455,104 @@ def test_get_physical_data_with_filter_last_multiple_entries():
     assert response.status_code == 200
     assert response.json()['user'] == user.name
     assert len(response.json()['physical_data']) == 1
-    assert response.json()['physical_data'][0]['steps'] == 2000
\ No newline at end of file
+    assert response.json()['physical_data'][0]['steps'] == 2000
+
+
+def test_create_physical_bulk():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    client.post(f'/physical/{user.user_name}', json={
+        'steps'       : 1000,
+        'session_date': '2023-10-01'
+    })
+    response = client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000, 'session_date': '2023-10-01'},
+        {'steps': 2000, 'cardio_time_session_minutes': 40, 'session_date': '2023-10-02'},
+        {'steps': 3000, 'session_date': '2023-10-02'},
+        {'steps': -1, 'session_date': '2023-10-03'},
+        {'steps': 4000, 'session_date': '2023-10-04'},
+    ])
+    assert response.status_code == 200
+    assert response.json()['created'] == 2
+    assert [result['status'] for result in response.json()['results']] == \
+           ['duplicate', 'created', 'duplicate', 'invalid', 'created']
+    response = client.get(f'/physical/{user.user_name}')
+    assert len(response.json()['physical_data']) == 3
+
+
+def test_create_physical_bulk_with_invalid_user_returns_404():
+    response = client.post('/physical/invalid_user/bulk', json=[{'steps': 1000, 'session_date': '2023-10-01'}])
+    assert response.status_code == 404
+    assert response.json()['detail'] == 'User not found'
+
+
+def test_create_physical_with_upsert_overrides_existing_date():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    client.post(f'/physical/{user.user_name}', json={'steps': 1000, 'session_date': '2023-10-01'})
+    response = client.post(f'/physical/{user.user_name}?upsert=true', json={
+        'steps'       : 2500,
+        'session_date': '2023-10-01'
+    })
+    assert response.status_code == 200
+    assert response.json()['message'] == f'Saved Physical data to user {user.name} on 2023-10-01'
+    response = client.get(f'/physical/{user.user_name}')
+    assert [data['steps'] for data in response.json()['physical_data']] == [2500]
+
+
+def test_create_physical_with_invalid_user_returns_404():
+    response = client.post('/physical/invalid_user', json={'steps': 1000, 'session_date': '2023-10-01'})
+    assert response.status_code == 404
+    assert response.json()['detail'] == 'User not found'
+
+
+def test_get_physical_data_pages():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000 * day, 'session_date': f'2023-10-0{day}'} for day in range(1, 6)
+    ])
+    steps, cursor = [], None
+    while True:
+        url = f'/physical/{user.user_name}?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        steps += [data['steps'] for data in response.json()['physical_data']]
+        cursor = response.json()['next_cursor']
+        if not cursor:
+            break
+    assert steps == [1000, 2000, 3000, 4000, 5000]
+
+
+def test_get_physical_data_with_date_range():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000 * day, 'session_date': f'2023-10-0{day}'} for day in range(1, 6)
+    ])
+    response = client.get(f'/physical/{user.user_name}?from_date=2023-10-02&to_date=2023-10-04')
+    assert [data['steps'] for data in response.json()['physical_data']] == [2000, 3000, 4000]
+    assert response.json()['next_cursor'] is None
+    response = client.get(f'/physical/{user.user_name}?to_date=2023-10-03&filter_last=true')
+    assert [data['steps'] for data in response.json()['physical_data']] == [3000]
+
+
+def test_get_physical_data_with_invalid_cursor_returns_422():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    response = client.get(f'/physical/{user.user_name}?limit=2&cursor=not-a-cursor')
+    assert response.status_code == 422
+
+
+def test_export_physical_data():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    client.post(f'/physical/{user.user_name}/bulk', json=[
+        {'steps': 1000 * day, 'session_date': f'2023-10-0{day}'} for day in range(1, 4)
+    ])
+    response = client.get(f'/physical/{user.user_name}/export')
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['steps'] for row in rows] == [1000, 2000, 3000]
+    assert rows[0]['date'] == '2023-10-01'
+
+    response = client.get(f'/physical/{user.user_name}/export?format=csv')
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == 'date,steps,cardio_time_session_minutes,strength_time_session_minutes'
+    assert lines[1:] == ['2023-10-01,1000,0,0', '2023-10-02,2000,0,0', '2023-10-03,3000,0,0']
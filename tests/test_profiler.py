@@ -0,0 +1,77 @@
+import pytest
+
+from Backend import profiler
+from Backend.profiler import QueryProfile, PROFILE_HEADER
+from tests.test_monthly import post_physical, post_sleep, post_blood
+from tests.test_setup import client, create_test_user, setup_and_teardown
+
+a = setup_and_teardown
+
+
+@pytest.fixture(autouse=True)
+def clear_profiles():
+    profiler.last_requests.clear()
+    yield
+    profiler.configure(False)
+    profiler.last_requests.clear()
+
+
+def test_requests_are_not_profiled_by_default():
+    create_test_user('john_doe', 'John Doe', 30)
+    response = client.get('/users/john_doe')
+    assert 'X-Query-Count' not in response.headers
+    assert client.get('/debug/last-requests').json() == []
+
+
+def test_profiled_request_has_the_summary_headers():
+    create_test_user('john_doe', 'John Doe', 30)
+    post_physical('john_doe', 1000, '2023-10-01')
+    post_sleep('john_doe', 8, '2023-10-01')
+    post_blood('john_doe', 4.5, '2023-10-01')
+
+    response = client.get('/get_health_score/john_doe', headers={PROFILE_HEADER: 'true'})
+    assert response.status_code == 200
+    assert int(response.headers['X-Query-Count']) > 0
+    assert float(response.headers['X-Query-Time-Ms']) > 0
+
+    profiles = client.get('/debug/last-requests').json()
+    assert len(profiles) == 1
+    profile = profiles[0]
+    assert profile['id'] == int(response.headers['X-Query-Profile-Id'])
+    assert (profile['method'], profile['path'], profile['status']) == ('GET', '/get_health_score/john_doe', 200)
+    assert profile['query_count'] == len(profile['queries']) == int(response.headers['X-Query-Count'])
+    # the line of the app that ran every statement
+    assert all(query['call_site'].startswith('Backend') for query in profile['queries'])
+    assert any('score_states' in query['statement'] for query in profile['queries'])
+
+
+def test_repeated_statements_are_reported():
+    profile = QueryProfile('GET', '/users/john_doe')
+    for i in range(3):
+        profile.add('SELECT * FROM users WHERE id = ?', 0.001, None, f'Backend/scoring.py:{10 + i % 2} get_users')
+    profile.add('SELECT * FROM score_states', 0.002, 3, 'Backend/scoring.py:20 domain_sums')
+    summary = profile.summary(200, 0.01)
+    assert summary['query_count'] == 4
+    assert summary['query_seconds'] == pytest.approx(0.005)
+    assert summary['repeated'] == [{'statement': 'SELECT * FROM users WHERE id = ?', 'count': 3,
+                                    'seconds': pytest.approx(0.003),
+                                    'call_sites': ['Backend/scoring.py:10 get_users',
+                                                   'Backend/scoring.py:11 get_users']}]
+    assert profiler.headers(summary)['X-Query-Repeated'] == '1'
+
+
+def test_profile_every_request_and_keep_the_last_ones():
+    profiler.configure(True, buffer_size=2)
+    create_test_user('john_doe', 'John Doe', 30)
+    client.get('/users/john_doe')
+    client.get('/users/jane_doe')
+    # the request to the ring buffer is profiled too, after it answered
+    paths = [profile['path'] for profile in client.get('/debug/last-requests').json()]
+    assert paths == ['/users/jane_doe', '/users/john_doe']
+
+    repeated = QueryProfile('GET', '/repeated')
+    repeated.add('SELECT 1', 0.001, None, None)
+    repeated.add('SELECT 1', 0.001, None, None)
+    profiler.record(repeated, 200, 0.01)
+    assert [profile['path'] for profile in client.get('/debug/last-requests?repeated_only=true').json()] == \
+           ['/repeated']
@@ -0,0 +1,77 @@
+import shutil
+
+import pytest
+from fastapi.testclient import TestClient
+
+from Backend import DB
+from Backend.DB import get_db, get_read_db, init_db, READ_PRIMARY_HEADER, LAST_WRITE_COOKIE
+from Backend.cache import score_cache, user_cache
+from Backend.main import app
+from Backend.metrics import database_metrics
+
+PHYSICAL = {'steps': 5000, 'cardio_time_session_minutes': 30, 'strength_time_session_minutes': 10,
+            'session_date': '2023-01-05'}
+
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch):
+    """A primary and a replica that is a copy of it, the writes after the copy aren't replicated"""
+    primary, replica_path = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    monkeypatch.delitem(app.dependency_overrides, get_db, raising=False)
+    monkeypatch.delitem(app.dependency_overrides, get_read_db, raising=False)
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{primary}')
+    init_db()
+    client = TestClient(app)
+    client.post('/users/', json={'user_name': 'replicated', 'name': 'Replicated', 'age': 30})
+
+    shutil.copy(primary, replica_path)
+    monkeypatch.setenv('DATABASE_READ_URL', f'sqlite:///{replica_path}')
+    init_db()
+    yield
+    database_metrics.clear()
+    score_cache.clear()
+    user_cache.clear()
+    DB.engine.dispose()
+
+
+def test_reads_go_to_the_replica(replica):
+    writer = TestClient(app)
+    assert writer.post('/physical/replicated', json=PHYSICAL).status_code == 200
+    assert LAST_WRITE_COOKIE in writer.cookies
+
+    reader = TestClient(app)
+    assert reader.get('/users/replicated').status_code == 200
+    # the day was written to the primary only
+    assert reader.get('/physical/replicated').status_code == 404
+    assert set(database_metrics.snapshot()) == {'primary', 'replica_0'}
+
+
+def test_read_your_writes(replica):
+    writer = TestClient(app)
+    assert writer.post('/physical/replicated', json=PHYSICAL).status_code == 200
+    # the client that wrote reads from the primary for a while
+    assert writer.get('/physical/replicated').status_code == 200
+
+    reader = TestClient(app)
+    assert reader.get('/physical/replicated', headers={READ_PRIMARY_HEADER: 'true'}).status_code == 200
+    assert reader.get('/physical/replicated').status_code == 404
+
+
+def test_read_your_writes_expires(replica, monkeypatch):
+    monkeypatch.setenv('READ_YOUR_WRITES_SECONDS', '0')
+    writer = TestClient(app)
+    assert writer.post('/physical/replicated', json=PHYSICAL).status_code == 200
+    assert writer.get('/physical/replicated').status_code == 404
+
+
+def test_missing_users_on_the_replica_are_not_cached(replica):
+    writer = TestClient(app)
+    assert writer.post('/users/', json={'user_name': 'new', 'name': 'New', 'age': 30}).status_code == 200
+    assert TestClient(app).get('/users/new').status_code == 404
+    assert writer.get('/users/new').status_code == 200
+
+
+def test_failed_writes_dont_read_from_the_primary(replica):
+    client = TestClient(app)
+    assert client.post('/physical/missing_user', json=PHYSICAL).status_code == 404
+    assert LAST_WRITE_COOKIE not in client.cookies
@@ -0,0 +1,135 @@
+import shutil
+import sys
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine, insert, select, delete, update
+from sqlalchemy.orm import Session
+
+from Backend import aggregates
+from Backend.DB import User, PhysicalActivity, SleepActivity, BloodTest, HealthScore, ScoreRun, ScoreRunPartition
+from Backend.migrations import upgrade
+from Backend import recompute as recompute_module
+from Backend.recompute import recompute, partitions, chunks
+from Backend.scoring import score_users
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    url = f'sqlite:///{tmp_path / "scores.db"}'
+    engine = create_engine(url)
+    upgrade(engine)
+    with Session(engine) as db:
+        ages = [19, 22, 25, 30, 31, 40, 50, 70, 130]
+        db.execute(insert(User), [{'id': i, 'user_name': f'user_{i}', 'name': f'User {i}', 'age': age}
+                                  for i, age in enumerate(ages, start=1)])
+        for i in range(1, len(ages)):  # the last user has no data
+            for month in (1, 2, 3):
+                day = date(2023, month, 1)
+                db.execute(insert(PhysicalActivity).values(user_id=i, steps=1000 * i + month, date=day,
+                                                           cardio_time_session_minutes=30,
+                                                           strength_time_session_minutes=20))
+                db.execute(insert(SleepActivity).values(user_id=i, sleep_hours=7 + month / 10, avg_heart_rate=60,
+                                                        avg_oxygen_level=98, date=day))
+                db.execute(insert(BloodTest).values(user_id=i, RBC=4.5, WBC=6, glucose_level=90 + i,
+                                                    cholesterol_level=180, triglycerides_level=150, date=day))
+        aggregates.rebuild(db)
+    engine.dispose()
+    return url
+
+
+def saved_scores(database_url: str) -> dict[str, tuple]:
+    with Session(create_engine(database_url)) as db:
+        return {row.user_name: (row.score, row.error) for row in db.execute(
+            select(User.user_name, HealthScore.score, HealthScore.error).join(HealthScore))}
+
+
+def test_partitions_cover_all_the_ages():
+    bounds = partitions()
+    assert bounds[20] == (20, 25)  # get_age_range(25) is range(20, 25)
+    assert bounds[76] == (76, None)
+    ages = sorted(age for first, last in bounds.values() for age in range(first, (last or 119) + 1))
+    assert ages == list(range(0, 120))
+
+
+@pytest.mark.parametrize('chunk_size', [recompute_module.CHUNK_SIZE, 1])
+def test_recompute_matches_score_users(database_url, chunk_size, monkeypatch):
+    monkeypatch.setattr(recompute_module, 'CHUNK_SIZE', chunk_size)
+    run_id = recompute(database_url, workers=2, progress=False)
+    scores = saved_scores(database_url)
+    with Session(create_engine(database_url)) as db:
+        expected = score_users(list(db.execute(select(User)).scalars()), db)
+        assert db.execute(select(ScoreRun.finished_at).where(ScoreRun.id == run_id)).scalar_one() is not None
+    assert len(scores) == len(expected) == 9
+    for user_name, score in expected.items():
+        if isinstance(score, str):
+            assert scores[user_name] == (None, score)
+        else:
+            assert scores[user_name][0] == pytest.approx(score)
+
+
+def test_recompute_resumes_the_unfinished_partitions(database_url):
+    run_id = recompute(database_url, workers=1, progress=False)
+    expected = saved_scores(database_url)
+    engine = create_engine(database_url)
+    with Session(engine) as db:
+        # interrupted after all the partitions but the one of the ages 25-35
+        db.execute(update(ScoreRun).values(finished_at=None))
+        db.execute(delete(ScoreRunPartition).where(ScoreRunPartition.age_bucket == 25))
+        db.execute(delete(HealthScore).where(HealthScore.user_id.in_([4, 5])))
+        db.execute(update(HealthScore).values(score=0))
+        db.commit()
+
+    assert recompute(database_url, workers=1, resume=True, progress=False) == run_id
+    scores = saved_scores(database_url)
+    assert scores['user_4'] == expected['user_4'] and scores['user_5'] == expected['user_5']
+    # the partitions that were saved are not scored again
+    assert scores['user_1'][0] in (0, None)
+    assert recompute(database_url, workers=1, resume=True, progress=False) != run_id
+
+
+def test_chunks_of_a_bucket(database_url, monkeypatch):
+    monkeypatch.setattr(recompute_module, 'CHUNK_SIZE', 2)
+    with Session(create_engine(database_url)) as db:
+        # the users 1 to 3 are 19, 22 and 25, the ages 13 to 25
+        assert chunks(db, 13, 25, []) == [(1, 2), (3, 3)]
+        assert chunks(db, 13, 25, [(1, 2)]) == [(3, 3)]
+        assert chunks(db, 76, None, []) == [(9, 9)]
+        assert chunks(db, 0, 1, []) == []
+
+
+def test_every_chunk_is_saved(database_url, monkeypatch):
+    monkeypatch.setattr(recompute_module, 'CHUNK_SIZE', 1)
+    run_id = recompute(database_url, workers=2, progress=False)
+    with Session(create_engine(database_url)) as db:
+        saved = db.execute(select(ScoreRunPartition.first_user_id, ScoreRunPartition.last_user_id)
+                           .where(ScoreRunPartition.run_id == run_id)
+                           .order_by(ScoreRunPartition.first_user_id)).all()
+    assert saved == [(i, i) for i in range(1, 10)]
+
+
+def test_recompute_of_shards_compares_to_the_cohorts_of_all_the_shards(database_url, tmp_path, monkeypatch):
+    recompute(database_url, workers=1, progress=False)
+    expected = saved_scores(database_url)
+    urls = []
+    for shard, user_ids in enumerate(([1, 3, 5, 7, 9], [2, 4, 6, 8])):
+        path = tmp_path / f'shard_{shard}.db'
+        shutil.copy(database_url.removeprefix('sqlite:///'), path)
+        urls.append(f'sqlite:///{path}')
+        with Session(create_engine(urls[-1])) as db:
+            db.execute(delete(HealthScore))
+            for model in (PhysicalActivity, SleepActivity, BloodTest):
+                db.execute(delete(model).where(model.user_id.not_in(user_ids)))
+            db.execute(delete(User).where(User.id.not_in(user_ids)))
+            aggregates.rebuild(db)
+    monkeypatch.setenv('DATABASE_SHARD_URLS', ','.join(urls))
+    monkeypatch.setattr(sys, 'argv', ['recompute', '--workers', '1', '--quiet'])
+    recompute_module.main()
+
+    scores = {}
+    for url in urls:
+        scores.update(saved_scores(url))
+    assert scores.keys() == expected.keys()
+    for user_name, (score, error) in expected.items():
+        assert scores[user_name][1] == error
+        assert scores[user_name][0] == (None if score is None else pytest.approx(score))
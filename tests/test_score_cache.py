@@ -0,0 +1,90 @@
+import time
+
+from Backend.cache import ScoreCache, SharedVersions, score_cache
+from tests.test_setup import client, create_test_user, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def create_data(user_name: str, steps: int = 1000):
+    client.post(f'/physical/{user_name}', json={
+        'steps'                        : steps,
+        'cardio_time_session_minutes'  : 30,
+        'strength_time_session_minutes': 20,
+        'session_date'                 : '2023-10-01'
+    })
+    client.post(f'/sleep/{user_name}', json={
+        'sleep_hours'     : 8.0,
+        'avg_heart_rate'  : 60.0,
+        'avg_oxygen_level': 98.0,
+        'sleep_date'      : '2023-10-01'
+    })
+    client.post(f'/blood/{user_name}', json={
+        'RBC'                : 4.5,
+        'WBC'                : 6.0,
+        'glucose_level'      : 90,
+        'cholesterol_level'  : 180,
+        'triglycerides_level': 150,
+        'test_date'          : '2023-10-01'
+    })
+
+
+def test_health_score_is_cached_until_the_data_changes():
+    user = create_test_user('john_doe', 'John Doe', 30)
+    user1 = create_test_user('jane_doe', 'Jane Doe', 31)
+    create_data(user.user_name)
+    create_data(user1.user_name, 3000)
+
+    score = client.get(f'/get_health_score/{user.user_name}').json()['health_score']
+    assert client.get(f'/get_health_score/{user.user_name}').json()['health_score'] == score
+    assert score_cache.stats()['hits'] == 1
+
+    # a write of another user in the same cohort changes the baseline
+    client.put(f'/physical/{user1.user_name}', json={'steps': 5000, 'session_date': '2023-10-01'})
+    new_score = client.get(f'/get_health_score/{user.user_name}').json()['health_score']
+    assert new_score < score
+    assert score_cache.stats()['misses'] == 2
+
+    client.put(f'/physical/{user.user_name}', json={'steps': 2000, 'session_date': '2023-10-01'})
+    assert client.get(f'/get_health_score/{user.user_name}').json()['health_score'] > new_score
+
+    response = client.get('/admin/score_cache')
+    assert response.status_code == 200
+    assert response.json()['hits'] == 1 and response.json()['misses'] == 3
+
+
+def test_score_cache_size_and_ttl():
+    cache = ScoreCache(max_size=2, ttl=60)
+    for user_name in ['a', 'b', 'c']:
+        cache.put(user_name, cache.versions(user_name, 30), 1.0)
+    assert cache.get('a') is None
+    assert cache.get('c') == 1.0
+
+    cache.configure(max_size=2, ttl=0)
+    cache.put('d', cache.versions('d', 30), 1.0)
+    time.sleep(0.01)
+    assert cache.get('d') is None
+
+
+def test_workers_that_share_the_versions_see_each_others_writes(tmp_path):
+    path = str(tmp_path / 'versions')
+    # two workers, every one with its own entries and the versions in the same file
+    worker, other_worker = ScoreCache(versions=SharedVersions(path)), ScoreCache(versions=SharedVersions(path))
+    worker.put('a', worker.versions('a', 30), 1.0)
+    worker.put('b', worker.versions('b', 50), 1.0)
+    other_worker.bump_version('a', 30)
+    assert worker.get('a') is None
+    assert worker.get('b') == 1.0
+
+    other_worker.clear()
+    assert worker.get('b') is None
+
+
+def test_scores_of_data_older_than_a_change_are_not_cached():
+    cache = ScoreCache()
+    cache.bump_version('a', 30)
+    # a replica or a snapshot of before the change, the score would be kept under the new versions
+    cache.put('a', cache.versions('a', 30), 1.0, as_of=time.time() - 5)
+    assert cache.get('a') is None
+    cache.put('a', cache.versions('a', 30), 1.0, as_of=time.time())
+    assert cache.get('a') == 1.0
@@ -5,7 +5,8 @@ from fastapi.testclient import TestClient
 from sqlalchemy import create_engine, StaticPool
 from sqlalchemy.orm import sessionmaker
 
-from Backend.DB import get_db, Base
+from Backend.DB import get_db, get_read_db, Base
+from Backend.cache import score_cache, user_cache
 from Backend.main import app
 
 # Set up the TestClient
@@ -38,6 +39,7 @@ def override_get_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
 
 #
 User_ = namedtuple('User_', ['name', 'age', 'user_name'])
@@ -57,3 +59,6 @@ def setup() -> None:
 def teardown() -> None:
     # Drop the tables in the test database
     Base.metadata.drop_all(bind=engine)
+    # the cached scores and users belong to the dropped data
+    score_cache.clear()
+    user_cache.clear()
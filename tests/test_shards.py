@@ -0,0 +1,117 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select, func
+
+from Backend import DB, shards
+from Backend.DB import get_db, get_read_db, init_db, shard_of, User, PhysicalActivity
+from Backend.cache import score_cache, user_cache
+from Backend.main import app
+from Backend.metrics import database_metrics
+from Backend.routers import physical
+from Backend.routers.utilities import get_age_range
+
+USERS = [(f'user_{i}', 30 + i % 4) for i in range(12)]
+
+
+def configure(monkeypatch, urls: list[str]) -> None:
+    for name in ('engine', 'SessionLocal', 'ShardSessions'):
+        monkeypatch.setattr(DB, name, getattr(DB, name))
+    monkeypatch.setenv('DATABASE_URL', urls[0])
+    monkeypatch.setenv('DATABASE_SHARD_URLS', ','.join(urls) if len(urls) > 1 else '')
+    score_cache.clear()
+    user_cache.clear()
+    init_db()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.delitem(app.dependency_overrides, get_db, raising=False)
+    monkeypatch.delitem(app.dependency_overrides, get_read_db, raising=False)
+    yield TestClient(app)
+    database_metrics.clear()
+    score_cache.clear()
+    user_cache.clear()
+
+
+def populate(client: TestClient) -> None:
+    for i, (user_name, age) in enumerate(USERS):
+        assert client.post('/users/', json={'user_name': user_name, 'name': user_name, 'age': age}).status_code == 200
+        for day in ('2023-01-10', '2023-02-10'):
+            assert client.post(f'/physical/{user_name}', json={
+                'steps': 1000 * (i + 1), 'cardio_time_session_minutes': 10 + i, 'strength_time_session_minutes': 5,
+                'session_date': day}).status_code == 200
+            assert client.post(f'/sleep/{user_name}', json={
+                'sleep_hours': 6 + i / 10, 'avg_heart_rate': 60, 'avg_oxygen_level': 97, 'sleep_date': day
+            }).status_code == 200
+            assert client.post(f'/blood/{user_name}', json={
+                'RBC': 4.5, 'WBC': 6, 'glucose_level': 90 + i, 'cholesterol_level': 180, 'triglycerides_level': 150,
+                'test_date': day}).status_code == 200
+
+
+def results(client: TestClient) -> dict:
+    user_names = [user_name for user_name, _ in USERS]
+    return {'scores'     : {user_name: client.get(f'/get_health_score/{user_name}').json()['health_score']
+                            for user_name in user_names},
+            'batch'      : client.post('/get_health_score/batch', json={'user_names': user_names}).json(),
+            'percentiles': {user_name: client.get(f'/get_health_score/{user_name}/percentile').json()
+                            for user_name in user_names}}
+
+
+def test_shard_of_is_the_same_in_every_process():
+    # moving users between shards isn't supported, the hash must never change
+    assert [shard_of(user_name, 3) for user_name, _ in USERS] == [1, 2, 2, 1, 1, 2, 0, 1, 1, 0, 1, 0]
+
+
+def test_users_are_on_their_shard(client, monkeypatch, tmp_path):
+    urls = [f'sqlite:///{tmp_path / f"shard_{i}.db"}' for i in range(3)]
+    configure(monkeypatch, urls)
+    populate(client)
+
+    for i, url in enumerate(urls):
+        engine = create_engine(url)
+        with engine.connect() as connection:
+            user_names = set(connection.execute(select(User.user_name)).scalars())
+            assert user_names == {user_name for user_name, _ in USERS if shard_of(user_name, 3) == i}
+            assert connection.execute(select(func.count()).select_from(PhysicalActivity)).scalar_one() == \
+                   2 * len(user_names)
+        engine.dispose()
+    assert client.get('/physical/user_5').json()['user'] == 'user_5'
+    assert set(database_metrics.snapshot()) == {'shard_0', 'shard_1', 'shard_2'}
+
+
+def test_scores_are_the_same_as_with_one_database(client, monkeypatch, tmp_path):
+    configure(monkeypatch, [f'sqlite:///{tmp_path / "single.db"}'])
+    populate(client)
+    expected = results(client)
+
+    configure(monkeypatch, [f'sqlite:///{tmp_path / f"shard_{i}.db"}' for i in range(3)])
+    populate(client)
+    actual = results(client)
+
+    assert actual['scores'] == pytest.approx(expected['scores'])
+    assert actual['batch']['health_scores'] == pytest.approx(expected['batch']['health_scores'])
+    assert actual['percentiles'] == expected['percentiles']
+
+
+def test_cohort_queries_gather_all_the_shards(client, monkeypatch, tmp_path):
+    configure(monkeypatch, [f'sqlite:///{tmp_path / f"shard_{i}.db"}' for i in range(3)])
+    populate(client)
+    age_range = get_age_range(30)
+    cohort = [user_name for user_name, age in USERS if age in age_range]
+
+    with DB.SessionLocal() as db:
+        steps, cardio, strength = physical.get_avg_all(age_range, db)
+        assert len(steps) == len(cohort)
+        assert sorted(steps) == sorted(1000.0 * (int(user_name.split('_')[1]) + 1) for user_name in cohort)
+        totals = shards.cohort_totals(age_range, db)
+    assert client.post('/admin/rebuild_aggregates').json()['users'] == {'physical': 12, 'sleep': 12, 'blood': 12}
+    with DB.SessionLocal() as db:
+        assert shards.cohort_totals(age_range, db) == pytest.approx(totals)
+
+
+def test_shards_with_replicas_are_not_supported(monkeypatch, tmp_path):
+    monkeypatch.setattr(DB, 'ShardSessions', DB.ShardSessions)
+    monkeypatch.setenv('DATABASE_SHARD_URLS', f'sqlite:///{tmp_path / "a.db"},sqlite:///{tmp_path / "b.db"}')
+    monkeypatch.setenv('DATABASE_READ_URL', f'sqlite:///{tmp_path / "c.db"}')
+    with pytest.raises(ValueError):
+        init_db()
@@ -237,6 +237,25 @@ def test_update_sleep_activity_with_no_data_returns_404():
     assert response.status_code == 404
     assert response.json()['detail'] == 'No sleep activity found for this date'
 
+
+def test_update_sleep_with_only_the_date_returns_400():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    # a day that doesn't exist
+    response = client.put(f'/sleep/{user.user_name}', json={'sleep_date': '2023-10-01'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'No fields to update'
+
+    client.post(f'/sleep/{user.user_name}', json={
+        'sleep_hours'     : 7.5,
+        'avg_heart_rate'  : 62.0,
+        'avg_oxygen_level': 97.0,
+        'sleep_date'      : '2023-10-01'
+    })
+    response = client.put(f'/sleep/{user.user_name}', json={'sleep_date': '2023-10-01'})
+    assert response.status_code == 400
+    assert client.get(f'/sleep/{user.user_name}').json()['sleep activity'][0]['sleep_hours'] == 7.5
+
+
 def test_delete_sleep_activity_with_no_data_returns_404():
     user = create_test_user('john_doe', 'Jane Doe', 25)
     response = client.delete(f'/sleep/{user.user_name}?delete_dates=2023-10-01')
@@ -411,4 +430,28 @@ def test_get_sleep_activities_with_filter_last_multiple_entries():
     assert response.status_code == 200
     assert response.json()['user'] == user.name
     assert len(response.json()['sleep activity']) == 1
-    assert response.json()['sleep activity'][0]['sleep_hours'] == 7.5
\ No newline at end of file
+    assert response.json()['sleep activity'][0]['sleep_hours'] == 7.5
+
+
+def test_create_sleep_activities_bulk():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    response = client.post(f'/sleep/{user.user_name}/bulk', json=[
+        {'sleep_hours': 8.0, 'avg_heart_rate': 60.0, 'avg_oxygen_level': 98.0, 'sleep_date': '2023-10-01'},
+        {'sleep_hours': 7.0, 'avg_heart_rate': 62.0, 'avg_oxygen_level': 97.0, 'sleep_date': '2023-10-02'},
+        {'sleep_hours': 7.0, 'avg_heart_rate': 62.0, 'sleep_date': '2023-10-03'},
+    ])
+    assert response.status_code == 200
+    assert response.json()['created'] == 2
+    assert [result['status'] for result in response.json()['results']] == ['created', 'created', 'invalid']
+    response = client.get(f'/sleep/{user.user_name}')
+    assert len(response.json()['sleep activity']) == 2
+
+
+def test_create_sleep_activity_with_upsert_overrides_existing_date():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    sleep = {'sleep_hours': 8.0, 'avg_heart_rate': 60.0, 'avg_oxygen_level': 98.0, 'sleep_date': '2023-10-01'}
+    client.post(f'/sleep/{user.user_name}', json=sleep)
+    response = client.post(f'/sleep/{user.user_name}?upsert=true', json={**sleep, 'sleep_hours': 6.5})
+    assert response.status_code == 200
+    response = client.get(f'/sleep/{user.user_name}')
+    assert [data['sleep_hours'] for data in response.json()['sleep activity']] == [6.5]
@@ -1,3 +1,6 @@
+import csv
+import io
+
 from tests.test_setup import client, create_test_user, setup_and_teardown
 
 a = setup_and_teardown
@@ -86,3 +89,25 @@ def test_update_user_with_duplicate_user_name_returns_400():
     assert response.status_code == 200
     assert response.json()['message'] == 'User Jane Smith updated successfully'
 
+
+
+def test_export_user_data():
+    user = create_test_user('john_doe', 'Jane Doe', 25)
+    client.post(f'/physical/{user.user_name}', json={'steps': 1000, 'session_date': '2023-10-01'})
+    client.post(f'/sleep/{user.user_name}', json={
+        'sleep_hours'     : 8.0,
+        'avg_heart_rate'  : 60.0,
+        'avg_oxygen_level': 98.0,
+        'sleep_date'      : '2023-10-01'
+    })
+    response = client.get(f'/users/{user.user_name}/export?format=csv')
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [(row['domain'], row['date']) for row in rows] == [('physical', '2023-10-01'), ('sleep', '2023-10-01')]
+    assert rows[0]['steps'] == '1000' and rows[0]['sleep_hours'] == ''
+    assert rows[1]['sleep_hours'] == '8.0'
+
+
+def test_export_nonexistent_user_returns_404():
+    response = client.get('/users/nonexistent_user/export')
+    assert response.status_code == 404
@@ -0,0 +1,89 @@
+import time
+
+from sqlalchemy import insert
+
+from Backend.DB import User
+from Backend.cache import UserCache, SharedVersions, CachedUser, NOT_CACHED, user_cache
+from Backend.routers.user import get_user
+from tests.test_setup import client, create_test_user, override_get_db, setup_and_teardown
+
+a = setup_and_teardown
+
+
+def test_user_is_looked_up_once():
+    user = create_test_user('john_doe', 'John Doe', 30)
+    assert client.get(f'/users/{user.user_name}').status_code == 200
+    assert client.get(f'/users/{user.user_name}').json() == {'user_name': 'john_doe', 'name': 'John Doe', 'age': 30}
+    # the first lookup is the duplicate check of create_user, it's invalidated by the creation
+    assert user_cache.stats()['hits'] == 1
+
+
+def test_user_cache_is_invalidated_by_update_and_delete():
+    user = create_test_user('john_doe', 'John Doe', 30)
+    client.get(f'/users/{user.user_name}')
+    client.put(f'/users/{user.user_name}', json={'name': 'Johnny', 'age': 40})
+    assert client.get(f'/users/{user.user_name}').json() == {'user_name': 'john_doe', 'name': 'Johnny', 'age': 40}
+
+    client.delete(f'/users/{user.user_name}')
+    assert client.get(f'/users/{user.user_name}').status_code == 404
+    response = client.post('/users/', json={'user_name': user.user_name, 'name': 'John Doe', 'age': 30})
+    assert response.status_code == 200
+    assert client.get(f'/users/{user.user_name}').json()['age'] == 30
+
+
+def test_missing_user_is_cached():
+    assert client.get('/users/john_doe').status_code == 404
+    assert user_cache.get('john_doe') is None
+    # created behind the cache's back, like by another worker
+    db = next(override_get_db())
+    db.execute(insert(User).values(user_name='john_doe', name='John Doe', age=30))
+    db.commit()
+    assert client.get('/users/john_doe').status_code == 404
+    response = client.post('/users/', json={'user_name': 'john_doe', 'name': 'John Doe', 'age': 30})
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'User with this user_name already exists'
+    assert client.get('/users/john_doe').status_code == 200
+
+
+def test_request_identity_map():
+    user = create_test_user('john_doe', 'John Doe', 30)
+    db = next(override_get_db())
+    user_cache.clear()
+    assert get_user(user.user_name, db) is get_user(user.user_name, db)
+    assert user_cache.stats()['misses'] == 1
+
+
+def test_user_cache_expiration_and_size():
+    cache = UserCache(max_size=2, ttl=60)
+    for i in range(3):
+        cache.put(f'user_{i}', cache.generation(f'user_{i}'), CachedUser(i, f'user_{i}', 'User', 30))
+    assert cache.get('user_0') is NOT_CACHED
+    assert cache.get('user_2').id == 2
+
+    cache.configure(max_size=2, ttl=-1)
+    cache.put('user_3', 0, None)
+    assert cache.get('user_3') is NOT_CACHED
+
+
+def test_user_cache_ignores_lookups_that_raced_with_a_change():
+    cache = UserCache()
+    generation = cache.generation('john_doe')
+    cache.invalidate('john_doe')
+    cache.put('john_doe', generation, CachedUser(1, 'john_doe', 'John Doe', 30))
+    assert cache.get('john_doe') is NOT_CACHED
+
+
+def test_a_change_in_another_worker_invalidates_the_user(tmp_path):
+    path = str(tmp_path / 'versions')
+    worker, other_worker = UserCache(versions=SharedVersions(path)), UserCache(versions=SharedVersions(path))
+    worker.put('john_doe', worker.generation('john_doe'), CachedUser(1, 'john_doe', 'John Doe', 30))
+    other_worker.invalidate('john_doe')
+    assert worker.get('john_doe') is NOT_CACHED
+
+
+def test_a_lagging_row_is_not_cached_under_a_new_generation():
+    cache = UserCache()
+    cache.invalidate('john_doe')
+    # read from a replica that may not have the change yet
+    cache.put('john_doe', cache.generation('john_doe'), None, as_of=time.time() - 5)
+    assert cache.get('john_doe') is NOT_CACHED